@@ -0,0 +1,283 @@
+"""
+Data-scale benchmark of DatabaseCore: how insert throughput, each retrieval mode, idea retrieval
+and the database file size evolve from thousands to millions of conversation rows.
+
+For each size, a synthetic database is generated (sessions of alternating user and system turns,
+dates spread over a year, a share of turns carrying a base64 image, ideas summarized every 100
+turns), then every operation is timed on it. The query plan of each retrieval is captured too, so
+full table scans and sorts without an index are flagged next to the timings.
+
+The report gives, for each operation, its time at each size and its growth exponent between the
+smallest and the largest size: ~0 means the operation doesn't depend on the table size (indexed),
+~1 that it grows linearly with it (scan). Save it with --output and pass it back with --compare to
+judge a schema or storage change against it.
+
+Usage:
+    python benchmarks/database_scale.py --sizes 10000 100000 1000000 --images 0 0.05
+    python benchmarks/database_scale.py --sizes 10000 100000 --output before.json
+    python benchmarks/database_scale.py --sizes 10000 100000 --compare before.json
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.core.database import DatabaseCore
+
+from datetime import datetime, timedelta
+import argparse
+import base64
+import json
+import logging
+import math
+import random
+import statistics
+import tempfile
+import time
+
+WORDS = ("light shadow color canvas brush portrait landscape sketch texture palette contrast layer "
+         "composition gallery museum oil watercolor charcoal ink abstract figure perspective horizon").split()
+
+SESSION_TURNS = 20
+IDEAS_EVERY = 100
+BATCH_SIZE = 50000
+START_DATE = datetime(2025, 1, 1)
+
+
+def synthetic_records(rows: int, image_share: float, image_kb: int, seed: int):
+    """Yield conversation records in chronological order, images on a random image_share of them."""
+    rng = random.Random(seed)
+    image = base64.b64encode(rng.randbytes(image_kb * 1024)).decode("ascii")
+    step = 365 * 86400 / max(rows, 1)
+    for index in range(rows):
+        yield {
+            'date': (START_DATE + timedelta(seconds=int(index * step))).strftime("%Y-%m-%d %H:%M:%S"),
+            'role': "user" if index % 2 == 0 else "system",
+            'text': " ".join(rng.choices(WORDS, k=rng.randint(8, 60))),
+            'image': image if rng.random() < image_share else None,
+            'session_id': f"session-{index // SESSION_TURNS}",
+        }
+
+
+def synthetic_ideas(rows: int, seed: int):
+    """Yield one summary of five ideas every IDEAS_EVERY turns, some repeating earlier ideas."""
+    rng = random.Random(seed)
+    step = 365 * 86400 / max(rows, 1)
+    for index in range(0, rows, IDEAS_EVERY):
+        date = (START_DATE + timedelta(seconds=int(index * step))).strftime("%Y-%m-%d %H:%M:%S")
+        ideas = [f"{' '.join(rng.choices(WORDS, k=4))} #{rng.randint(0, rows // 20)}" for _ in range(5)]
+        yield {'date': date, 'idea': "\n".join(ideas)}
+
+
+def batches(records, size: int):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def generate(path: str, rows: int, image_share: float, image_kb: int, seed: int) -> dict:
+    """Create the synthetic database, return the bulk insert throughput."""
+    database = DatabaseCore(verbose=False, database_type="sqlite", database_path=path)
+    start = time.perf_counter()
+    for batch in batches(synthetic_records(rows, image_share, image_kb, seed), BATCH_SIZE):
+        database.conversation_bulk_saver(batch)
+    conversations = time.perf_counter() - start
+
+    start = time.perf_counter()
+    summaries = 0
+    for batch in batches(synthetic_ideas(rows, seed), BATCH_SIZE):
+        summaries += database.idea_bulk_saver(batch)
+    ideas = time.perf_counter() - start
+    database.db.close()
+    return {
+        'bulk_insert_rows_per_s': rows / conversations if conversations else None,
+        'bulk_idea_summaries_per_s': summaries / ideas if ideas and summaries else None,
+    }
+
+
+def query_plans(database: DatabaseCore, call) -> list[str]:
+    """Run a call and return the query plan of every SELECT it issued."""
+    statements = []
+    database.db.set_trace_callback(statements.append)
+    try:
+        call()
+    finally:
+        database.db.set_trace_callback(None)
+
+    plans = []
+    for statement in statements:
+        if not statement.lstrip().upper().startswith(("SELECT", "WITH")):
+            continue
+        try:
+            rows = database.db.execute(f"EXPLAIN QUERY PLAN {statement}").fetchall()
+        except Exception:
+            continue
+        plans.extend(row[-1] for row in rows)
+    return plans
+
+
+def plan_flags(plans: list[str]) -> str:
+    """Summarize query plans: full scans of a table and sorts without an index."""
+    flags = set()
+    for detail in plans:
+        if detail.startswith("SCAN ") and "INDEX" not in detail and not detail.startswith(("SCAN CONSTANT", "SCAN summary", "SCAN (")):
+            flags.add(f"full {detail}")
+        if "TEMP B-TREE" in detail:
+            flags.add(detail.lower())
+    return "; ".join(sorted(flags)) or "indexed"
+
+
+def timed(call, repeat: int) -> float:
+    """The median seconds of a call over repeat runs."""
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        call()
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations)
+
+
+def measure(path: str, rows: int, repeat: int, writes: int) -> dict:
+    """Time every operation on a generated database."""
+    database = DatabaseCore(verbose=False, database_type="sqlite", database_path=path)
+    recent_date = (START_DATE + timedelta(days=364)).strftime("%Y-%m-%d %H:%M:%S")
+    recent_session = f"session-{(rows - 1) // SESSION_TURNS}"
+    summaries = database.idea_retriever(num_rows=1)
+    summary_id = summaries[0]['id'] if summaries else 0
+
+    reads = {
+        'retriever top_k=20': lambda: database.conversation_retriever(top_k=20),
+        'retriever top_k=20 no image': lambda: database.conversation_retriever(top_k=20, exclude_image=True),
+        'retriever since date': lambda: database.conversation_retriever(basedOnDate=True, date=recent_date, exclude_image=True),
+        'retriever since date, role': lambda: database.conversation_retriever(basedOnDate=True, date=recent_date, role="user", exclude_image=True),
+        'session_retriever': lambda: database.session_retriever(recent_session),
+        'page_retriever': lambda: database.conversation_page_retriever(before_date=recent_date, limit=1000),
+        'len': lambda: len(database),
+        'idea_retriever': lambda: database.idea_retriever(num_rows=4),
+        'idea_top_retriever recent': lambda: database.idea_top_retriever(limit=10, order_by="recent"),
+        'idea_top_retriever usage': lambda: database.idea_top_retriever(limit=10, order_by="usage"),
+        'idea_summary_retriever': lambda: database.idea_summary_retriever(summary_id),
+    }
+
+    results = {}
+    for name, call in reads.items():
+        results[name] = {'seconds': timed(call, repeat), 'plan': plan_flags(query_plans(database, call))}
+
+    # Writes last, they add rows to the table
+    counter = iter(range(10 ** 9))
+
+    def single_insert():
+        database.conversation_saver({'role': "user", 'text': "benchmark turn", 'session_id': f"bench-{next(counter)}"})
+
+    def turn_insert():
+        session_id = f"bench-{next(counter)}"
+        with database.turn(session_id=session_id):
+            database.conversation_saver({'role': "user", 'text': "benchmark prompt", 'session_id': session_id})
+            database.conversation_saver({'role': "system", 'text': "benchmark answer", 'session_id': session_id})
+
+    results['insert, commit per row'] = {'seconds': timed(single_insert, writes), 'plan': "-"}
+    results['insert, turn of 2 rows'] = {'seconds': timed(turn_insert, writes), 'plan': "-"}
+    results['idea_saver'] = {'seconds': timed(lambda: database.idea_saver(f"benchmark idea {next(counter)}"), writes), 'plan': "-"}
+    database.db.close()
+    return results
+
+
+def growth(points: list[tuple[int, float]]) -> float:
+    """The exponent k of time ~ size^k between the smallest and the largest size."""
+    points = [point for point in points if point[1] and point[1] > 0]
+    if len(points) < 2 or points[0][0] == points[-1][0]:
+        return None
+    (size_a, time_a), (size_b, time_b) = points[0], points[-1]
+    return math.log(time_b / time_a) / math.log(size_b / size_a)
+
+
+def report(results: list[dict], previous: list[dict] = None):
+    """Print the scaling report, one table per image share."""
+    before = {(run['image_share'], run['rows']): run for run in previous or []}
+    # Compared cells hold the ratio too
+    width = 20 if previous else 12
+    for image_share in sorted({run['image_share'] for run in results}):
+        runs = sorted((run for run in results if run['image_share'] == image_share), key=lambda run: run['rows'])
+        sizes = [run['rows'] for run in runs]
+        print(f"\n## {image_share:.0%} of turns with an image")
+        print(f"{'':>32} " + " ".join(f"{size:>{width},}" for size in sizes) + f" {'growth':>7}  plan at largest size")
+
+        # Throughput is only measured when the database is generated, not when an existing one is reused
+        for key, label in (("bulk_insert_rows_per_s", "bulk insert rows/s"), ("bulk_idea_summaries_per_s", "bulk idea summaries/s")):
+            print(f"{label:>32} " + " ".join(f"{run[key]:>{width},.0f}" if run[key] else f"{'-':>{width}}" for run in runs))
+        print(f"{'file MB':>32} " + " ".join(f"{run['file_bytes'] / 2 ** 20:>{width},.1f}" for run in runs))
+        print(f"{'bytes per row':>32} " + " ".join(f"{run['file_bytes'] / run['rows']:>{width},.0f}" for run in runs))
+
+        for operation in runs[0]['operations']:
+            times = [run['operations'][operation]['seconds'] for run in runs]
+            exponent = growth(list(zip(sizes, times)))
+            cells = []
+            for run, seconds in zip(runs, times):
+                cell = f"{seconds * 1000:.3f}ms"
+                reference = before.get((image_share, run['rows']))
+                if reference and operation in reference['operations'] and reference['operations'][operation]['seconds']:
+                    cell = f"{seconds / reference['operations'][operation]['seconds']:.2f}x {cell}"
+                cells.append(f"{cell:>{width}}")
+            exponent = f"{exponent:.2f}" if exponent is not None else "-"
+            print(f"{operation:>32} " + " ".join(cells) + f" {exponent:>7}  {runs[-1]['operations'][operation]['plan']}")
+    if previous:
+        print("\nRatios are to the compared report, below 1 is faster.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000], help="Conversation rows, e.g. 10000 up to 10000000")
+    parser.add_argument("--images", type=float, nargs="+", default=[0, 0.05], help="Shares of turns with an image")
+    parser.add_argument("--image-kb", type=int, default=64, help="Size of each synthetic image before base64")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs of each read, the median is kept")
+    parser.add_argument("--writes", type=int, default=200, help="Runs of each write, the median is kept")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--directory", help="Where the databases are generated and kept for later runs, a temporary directory if not set")
+    parser.add_argument("--output", help="Write the results as JSON")
+    parser.add_argument("--compare", help="A JSON report of a previous run to compare with")
+    args = parser.parse_args()
+
+    # The retrievers log a warning per row without an image, which would flood the report
+    logging.disable(logging.WARNING)
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['results']
+
+    results = []
+    with tempfile.TemporaryDirectory() as temporary:
+        directory = args.directory or temporary
+        os.makedirs(directory, exist_ok=True)
+        for image_share in args.images:
+            for rows in sorted(args.sizes):
+                path = os.path.join(directory, f"scale_{rows}_{image_share:g}_{args.image_kb}kb_{args.seed}.db")
+                generation = {}
+                if not os.path.exists(path):
+                    print(f"Generating {rows:,} rows, {image_share:.0%} with an image...", file=sys.stderr)
+                    generation = generate(path, rows, image_share, args.image_kb, args.seed)
+                file_bytes = os.path.getsize(path)
+
+                print(f"Measuring {rows:,} rows, {image_share:.0%} with an image...", file=sys.stderr)
+                results.append({
+                    'rows': rows,
+                    'image_share': image_share,
+                    'file_bytes': file_bytes,
+                    'bulk_insert_rows_per_s': generation.get('bulk_insert_rows_per_s'),
+                    'bulk_idea_summaries_per_s': generation.get('bulk_idea_summaries_per_s'),
+                    'operations': measure(path, rows, args.repeat, args.writes),
+                })
+
+    report(results, previous)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({'date': datetime.now().isoformat(timespec="seconds"), 'arguments': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Microbenchmark of the image payload of ModelCore.chattingImage: time per MB, peak RSS and memory
+retained while the request is in flight, for the previous implementation (read the whole file,
+encode, format a data URL next to the base64 kept for the database record) against the chunked
+one (one data URL built in place, shared by the request and the record).
+
+Every run happens in a fresh process so its peak RSS only reflects one payload.
+
+Usage:
+    python benchmarks/encode_image.py --sizes 10 50 200 --repeat 3
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.core.utils import Utils
+
+import argparse
+import base64
+import resource
+import subprocess
+import tempfile
+import time
+
+
+def payload_legacy(image_path: str) -> tuple:
+    """The previous implementation: the base64 for the database and the data URL for the request."""
+    with open(image_path, "rb") as image_file:
+        base64_image = base64.b64encode(image_file.read()).decode("utf-8")
+    return base64_image, f"data:image/jpeg;base64,{base64_image}"
+
+
+def payload_streaming(image_path: str) -> tuple:
+    image_url = Utils(verbose=False).imageDataUrl(image_path)
+    return image_url, image_url
+
+
+ENCODERS = {
+    'legacy': payload_legacy,
+    'streaming': payload_streaming
+}
+
+
+def current_rss_mb() -> float:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def run_once(encoder: str, image_path: str):
+    """Child process: build the payload once, print the time, peak RSS and retained RSS."""
+    baseline_peak = peak_rss_mb()
+    baseline = current_rss_mb()
+    start = time.perf_counter()
+    record, request = ENCODERS[encoder](image_path)
+    elapsed = time.perf_counter() - start
+    # Both strings stay alive until the turn is committed, as in chattingImage
+    print(f"{elapsed} {peak_rss_mb() - baseline_peak} {current_rss_mb() - baseline} {len(record) + len(request)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 50, 200], help="File sizes in MB")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per encoder and size, the best is kept")
+    parser.add_argument("--child", nargs=2, metavar=("ENCODER", "PATH"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_once(*args.child)
+        return
+
+    print(f"{'size MB':>8} {'encoder':>10} {'ms/MB':>8} {'peak RSS MB':>12} {'retained MB':>12}")
+    with tempfile.TemporaryDirectory() as directory:
+        for size in args.sizes:
+            # Random bytes, base64 cost does not depend on the image format
+            image_path = os.path.join(directory, f"scan_{size}mb.bin")
+            with open(image_path, "wb") as f:
+                for _ in range(size):
+                    f.write(os.urandom(1024 * 1024))
+
+            for encoder in ENCODERS:
+                runs = []
+                for _ in range(args.repeat):
+                    output = subprocess.run(
+                        [sys.executable, __file__, "--child", encoder, image_path],
+                        check=True, capture_output=True, text=True
+                    ).stdout.split()
+                    runs.append((float(output[0]), float(output[1]), float(output[2])))
+                elapsed = min(run[0] for run in runs)
+                peak = min(run[1] for run in runs)
+                retained = min(run[2] for run in runs)
+                print(f"{size:>8} {encoder:>10} {elapsed * 1000 / size:>8.2f} {peak:>12.1f} {retained:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,26 @@
 from src.core.model import ModelCore
 from src.core.agent import AgentCore
 from src.core.utils import Utils
+from src.core.image_cache import ImageCache
+from src.core.http_transport import HttpTransport, OPENAI_BASE_URL
+from src.core.image_hash import ImageHashIndex
 from src.core.database import DatabaseCore
+from src.core.sharded_database import ShardedDatabaseCore
 from src.core.logging_config import setup_logging
 from src.core.runner import Runner
-from src.core.tools import ImageAnalysisTool
+from src.core.router import ModeRouter
+from src.core.tools import ImageAnalysisTool, ColorCompositionTool, ParallelResearchTool
 from src.core.prompts import Prompts
+from src.core.tracing import Tracer
+from src.core.profiling import Profiler
+from src.core.tool_cache import ToolCache
+from src.core.session_memory import SessionMemory
+from src.core.archive import ArchiveCore
+from src.core.transfer import DataTransfer
+from src.core.bulk_analysis import BulkAnalyzer
+from src.core.budget import BudgetController
+from src.core.single_flight import SingleFlight
+from src.core.job_queue import JobQueue
 
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
@@ -30,6 +45,10 @@ class ArtBuddy:
         self.variableLoader()
         logger.info("Environment variables loaded!")
 
+        # ==== Load HTTP Transport ==== #
+        self.transport_handler()
+        logger.info("HTTP Transport loaded!")
+
         # ==== Load Utils ==== #
         self.utils_loader()
         logger.info("Utils loaded!")
@@ -42,10 +61,42 @@ class ArtBuddy:
         self.database_handler()
         logger.info("Database loaded!")
 
+        # ==== Load Job Queue ==== #
+        self.jobs_handler()
+        logger.info("Job Queue loaded!")
+
+        # ==== Load Archive ==== #
+        self.archive_handler()
+        logger.info("Archive loaded!")
+
+        # ==== Load Data Transfer ==== #
+        self.transfer_handler()
+        logger.info("Data Transfer loaded!")
+
+        # ==== Load Budget ==== #
+        self.budget_handler()
+        logger.info("Budget loaded!")
+
+        # ==== Load Image Index ==== #
+        self.image_index_handler()
+        logger.info("Image Index loaded!")
+
         # ==== Load Model ==== #
         self.model_handler()
         logger.info("Model loaded!")
 
+        # ==== Load Bulk Analyzer ==== #
+        self.bulk_analysis_handler()
+        logger.info("Bulk Analyzer loaded!")
+
+        # ==== Load Tracer ==== #
+        self.tracer_handler()
+        logger.info("Tracer loaded!")
+
+        # ==== Load Profiler ==== #
+        self.profiler_handler()
+        logger.info("Profiler loaded!")
+
         # ==== Load Tools ==== #
         self.tools_handler()
         logger.info("Tools loaded!")
@@ -54,6 +105,10 @@ class ArtBuddy:
         self.agent_handler()
         logger.info("Agent loaded!")
 
+        # ==== Load Router ==== #
+        self.router_handler()
+        logger.info("Router loaded!")
+
         # ==== Load Runner ==== #
         self.run()
 
@@ -80,6 +135,15 @@ class ArtBuddy:
         
         self.verbosity = int(os.getenv("VERBOSITY"))
         logger.info(f"Verbosity: {self.verbosity} -> type: {type(self.verbosity)}")
+
+        self.agent_pool_size = int(os.getenv("AGENT_POOL_SIZE") or 1)
+        logger.info(f"Agent Pool Size: {self.agent_pool_size} -> type: {type(self.agent_pool_size)}")
+
+        self.agent_pool_min_size = int(os.getenv("AGENT_POOL_MIN_SIZE") or 1)
+        logger.info(f"Agent Pool Min Size: {self.agent_pool_min_size} -> type: {type(self.agent_pool_min_size)}")
+
+        self.agent_pool_idle_timeout = float(os.getenv("AGENT_POOL_IDLE_TIMEOUT") or 300)
+        logger.info(f"Agent Pool Idle Timeout: {self.agent_pool_idle_timeout} -> type: {type(self.agent_pool_idle_timeout)}")
         
         logger.info("Environment variables loaded!")
 
@@ -87,11 +151,122 @@ class ArtBuddy:
         logger.info(f"Database Type: {self.database_type} -> type: {type(self.database_type)}")
         self.database_path = os.getenv("DATABASE_PATH")
         logger.info(f"Database Path: {self.database_path} -> type: {type(self.database_path)}")
+
+        self.database_shards = int(os.getenv("DATABASE_SHARDS") or 4)
+        logger.info(f"Database Shards: {self.database_shards} -> type: {type(self.database_shards)}")
+
+        self.image_cache_path = os.getenv("IMAGE_CACHE_PATH") or "data/cache/derivatives"
+        logger.info(f"Image Cache Path: {self.image_cache_path} -> type: {type(self.image_cache_path)}")
+
+        self.image_cache_max_mb = int(os.getenv("IMAGE_CACHE_MAX_MB") or 512)
+        logger.info(f"Image Cache Max MB: {self.image_cache_max_mb} -> type: {type(self.image_cache_max_mb)}")
+
+        self.image_dedup_distance = int(os.getenv("IMAGE_DEDUP_DISTANCE") or 6)
+        logger.info(f"Image Dedup Distance: {self.image_dedup_distance} -> type: {type(self.image_dedup_distance)}")
+
+        self.archive_path = os.getenv("ARCHIVE_PATH") or "data/archive"
+        logger.info(f"Archive Path: {self.archive_path} -> type: {type(self.archive_path)}")
+
+        self.retention_days = int(os.getenv("RETENTION_DAYS") or 0)
+        logger.info(f"Retention Days: {self.retention_days} -> type: {type(self.retention_days)}")
+
+        self.session_token_budget = int(os.getenv("SESSION_TOKEN_BUDGET") or 2000)
+        logger.info(f"Session Token Budget: {self.session_token_budget} -> type: {type(self.session_token_budget)}")
+
+        self.bulk_analysis_concurrency = int(os.getenv("BULK_ANALYSIS_CONCURRENCY") or 4)
+        logger.info(f"Bulk Analysis Concurrency: {self.bulk_analysis_concurrency} -> type: {type(self.bulk_analysis_concurrency)}")
+
+        self.token_budget = int(os.getenv("TOKEN_BUDGET") or 0)
+        logger.info(f"Token Budget: {self.token_budget} -> type: {type(self.token_budget)}")
+
+        self.image_budget = int(os.getenv("IMAGE_BUDGET") or 0)
+        logger.info(f"Image Budget: {self.image_budget} -> type: {type(self.image_budget)}")
+
+        self.budget_window = float(os.getenv("BUDGET_WINDOW") or 86400)
+        logger.info(f"Budget Window: {self.budget_window} -> type: {type(self.budget_window)}")
+
+        self.budget_max_queue_wait = float(os.getenv("BUDGET_MAX_QUEUE_WAIT") or 30)
+        logger.info(f"Budget Max Queue Wait: {self.budget_max_queue_wait} -> type: {type(self.budget_max_queue_wait)}")
+
+        self.coalesce_requests = bool((os.getenv("COALESCE_REQUESTS") or "true").lower() == "true")
+        logger.info(f"Coalesce Requests: {self.coalesce_requests} -> type: {type(self.coalesce_requests)}")
+
+        self.job_workers = int(os.getenv("JOB_WORKERS") or 1)
+        logger.info(f"Job Workers: {self.job_workers} -> type: {type(self.job_workers)}")
+
+        self.image_job_workers = int(os.getenv("IMAGE_JOB_WORKERS") or 4)
+        logger.info(f"Image Job Workers: {self.image_job_workers} -> type: {type(self.image_job_workers)}")
+
+        self.research_concurrency = int(os.getenv("RESEARCH_CONCURRENCY") or 8)
+        logger.info(f"Research Concurrency: {self.research_concurrency} -> type: {type(self.research_concurrency)}")
+
+        self.research_timeout = float(os.getenv("RESEARCH_TIMEOUT") or 10)
+        logger.info(f"Research Timeout: {self.research_timeout} -> type: {type(self.research_timeout)}")
+
+        self.routing_threshold = float(os.getenv("ROUTING_THRESHOLD") or 1.0)
+        logger.info(f"Routing Threshold: {self.routing_threshold} -> type: {type(self.routing_threshold)}")
+
+        self.tracing = bool((os.getenv("TRACING") or "false").lower() == "true")
+        logger.info(f"Tracing: {self.tracing} -> type: {type(self.tracing)}")
+
+        self.profiling = bool((os.getenv("PROFILING") or "false").lower() == "true")
+        logger.info(f"Profiling: {self.profiling} -> type: {type(self.profiling)}")
+
+        self.profiling_mode = os.getenv("PROFILING_MODE") or "sampling"
+        logger.info(f"Profiling Mode: {self.profiling_mode} -> type: {type(self.profiling_mode)}")
+
+        self.profiling_sample_rate = float(os.getenv("PROFILING_SAMPLE_RATE") or 0.01)
+        logger.info(f"Profiling Sample Rate: {self.profiling_sample_rate} -> type: {type(self.profiling_sample_rate)}")
+
+        self.profiling_interval = float(os.getenv("PROFILING_INTERVAL") or 0.01)
+        logger.info(f"Profiling Interval: {self.profiling_interval} -> type: {type(self.profiling_interval)}")
+
+        self.profiling_memory = bool((os.getenv("PROFILING_MEMORY") or "false").lower() == "true")
+        logger.info(f"Profiling Memory: {self.profiling_memory} -> type: {type(self.profiling_memory)}")
+
+        self.profiling_path = os.getenv("PROFILING_PATH") or "data/profiles"
+        logger.info(f"Profiling Path: {self.profiling_path} -> type: {type(self.profiling_path)}")
+
+        self.http_timeout = float(os.getenv("HTTP_TIMEOUT") or 60)
+        logger.info(f"HTTP Timeout: {self.http_timeout} -> type: {type(self.http_timeout)}")
+
+        self.http_max_connections = int(os.getenv("HTTP_MAX_CONNECTIONS") or 20)
+        logger.info(f"HTTP Max Connections: {self.http_max_connections} -> type: {type(self.http_max_connections)}")
+
+        self.http_keepalive_expiry = float(os.getenv("HTTP_KEEPALIVE_EXPIRY") or 120)
+        logger.info(f"HTTP Keepalive Expiry: {self.http_keepalive_expiry} -> type: {type(self.http_keepalive_expiry)}")
+
+        self.http2 = bool((os.getenv("HTTP2") or "true").lower() == "true")
+        logger.info(f"HTTP2: {self.http2} -> type: {type(self.http2)}")
+
+        self.http_warm_urls = [url.strip() for url in (os.getenv("HTTP_WARM_URLS") or OPENAI_BASE_URL).split(",") if url.strip()]
+        logger.info(f"HTTP Warm URLs: {self.http_warm_urls} -> type: {type(self.http_warm_urls)}")
+
+        self.http_keep_warm_interval = float(os.getenv("HTTP_KEEP_WARM_INTERVAL") or 60)
+        logger.info(f"HTTP Keep Warm Interval: {self.http_keep_warm_interval} -> type: {type(self.http_keep_warm_interval)}")
+
+        self.tool_cache_ttl = float(os.getenv("TOOL_CACHE_TTL") or 0)
+        logger.info(f"Tool Cache TTL: {self.tool_cache_ttl} -> type: {type(self.tool_cache_ttl)}")
         
 
+    def transport_handler(self):
+        logger.info("Loading HTTP Transport - - -")
+        self.transport = HttpTransport(
+            verbose=self.verbose,
+            timeout=self.http_timeout,
+            max_connections=self.http_max_connections,
+            keepalive_expiry=self.http_keepalive_expiry,
+            http2=self.http2,
+            warm_urls=self.http_warm_urls,
+            keep_warm_interval=self.http_keep_warm_interval
+            )
+        self.transport.start()
+
+
     def utils_loader(self):
         logger.info("Loading Utils - - -")
-        self.utils = Utils(verbose=self.verbose)
+        self.image_cache = ImageCache(cache_path=self.image_cache_path, verbose=self.verbose, max_bytes=self.image_cache_max_mb * 1024 * 1024)
+        self.utils = Utils(verbose=self.verbose, image_cache=self.image_cache, transport=self.transport, download_timeout=self.http_timeout)
 
 
     def prompts_loader(self):
@@ -101,11 +276,56 @@ class ArtBuddy:
 
     def database_handler(self):
         logger.info("Loading Database - - -")
-        self.database = DatabaseCore(verbose=self.verbose, database_type=self.database_type, database_path=self.database_path)
+        if self.database_type == "sqlite_sharded":
+            self.database = ShardedDatabaseCore(verbose=self.verbose, database_type=self.database_type, database_path=self.database_path, num_shards=self.database_shards)
+        else:
+            self.database = DatabaseCore(verbose=self.verbose, database_type=self.database_type, database_path=self.database_path)
+
+
+    def jobs_handler(self):
+        logger.info("Loading Job Queue - - -")
+        self.jobs = JobQueue(database=self.database, verbose=self.verbose, workers=self.job_workers, kinds=("sumUpIdeas", "archiveConversations"))
+
+        # Image generations get their own workers, so they pipeline without waiting on background jobs.
+        # They aren't retried: a failed generation is reported to its caller, who decides to resubmit
+        self.image_jobs = JobQueue(database=self.database, verbose=self.verbose, workers=self.image_job_workers, max_attempts=1, poll_interval=0.5, kinds=("generatingImage",))
+
+
+    def archive_handler(self):
+        logger.info("Loading Archive - - -")
+        self.archive = ArchiveCore(database=self.database, archive_path=self.archive_path, verbose=self.verbose)
+
+
+    def transfer_handler(self):
+        logger.info("Loading Data Transfer - - -")
+        self.transfer = DataTransfer(database=self.database, verbose=self.verbose)
+
+
+    def budget_handler(self):
+        logger.info("Loading Budget - - -")
+        self.budget = BudgetController(
+            database=self.database,
+            verbose=self.verbose,
+            token_limit=self.token_budget,
+            image_limit=self.image_budget,
+            window=self.budget_window,
+            max_queue_wait=self.budget_max_queue_wait,
+            agent_factor=self.max_steps
+            )
+
+
+    def image_index_handler(self):
+        logger.info("Loading Image Index - - -")
+        # A negative distance disables near-duplicate detection
+        self.image_index = None
+        if self.image_dedup_distance >= 0:
+            self.image_index = ImageHashIndex(database=self.database, verbose=self.verbose, threshold=self.image_dedup_distance)
 
 
     def model_handler(self):
         logger.info("Loading Model - - - ")
+        # Identical model calls in flight at the same time share one upstream request
+        self.single_flight = SingleFlight(verbose=self.verbose) if self.coalesce_requests else None
         self.model = ModelCore(
             model_provider=self.model_provider,
             model_name=self.model_name,
@@ -114,17 +334,53 @@ class ArtBuddy:
             API_TOKEN=self.API_TOKEN,
             database=self.database,
             prompts=self.prompts,
-            verbose=self.verbose
+            verbose=self.verbose,
+            image_index=self.image_index,
+            budget=self.budget,
+            single_flight=self.single_flight,
+            transport=self.transport
             )
         
 
+    def bulk_analysis_handler(self):
+        logger.info("Loading Bulk Analyzer - - - ")
+        self.bulk_analyzer = BulkAnalyzer(model=self.model, verbose=self.verbose, concurrency=self.bulk_analysis_concurrency)
+
+
+    def tracer_handler(self):
+        logger.info("Loading Tracer - - - ")
+        self.tracer = Tracer(database=self.database, verbose=self.verbose, enabled=self.tracing)
+
+
+    def profiler_handler(self):
+        logger.info("Loading Profiler - - - ")
+        self.profiler = Profiler(
+            verbose=self.verbose,
+            enabled=self.profiling,
+            mode=self.profiling_mode,
+            sample_rate=self.profiling_sample_rate,
+            interval=self.profiling_interval,
+            memory=self.profiling_memory,
+            output_path=self.profiling_path
+            )
+
+
     def tools_handler(self):
         logger.info("Loading Tools - - - ")
 
         # Image Analysis Tool
         image_analysis_tool = ImageAnalysisTool(model_handler=self.model)
 
-        self.tools = [image_analysis_tool]
+        # Color and Composition Tool, local measurements that don't need the vision model
+        color_composition_tool = ColorCompositionTool()
+
+        # Parallel Research Tool, shared by the manager and the Web Agent so their searches share one bounded pool
+        self.research_tool = ParallelResearchTool(max_workers=self.research_concurrency, timeout=self.research_timeout)
+
+        self.tools = [image_analysis_tool, color_composition_tool, self.research_tool]
+
+        # Tool calls are memoized per agent run, and across runs when a TTL is set
+        self.tool_cache = ToolCache(verbose=self.verbose, ttl=self.tool_cache_ttl)
 
 
     def agent_handler(self):
@@ -137,10 +393,24 @@ class ArtBuddy:
             verbosity_level=self.verbosity, 
             verbose=self.verbose,
             database=self.database,
-            prompts=self.prompts
+            prompts=self.prompts,
+            tracer=self.tracer,
+            tool_cache=self.tool_cache,
+            pool_size=self.agent_pool_size,
+            pool_min_size=self.agent_pool_min_size,
+            pool_idle_timeout=self.agent_pool_idle_timeout,
+            budget=self.budget,
+            research_tool=self.research_tool,
+            profiler=self.profiler,
+            transport=self.transport
             )
 
 
+    def router_handler(self):
+        logger.info("Loading Router - - - ")
+        self.router = ModeRouter(database=self.database, verbose=self.verbose, threshold=self.routing_threshold)
+
+
     def run(self):
         mode = "generatingImage"
         user_prompt = "A cute horse playing with a ball while sky boarding."
@@ -149,12 +419,33 @@ class ArtBuddy:
         agent_mode = False
         use_ideas = False
 
+        session_memory = SessionMemory(model=self.model,
+                                       database=self.database,
+                                       utils=self.utils,
+                                       prompts=self.prompts,
+                                       verbose=self.verbose,
+                                       token_budget=self.session_token_budget)
+
         runner = Runner(model=self.model,
                         agent=self.agent,
                         database=self.database,
                         utils=self.utils,
                         prompts=self.prompts,
-                        verbose=self.verbose)
+                        verbose=self.verbose,
+                        session_memory=session_memory,
+                        budget=self.budget,
+                        job_queue=self.jobs,
+                        router=self.router,
+                        profiler=self.profiler,
+                        image_queue=self.image_jobs)
+
+        # Background work runs on the job queue, never while an interactive request is running
+        self.jobs.register("sumUpIdeas", lambda payload: runner.sumUpIdeas(**payload))
+        self.jobs.register("archiveConversations", lambda payload: self.archive.archiveConversations(**payload))
+        self.jobs.start()
+
+        self.image_jobs.register("generatingImage", lambda payload: runner.run(mode="generatingImage", **payload))
+        self.image_jobs.start()
 
         #### ----- Image Generation ----- ####
         # Basic image generation
@@ -164,6 +455,13 @@ class ArtBuddy:
             use_ideas=False
         )
 
+        # Non-blocking image generation, the job id is returned at once
+        # job_id = runner.submitGeneratingImage(
+        #     user_prompt="A lighthouse in a storm",
+        #     callback=lambda job: print(job['status'], job['result'] or job['error'])
+        # )
+        # self.image_jobs.wait(job_id, timeout=60)
+
         # Image generation with ideas from previous conversations
         # runner.run(
         #     mode="generatingImage",
@@ -186,6 +484,13 @@ class ArtBuddy:
         #     img_path="data/imgs/squire.jpg"
         # )
 
+        # Critique a whole portfolio, results are appended to the JSONL file as they finish
+        # self.bulk_analyzer.analyze(
+        #     source="data/imgs",
+        #     prompt="Critique the composition and color theory of this artwork",
+        #     output_path="data/portfolio_analysis.jsonl"
+        # )
+
         #### ----- Chatting ----- ####
         # Basic chat
         # runner.run(
@@ -193,6 +498,14 @@ class ArtBuddy:
         #     user_prompt="Tell me about art history"
         # )
 
+        # Let the router pick direct model mode or agent mode from the prompt, within a latency SLO
+        # runner.run(
+        #     mode="chatting",
+        #     agent_mode="auto",
+        #     user_prompt="What are the latest exhibitions about Impressionism this year?",
+        #     latency_slo=20
+        # )
+
         # Agent-based chat (for complex queries and research)
         runner.run(
             mode="chatting",
@@ -201,9 +514,22 @@ class ArtBuddy:
         )
 
 
-        # Sum up ideas every 10 conversations
+        # Sum up ideas every 10 conversations, in the background
         if len(self.database) % 10 == 0:
-            runner.sumUpIdeas(top_k=10, exclude_image=True)
+            self.jobs.submit("sumUpIdeas", payload={'top_k': 10, 'exclude_image': True})
+
+        # Move conversations older than the retention period to the archive
+        if self.retention_days > 0:
+            self.jobs.submit("archiveConversations", payload={'retention_days': self.retention_days})
+
+        # Let queued jobs finish before exiting, jobs left in the queue are resumed at the next start
+        self.jobs.join()
+        self.jobs.shutdown()
+        self.image_jobs.join()
+        self.image_jobs.shutdown()
+
+        # The jobs are done with the connection pool, stop keeping it warm and close it
+        self.transport.close()
 
 
 if __name__ == "__main__":
@@ -3,10 +3,26 @@ from src.core.utils import Utils
 from src.core.database import DatabaseCore
 from src.core.logging_config import setup_logging
 from src.core.prompts import Prompts
+from src.core.tracing import Tracer
+from src.core.tool_cache import ToolCache
+from src.core.agent_pool import AgentPool
+from src.core.budget import BudgetController
+from src.core.tools import ParallelResearchTool
+from src.core.profiling import Profiler
+from src.core.http_transport import HttpTransport
 
 from smolagents import CodeAgent, OpenAIServerModel, DuckDuckGoSearchTool, Tool
+from smolagents.agents import FinalAnswerStep
+from smolagents.memory import ActionStep, PlanningStep
 
 from PIL import Image
+from functools import wraps
+from typing import AsyncIterator, Callable, Iterator
+import asyncio
+import copy
+import queue
+import threading
+import time
 import os
 import logging
 
@@ -22,7 +38,16 @@ class AgentCore:
                        verbosity_level: int, 
                        verbose: bool,
                        database: DatabaseCore,
-                       prompts: Prompts):
+                       prompts: Prompts,
+                       tracer: Tracer = None,
+                       tool_cache: ToolCache = None,
+                       pool_size: int = 1,
+                       pool_min_size: int = 1,
+                       pool_idle_timeout: float = 300,
+                       budget: BudgetController = None,
+                       research_tool: ParallelResearchTool = None,
+                       profiler: Profiler = None,
+                       transport: HttpTransport = None):
         """
         Initialize the AgentCore class.
 
@@ -35,18 +60,42 @@ class AgentCore:
             verbosity_level: The verbosity level of the agent.
             verbose: The verbose level of the agent.
             database: The database to use.
+            prompts: The prompts to use.
+            tracer: The tracer recording agent steps. Tracing is disabled if not provided.
+            tool_cache: The cache memoizing tool calls. Calls are memoized per run if not provided.
+            pool_size: The maximum number of manager agents serving requests concurrently.
+            pool_min_size: The number of manager agents built at startup.
+            pool_idle_timeout: Seconds after which an idle agent above pool_min_size is evicted.
+            budget: The budget controller the agents' model calls are charged to. Not metered if not provided.
+            research_tool: The tool fanning out the Web Agent's searches. A default one is used if not provided.
+            profiler: The profiler sampling agent runs. Agent runs are only profiled as part of a profiled request if not provided.
+            transport: The shared HTTP connection pool. The server model uses its own if not provided.
         """
         # Configure logging based on verbosity level
         setup_logging(verbose=verbose)
 
         logger.info("Initializing AgentCore - - -")
         self.model_handler = model_instance
+        self.transport = transport
         self.serverModel = self.loadModel()
         self.tools = tools
         self.database = database
         self.utils = utils
         self.prompts = prompts
-        self.managerAgent = self.agentManager(planning_interval, verbosity_level, max_steps)
+        self.tracer = tracer or Tracer(database=database, verbose=verbose, enabled=False)
+        self.toolCache = tool_cache or ToolCache(verbose=verbose)
+        self.budget = budget
+        self.researchTool = research_tool or ParallelResearchTool()
+        self.profiler = profiler or Profiler(verbose=verbose)
+        # The event stream of the request running in each thread, if it is streamed
+        self._stream = threading.local()
+        self.agentPool = AgentPool(
+            factory=lambda: self.agentManager(planning_interval, verbosity_level, max_steps),
+            verbose=verbose,
+            max_size=pool_size,
+            min_size=pool_min_size,
+            idle_timeout=pool_idle_timeout
+        )
         logger.info("AgentCore initialized successfully!")
 
 
@@ -62,8 +111,8 @@ class AgentCore:
         """
         logger.info("Initializing agent manager...")
         agent = CodeAgent(
-            model=self.serverModel,
-            tools=self.tools,
+            model=self.wrapModel(agent_name="manager"),
+            tools=[self.wrapTool(tool, agent_name="manager") for tool in self.tools],
             managed_agents=[
                 self.WebAgent(max_steps, verbosity_level)
             ],
@@ -72,6 +121,7 @@ class AgentCore:
             verbosity_level=verbosity_level,
             final_answer_checks=[],
             max_steps=max_steps,
+            step_callbacks=[self.tracer.stepCallback(agent_name="manager"), self.stepEvents],
         )
         logger.info("Agent manager initialized successfully")
         return agent
@@ -83,108 +133,346 @@ class AgentCore:
         """
         logger.info("Loading web agent - - -")
         agent = CodeAgent(
-            model=self.serverModel,
-            tools=[DuckDuckGoSearchTool()],
+            model=self.wrapModel(agent_name="Web_Agent"),
+            tools=[self.wrapTool(tool, agent_name="Web_Agent") for tool in (DuckDuckGoSearchTool(), self.researchTool)],
             name="Web_Agent",
-            description="A Web Agent that can search the web for information.",
+            description="A Web Agent that can search the web for information. Give it every sub-query of a research task at once, it searches them in parallel.",
             verbosity_level=verbosity_level,
-            max_steps=max_steps
+            max_steps=max_steps,
+            step_callbacks=[self.tracer.stepCallback(agent_name="Web_Agent"), self.stepEvents]
         )
+        self.delegationEvents(agent)
         logger.info("Web agent loaded successfully!")
         return agent
 
 
-    def runAgent(self, prompt: str, history: list[str]) -> str:
+    def wrapTool(self, tool: Tool, agent_name: str) -> Tool:
+        """
+        Wrap a tool with memoization, tracing and stream events.
+
+        Each agent gets its own shallow copy of the tool, so a tool given to several agents (e.g. the
+        research tool, shared by the manager and the Web Agent) records its spans under the agent
+        calling it, while the copies still share its state such as the research pool.
+
+        Args:
+            tool: The tool to wrap.
+            agent_name: The name of the agent owning this tool.
+        """
+        tool = self.tracer.wrapTool(self.toolCache.wrapTool(copy.copy(tool)), agent_name=agent_name)
+        if getattr(tool, "_streamed", False):
+            return tool
+
+        forward = tool.forward
+
+        @wraps(forward)
+        def streamed_forward(*args, **kwargs):
+            start = time.monotonic()
+            self.emit("tool_call_started", tool=tool.name, arguments=self.preview(kwargs or args))
+            try:
+                result = forward(*args, **kwargs)
+            except Exception as e:
+                self.emit("tool_call_finished", tool=tool.name, duration=time.monotonic() - start, error=str(e))
+                raise
+            self.emit("tool_call_finished", tool=tool.name, duration=time.monotonic() - start, output=self.preview(result))
+            return result
+
+        tool.forward = streamed_forward
+        tool._streamed = True
+        return tool
+
+
+    def delegationEvents(self, agent: CodeAgent):
+        """
+        Emit the delegation of a task to a managed agent as a tool call, and its report as a partial answer.
+        Events emitted while it runs are attributed to it.
+        """
+        run = agent.run
+
+        @wraps(run)
+        def streamed_run(task, *args, **kwargs):
+            sink = getattr(self._stream, "sink", None)
+            if sink is None:
+                return run(task, *args, **kwargs)
+
+            start = time.monotonic()
+            self.emit("tool_call_started", tool=agent.name, arguments=self.preview(task))
+            caller, sink['agent'] = sink['agent'], agent.name
+            try:
+                result = run(task, *args, **kwargs)
+            finally:
+                sink['agent'] = caller
+            self.emit("tool_call_finished", tool=agent.name, duration=time.monotonic() - start)
+            self.emit("partial_answer", source=agent.name, answer=str(result))
+            return result
+
+        agent.run = streamed_run
+
+
+    def stepEvents(self, memory_step, agent=None):
+        """Step callback emitting every finished action step of an agent: its thought, its tool calls and what they returned."""
+        if not isinstance(memory_step, ActionStep) or getattr(self._stream, "sink", None) is None:
+            return
+        self.emit(
+            "step",
+            step_number=memory_step.step_number,
+            thought=self.preview(memory_step.model_output),
+            tool_calls=[tool_call.name for tool_call in memory_step.tool_calls or []],
+            observations=self.preview(memory_step.observations),
+            error=str(memory_step.error) if memory_step.error else None,
+            duration=memory_step.duration
+        )
+
+
+    def emit(self, event_type: str, **data):
+        """Push an event to the stream of the request running in this thread, if it is streamed."""
+        sink = getattr(self._stream, "sink", None)
+        if sink is not None:
+            sink['events'].put({'type': event_type, 'agent': sink['agent'], 'time': time.monotonic() - sink['start'], **data})
+
+
+    @staticmethod
+    def preview(value, limit: int = 1000):
+        """Shorten a value for an event."""
+        if value is None:
+            return None
+        text = str(value)
+        return text if len(text) <= limit else text[:limit] + "..."
+
+
+    def stream(self, call: Callable) -> Iterator[dict]:
+        """
+        Run a request in a worker thread and stream its events as they happen:
+            - started: right away
+            - plan: each plan of the manager
+            - tool_call_started / tool_call_finished: each tool call, including delegations to the Web Agent
+            - step: each finished agent step, with its thought, tool calls and observations
+            - partial_answer: each report of a managed agent
+            - final_answer: the result of the request, or error if it failed
+        Every event has its type, the agent it comes from and its time since the start. The request
+        is persisted as when it isn't streamed, and runs to completion even if the stream is abandoned.
+
+        Args:
+            call: The request, e.g. lambda: self.runAgent(prompt, history).
+
+        Yields:
+            dict: The events of the request.
+
+        Raises:
+            Exception: The exception raised by the request, after its error event.
+        """
+        events = queue.Queue()
+        done = object()
+        failure = []
+
+        def worker():
+            self._stream.sink = {'events': events, 'agent': "manager", 'start': time.monotonic()}
+            try:
+                self.emit("started")
+                self.emit("final_answer", answer=call())
+            except Exception as e:
+                logger.error(f"Streamed request failed: {str(e)}")
+                self.emit("error", error=str(e))
+                failure.append(e)
+            finally:
+                self._stream.sink = None
+                events.put(done)
+
+        threading.Thread(target=worker, name="agent-stream", daemon=True).start()
+        while (event := events.get()) is not done:
+            yield event
+        if failure:
+            raise failure[0]
+
+
+    async def astream(self, call: Callable) -> AsyncIterator[dict]:
+        """
+        Async iterator over the events of a request, see stream.
+        """
+        events = self.stream(call)
+        done = object()
+        while (event := await asyncio.to_thread(next, events, done)) is not done:
+            yield event
+
+
+    def streamAgent(self, prompt: str, history: list[dict], session_id: str = None) -> Iterator[dict]:
+        """Run the agent, streaming its events. See runAgent and stream."""
+        return self.stream(lambda: self.runAgent(prompt, history, session_id=session_id))
+
+
+    def streamImageAgent(self, prompt: str, image_path: str, history: list[dict] = None, session_id: str = None) -> Iterator[dict]:
+        """Run the agent with an image, streaming its events. See runImageAgent and stream."""
+        return self.stream(lambda: self.runImageAgent(prompt, image_path, history=history, session_id=session_id))
+
+
+    def astreamAgent(self, prompt: str, history: list[dict], session_id: str = None) -> AsyncIterator[dict]:
+        """Async version of streamAgent."""
+        return self.astream(lambda: self.runAgent(prompt, history, session_id=session_id))
+
+
+    def astreamImageAgent(self, prompt: str, image_path: str, history: list[dict] = None, session_id: str = None) -> AsyncIterator[dict]:
+        """Async version of streamImageAgent."""
+        return self.astream(lambda: self.runImageAgent(prompt, image_path, history=history, session_id=session_id))
+
+
+    def wrapModel(self, agent_name: str):
+        """
+        Wrap the server model of an agent with tracing and, if a budget is set, metering.
+
+        Args:
+            agent_name: The name of the agent using the model.
+        """
+        model = self.tracer.wrapModel(self.serverModel, agent_name=agent_name)
+        if self.budget is not None:
+            model = self.budget.wrapModel(model)
+        return model
+
+
+    def runAgent(self, prompt: str, history: list[dict], session_id: str = None) -> str:
         """
         Run the agent.
 
         Args:
             prompt: The prompt to use.
-            history: The history of the conversation.
-        """
-        # Format the prompt
-        formatted_prompt, original_prompt = self.prompts.promptFormatter(task="chatting", prompt=prompt)
-
-        # Save user's prompt to database before being processed
-        self.database.conversation_saver(
-            data={
-                'role': 'user',
-                'text': original_prompt
-            },
-            data_table='conversations'
-        )
-        logger.info(f"User's original prompt saved to database")
-
-        logger.info(f"Running agent with prompt: {formatted_prompt}")
-        result = self.managerAgent.run(formatted_prompt, history)
-        logger.info("Agent execution completed")
-
-        # Save system's response to database
-        self.database.conversation_saver(
-            data={
-                'role': 'system',
-                'text': result
-            },
-            data_table='conversations'
-        )
-        logger.info(f"System's response saved to database")
-        return result
+            history: The history of the conversation, as chat messages.
+            session_id: The session making the request, used to check out an agent from the pool.
+        """
+        # Every record of the request, including nested tool calls, is committed at once when the turn ends.
+        # The run is profiled if sampled, or as part of the profiled request calling it
+        with self.profiler.profile(name="runAgent"), self.database.turn(session_id=session_id):
+            # Format the prompt
+            formatted_prompt, original_prompt = self.prompts.promptFormatter(task="chatting", prompt=prompt)
+
+            # Save user's prompt to database before being processed
+            conversation_id = self.database.conversation_saver(
+                data={
+                    'role': 'user',
+                    'text': original_prompt,
+                    'session_id': session_id
+                },
+                data_table='conversations'
+            )
+            logger.info(f"User's original prompt saved to database")
+
+            logger.info(f"Running agent with prompt: {formatted_prompt}")
+            with self.agentPool.checkout(session_id) as managerAgent, \
+                 self.tracer.trace(name="runAgent", conversation_id=conversation_id), \
+                 self.toolCache.run(name="runAgent"):
+                result = self.execute(managerAgent, self.withHistory(formatted_prompt, history))
+            logger.info("Agent execution completed")
 
+            # Save system's response to database
+            self.database.conversation_saver(
+                data={
+                    'role': 'system',
+                    'text': result,
+                    'session_id': session_id
+                },
+                data_table='conversations'
+            )
+            logger.info(f"System's response saved to database")
+            return result
 
-    def runImageAgent(self, prompt: str, image_path: str, history: list[str] = None) -> str:
+
+    def runImageAgent(self, prompt: str, image_path: str, history: list[dict] = None, session_id: str = None) -> str:
         """
         Run the agent with an image.
 
         Args:
             prompt: The prompt to use.
             image_path: Path to the image file.
-            history: The history of the conversation.
-        """
-        # Format the prompt
-        formatted_prompt, original_prompt = self.prompts.promptFormatter(task="chattingImage", prompt=prompt, image_path=image_path)
-
-        # Save user's prompt to database before being processed
-        self.database.conversation_saver(
-            data={
-                'role': 'user',
-                'text': original_prompt
-            },
-            data_table='conversations'
-        )
-        logger.info(f"User's original prompt saved to database")
+            history: The history of the conversation, as chat messages.
+            session_id: The session making the request, used to check out an agent from the pool.
+        """
+        # Every record of the request, including nested tool calls, is committed at once when the turn ends.
+        # The run is profiled if sampled, or as part of the profiled request calling it
+        with self.profiler.profile(name="runImageAgent"), self.database.turn(session_id=session_id):
+            # Format the prompt
+            formatted_prompt, original_prompt = self.prompts.promptFormatter(task="chattingImage", prompt=prompt, image_path=image_path)
 
+            # Save user's prompt to database before being processed
+            conversation_id = self.database.conversation_saver(
+                data={
+                    'role': 'user',
+                    'text': original_prompt,
+                    'session_id': session_id
+                },
+                data_table='conversations'
+            )
+            logger.info(f"User's original prompt saved to database")
 
-        logger.info(f"Running image agent with prompt: {prompt}")
-        logger.info(f"Using image from path: {image_path}")
 
-        # Create a prompt that instructs the agent to use the image analysis tool
-        agent_prompt = self.prompts.agentPromptTemplate(prompt=prompt, image_path=image_path)
+            logger.info(f"Running image agent with prompt: {prompt}")
+            logger.info(f"Using image from path: {image_path}")
 
-        # Save agent's prompt to database before being processed
-        self.database.conversation_saver(
-            data={
-                'role': 'agent',
-                'text': agent_prompt
-            },
-            data_table='conversations'
-        )
-        logger.info(f"Agent's prompt saved to database")
+            # Create a prompt that instructs the agent to use the image analysis tool
+            agent_prompt = self.prompts.agentPromptTemplate(prompt=prompt, image_path=image_path)
 
+            # Save agent's prompt to database before being processed
+            self.database.conversation_saver(
+                data={
+                    'role': 'agent',
+                    'text': agent_prompt,
+                    'session_id': session_id
+                },
+                data_table='conversations'
+            )
+            logger.info(f"Agent's prompt saved to database")
 
-        # Run the agent with the formatted prompt
-        result = self.managerAgent.run(agent_prompt, history or [])
-        logger.info("Image agent execution completed")
 
-        # Save system's response to database
-        self.database.conversation_saver(
-            data={
-                'role': 'system',
-                'text': result
-            },
-            data_table='conversations'
-        )
-        logger.info(f"System's response saved to database")
-        return result
+            # Run the agent with the formatted prompt
+            with self.agentPool.checkout(session_id) as managerAgent, \
+                 self.tracer.trace(name="runImageAgent", conversation_id=conversation_id), \
+                 self.toolCache.run(name="runImageAgent"):
+                result = self.execute(managerAgent, self.withHistory(agent_prompt, history))
+            logger.info("Image agent execution completed")
+
+            # Save system's response to database
+            self.database.conversation_saver(
+                data={
+                    'role': 'system',
+                    'text': result,
+                    'session_id': session_id
+                },
+                data_table='conversations'
+            )
+            logger.info(f"System's response saved to database")
+            return result
+
+
+    def execute(self, agent: CodeAgent, task: str):
+        """
+        Run an agent on a task. When the request is streamed, the agent's steps are iterated as they
+        happen to emit its plans; the other events come from the step callbacks and tool wrappers.
+
+        Returns:
+            The final answer of the agent.
+        """
+        if getattr(self._stream, "sink", None) is None:
+            return agent.run(task)
+
+        final_answer = None
+        for step in agent.run(task, stream=True):
+            if isinstance(step, PlanningStep):
+                self.emit("plan", plan=step.plan)
+            elif isinstance(step, FinalAnswerStep):
+                final_answer = step.final_answer
+        return final_answer
+
+
+    def withHistory(self, task: str, history: list[dict]) -> str:
+        """
+        Prepend the history of the conversation to an agent task. Agents only take a task string.
+
+        Args:
+            task: The task to run.
+            history: The history of the conversation, as chat messages.
+        """
+        if not history:
+            return task
+
+        history_text = "\n".join(f"{message['role']}: {message['content']}" for message in history)
+        formatted_task, _ = self.prompts.promptFormatter(task="agentWithHistory", prompt=[history_text, task])
+        return formatted_task
 
 
     def loadModel(self) -> OpenAIServerModel:
@@ -192,6 +480,7 @@ class AgentCore:
         Load the model acceptable by the SmolAgents CodeAgent.
         """
         logger.info("Loading server model...")
-        model = OpenAIServerModel(model_id=self.model_handler.model_name)
+        client_kwargs = self.transport.clientKwargs() if self.transport is not None else None
+        model = OpenAIServerModel(model_id=self.model_handler.model_name, client_kwargs=client_kwargs)
         logger.info("Server model loaded successfully")
         return model
@@ -0,0 +1,163 @@
+from src.core.logging_config import setup_logging
+
+from smolagents import CodeAgent
+
+from contextlib import contextmanager
+from typing import Callable
+import threading
+import time
+import logging
+
+# Get logger for this module
+logger = logging.getLogger(__name__)
+
+class AgentPool:
+    def __init__(self, factory: Callable[[], CodeAgent],
+                       verbose: bool,
+                       max_size: int = 1,
+                       min_size: int = 1,
+                       idle_timeout: float = 300):
+        """
+        Initialize the AgentPool class.
+
+        SmolAgents agents keep their memory and python state between runs, so a single
+        agent can't serve concurrent requests. The pool hands out one agent per request.
+
+        Args:
+            factory: Builds a new manager agent (with its managed agents).
+            verbose: Whether to enable verbose logging.
+            max_size: The maximum number of agents alive at once.
+            min_size: The number of agents built at startup and never evicted.
+            idle_timeout: Seconds after which an idle agent above min_size is evicted.
+        """
+        self.factory = factory
+        self.max_size = max(max_size, 1)
+        self.min_size = min(max(min_size, 0), self.max_size)
+        self.idle_timeout = idle_timeout
+        self.verbose = verbose
+        setup_logging(verbose=verbose)
+
+        # Idle entries are kept most recently used last
+        self._idle = []
+        self._size = 0
+        self._condition = threading.Condition()
+
+        self.prewarm()
+        logger.info(f"Agent pool ready with {self._size} agents (max {self.max_size})")
+
+
+    def prewarm(self):
+        """
+        Build agents up to min_size so the first requests don't pay for agent construction.
+        """
+        while self._size < self.min_size:
+            agent = self.factory()
+            with self._condition:
+                self._size += 1
+                self._idle.append({'agent': agent, 'tenant': None, 'last_used': time.monotonic()})
+
+
+    @contextmanager
+    def checkout(self, session_id: str = None, timeout: float = None):
+        """
+        Check an agent out of the pool for the duration of one request.
+
+        An agent last used by another session is reset before being handed out, and a
+        session gets back its previous agent when it is idle.
+
+        Args:
+            session_id: The session/user making the request. None always gets a clean agent.
+            timeout: Seconds to wait for a free agent. Waits forever if None.
+
+        Yields:
+            CodeAgent: The manager agent reserved for this request.
+
+        Raises:
+            TimeoutError: If no agent became free in time.
+        """
+        entry = self._acquire(session_id, timeout)
+        try:
+            if session_id is None or entry['tenant'] != session_id:
+                self.resetAgent(entry['agent'])
+            entry['tenant'] = session_id
+            yield entry['agent']
+        finally:
+            self._release(entry)
+
+
+    def _acquire(self, session_id: str, timeout: float) -> dict:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while True:
+                self._evictIdle()
+
+                if self._idle:
+                    # Prefer the agent this session used last, otherwise the most recently used one
+                    for index in range(len(self._idle) - 1, -1, -1):
+                        if session_id is not None and self._idle[index]['tenant'] == session_id:
+                            return self._idle.pop(index)
+                    return self._idle.pop()
+
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError(f"No agent available after {timeout} seconds")
+                self._condition.wait(remaining)
+
+        # Build outside of the lock, agent construction is slow
+        try:
+            logger.info(f"Growing agent pool to {self._size} agents")
+            return {'agent': self.factory(), 'tenant': None, 'last_used': time.monotonic()}
+        except Exception:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+
+
+    def _release(self, entry: dict):
+        with self._condition:
+            entry['last_used'] = time.monotonic()
+            self._idle.append(entry)
+            self._condition.notify()
+
+
+    def _evictIdle(self):
+        """Drop agents idle for longer than idle_timeout while keeping min_size alive. Expects the lock held."""
+        now = time.monotonic()
+        kept = []
+        for entry in self._idle:
+            if self._size > self.min_size and now - entry['last_used'] > self.idle_timeout:
+                self._size -= 1
+                logger.info("Evicted idle agent from pool")
+            else:
+                kept.append(entry)
+        self._idle = kept
+
+
+    def resetAgent(self, agent: CodeAgent):
+        """
+        Clear everything an agent remembers from a previous tenant: memory, token monitor,
+        shared state and python executor variables, for the agent and its managed agents.
+        """
+        agent.memory.reset()
+        agent.monitor.reset()
+        agent.state.clear()
+        if getattr(agent, "python_executor", None) is not None:
+            agent.python_executor = agent.create_python_executor()
+        for managed_agent in agent.managed_agents.values():
+            self.resetAgent(managed_agent)
+
+
+    def stats(self) -> dict:
+        """
+        Return the current size of the pool.
+
+        Returns:
+            dict: The number of agents alive, idle and in use.
+        """
+        with self._condition:
+            return {'size': self._size, 'idle': len(self._idle), 'in_use': self._size - len(self._idle)}
@@ -0,0 +1,173 @@
+from src.core.database import DatabaseCore
+from src.core.logging_config import setup_logging
+
+from datetime import datetime, timedelta
+from typing import Iterator
+import gzip
+import json
+import os
+import logging
+
+# Get logger for this module
+logger = logging.getLogger(__name__)
+
+class ArchiveCore:
+    def __init__(self, database: DatabaseCore, archive_path: str, verbose: bool, batch_size: int = 1000):
+        """
+        Initialize the ArchiveCore class.
+
+        Old conversations are moved out of the database into gzip compressed JSONL files, one per
+        month, listed in a manifest so archived ranges can still be queried read-only.
+
+        Args:
+            database: The database holding the conversations.
+            archive_path: The directory of the archive files and manifest.
+            verbose: Whether to enable verbose logging.
+            batch_size: The number of rows read from the database at once.
+        """
+        self.database = database
+        self.archive_path = archive_path
+        self.batch_size = batch_size
+        self.verbose = verbose
+        setup_logging(verbose=verbose)
+
+        os.makedirs(self.archive_path, exist_ok=True)
+        self.manifest_path = os.path.join(self.archive_path, "manifest.json")
+
+
+    def archiveConversations(self, retention_days: int, full_vacuum: bool = False) -> int:
+        """
+        Move the conversations older than retention_days to the archive and reclaim their space.
+
+        Each page of rows is written and listed in the manifest before being deleted, so an
+        interrupted run never loses data; at worst the last page is archived twice.
+
+        Args:
+            retention_days: The number of days of conversations kept in the database.
+            full_vacuum: Force a full VACUUM instead of an incremental one.
+
+        Returns:
+            int: The number of archived rows.
+        """
+        cutoff = (datetime.now() - timedelta(days=retention_days)).strftime("%Y-%m-%d %H:%M:%S")
+        logger.info(f"Archiving conversations older than {cutoff}")
+
+        manifest = self.loadManifest()
+        last_id = 0
+        archived = 0
+
+        while True:
+            rows = self.database.conversation_page_retriever(before_date=cutoff, after_id=last_id, limit=self.batch_size)
+            if not rows:
+                break
+
+            # Group the page by month and append each group to its partition
+            partitions = {}
+            for row in rows:
+                partitions.setdefault(row[1][:7], []).append(row)
+
+            for month, month_rows in partitions.items():
+                self.appendPartition(month, month_rows, manifest)
+            self.saveManifest(manifest)
+
+            # Only delete once the page is durably archived
+            self.database.conversation_deleter(ids=[row[0] for row in rows])
+
+            last_id = rows[-1][0]
+            archived += len(rows)
+
+        if archived:
+            self.database.reclaim_space(full=full_vacuum)
+
+        logger.info(f"{archived} conversations archived to {self.archive_path}")
+        return archived
+
+
+    def appendPartition(self, month: str, rows: list[list], manifest: dict):
+        """
+        Append rows to the archive file of a month and update its manifest entry.
+
+        Args:
+            month: The month of the rows, as YYYY-MM.
+            rows: The rows to append, as [id, date, role, text, image, session_id, parent_id].
+            manifest: The manifest to update.
+        """
+        filename = f"conversations-{month}.jsonl.gz"
+        path = os.path.join(self.archive_path, filename)
+
+        # Appending writes a new gzip member, readers decompress concatenated members transparently
+        with gzip.open(path, "at", encoding="utf-8") as f:
+            f.writelines(
+                json.dumps({'id': row[0], 'date': row[1], 'role': row[2], 'text': row[3], 'image': row[4], 'session_id': row[5], 'parent_id': row[6]}) + "\n"
+                for row in rows
+            )
+            f.flush()
+            os.fsync(f.fileno())
+
+        entry = manifest.setdefault(month, {'file': filename, 'rows': 0, 'first_id': rows[0][0], 'last_id': rows[0][0], 'start_date': rows[0][1], 'end_date': rows[0][1]})
+        entry['rows'] += len(rows)
+        entry['first_id'] = min(entry['first_id'], min(row[0] for row in rows))
+        entry['last_id'] = max(entry['last_id'], max(row[0] for row in rows))
+        entry['start_date'] = min(entry['start_date'], min(row[1] for row in rows))
+        entry['end_date'] = max(entry['end_date'], max(row[1] for row in rows))
+
+
+    def queryArchive(self, start_date: str = None, end_date: str = None, role: str = None, session_id: str = None, exclude_image: bool = False) -> Iterator[dict]:
+        """
+        Stream archived conversations, only opening the partitions overlapping the date range.
+
+        Args:
+            start_date: Only return rows saved at or after this date.
+            end_date: Only return rows saved before this date.
+            role: Filter by role ('user', 'system', 'agent').
+            session_id: Filter by session.
+            exclude_image: Whether to drop the image of each row.
+
+        Yields:
+            dict: One archived row, oldest first.
+        """
+        for month, entry in sorted(self.loadManifest().items()):
+            if start_date is not None and entry['end_date'] < start_date:
+                continue
+            if end_date is not None and entry['start_date'] >= end_date:
+                continue
+
+            with gzip.open(os.path.join(self.archive_path, entry['file']), "rt", encoding="utf-8") as f:
+                for line in f:
+                    row = json.loads(line)
+                    # Rows archived before parent_id was kept have no parent
+                    row.setdefault('parent_id', None)
+                    if start_date is not None and row['date'] < start_date:
+                        continue
+                    if end_date is not None and row['date'] >= end_date:
+                        continue
+                    if role is not None and row['role'] != role:
+                        continue
+                    if session_id is not None and row['session_id'] != session_id:
+                        continue
+                    if exclude_image:
+                        row['image'] = None
+                    yield row
+
+
+    def loadManifest(self) -> dict:
+        """
+        Load the manifest listing every archive partition.
+
+        Returns:
+            dict: The partitions by month, with their file, row count, id and date range.
+        """
+        if not os.path.exists(self.manifest_path):
+            return {}
+        with open(self.manifest_path, "r") as f:
+            return json.load(f)
+
+
+    def saveManifest(self, manifest: dict):
+        """Atomically replace the manifest file."""
+        temporary_path = f"{self.manifest_path}.tmp"
+        with open(temporary_path, "w") as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, self.manifest_path)
@@ -0,0 +1,298 @@
+from src.core.database import DatabaseCore
+from src.core.logging_config import setup_logging
+
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import threading
+import time
+import logging
+
+# Get logger for this module
+logger = logging.getLogger(__name__)
+
+# Usage without a session_id is accounted under this key
+ANONYMOUS = "anonymous"
+KINDS = ("tokens", "images")
+
+
+class BudgetExceededError(Exception):
+    """Raised when a request can't be admitted, or an agent run is stopped, because its session is over budget."""
+
+
+class MeteredModel:
+    """
+    Thin proxy around a SmolAgents model that charges the tokens of every call to the session of
+    the current request, and refuses new calls once the session is over budget so a runaway agent
+    loop stops at its next step. Every other attribute is forwarded to the wrapped model.
+    """
+    def __init__(self, model, controller: "BudgetController"):
+        self._model = model
+        self._controller = controller
+
+
+    def __call__(self, *args, **kwargs):
+        self._controller.check()
+        result = self._model(*args, **kwargs)
+        self._controller.record(tokens=(getattr(self._model, "last_input_token_count", None) or 0) + (getattr(self._model, "last_output_token_count", None) or 0))
+        return result
+
+
+    def __getattr__(self, name):
+        return getattr(self._model, name)
+
+
+class BudgetController:
+    # Rough cost of one direct model call on top of its prompt: the completion and an image input
+    OUTPUT_TOKENS = 512
+    IMAGE_TOKENS = 765
+
+    def __init__(self, database: DatabaseCore,
+                       verbose: bool,
+                       token_limit: int = 0,
+                       image_limit: int = 0,
+                       window: float = 86400,
+                       max_queue_wait: float = 30,
+                       agent_factor: int = 8):
+        """
+        Initialize the BudgetController class.
+
+        Every session has a token bucket and an image bucket holding up to its limit and refilling
+        continuously over `window` seconds. Usage reported by ModelCore and the agents' models is
+        charged to the session of the request, and requests are admitted against an estimate of
+        their cost: run as asked if it fits, degraded from agent mode to direct model mode if only
+        that fits, queued if the bucket refills enough within max_queue_wait, rejected otherwise.
+        Buckets are plain dict entries, so every lookup on the request path is O(1).
+
+        Args:
+            database: The database where usage is persisted.
+            verbose: Whether to enable verbose logging.
+            token_limit: The tokens a session can spend per window, 0 for no limit.
+            image_limit: The images a session can generate per window, 0 for no limit.
+            window: The seconds over which a bucket refills completely.
+            max_queue_wait: The longest a request is held waiting for its budget to refill.
+            agent_factor: The estimated cost of an agent run, in direct model calls.
+        """
+        self.database = database
+        self.limits = {'tokens': token_limit, 'images': image_limit}
+        self.window = window
+        self.max_queue_wait = max_queue_wait
+        self.agent_factor = agent_factor
+        self.verbose = verbose
+        setup_logging(verbose=verbose)
+
+        # (session, kind) -> [level, last refill time]
+        self._buckets = {}
+        self._lock = threading.Lock()
+        # The request running in this thread, so nested model calls are charged to its session
+        self._local = threading.local()
+
+        # Start from what each session already spent in the current window
+        since = (datetime.now() - timedelta(seconds=window)).strftime("%Y-%m-%d %H:%M:%S")
+        now = time.monotonic()
+        for session, used in self.database.usage_retriever(since=since).items():
+            for kind in KINDS:
+                if self.limits[kind]:
+                    self._buckets[(session, kind)] = [self.limits[kind] - used[kind], now]
+        logger.info(f"Budgets: {token_limit or 'unlimited'} tokens and {image_limit or 'unlimited'} images per session every {window}s")
+
+
+    def estimateTokens(self, prompt_tokens: int, history_tokens: int = 0, image: bool = False, agent: bool = False) -> int:
+        """
+        Estimate the tokens of a request before running it.
+
+        Args:
+            prompt_tokens: The tokens of the user's prompt.
+            history_tokens: The tokens of the session history sent with it.
+            image: Whether an image is sent.
+            agent: Whether the request runs an agent, which makes several model calls.
+
+        Returns:
+            int: The estimated tokens.
+        """
+        tokens = prompt_tokens + history_tokens + self.OUTPUT_TOKENS + (self.IMAGE_TOKENS if image else 0)
+        return tokens * self.agent_factor if agent else tokens
+
+
+    def _bucket(self, session: str, kind: str, now: float) -> list:
+        """Return the refilled bucket of a session. Must be called with the lock held."""
+        limit = self.limits[kind]
+        bucket = self._buckets.get((session, kind))
+        if bucket is None:
+            bucket = self._buckets[(session, kind)] = [limit, now]
+        else:
+            bucket[0] = min(limit, bucket[0] + (now - bucket[1]) * limit / self.window)
+            bucket[1] = now
+        return bucket
+
+
+    def _wait(self, session: str, costs: dict, now: float) -> float:
+        """Seconds until every bucket of a session holds its cost. Must be called with the lock held."""
+        wait = 0.0
+        for kind, cost in costs.items():
+            limit = self.limits[kind]
+            if not limit or not cost:
+                continue
+            if cost > limit:
+                return float("inf")
+            level = self._bucket(session, kind, now)[0]
+            if level < cost:
+                wait = max(wait, (cost - level) * self.window / limit)
+        return wait
+
+
+    def admit(self, session_id: str = None, tokens: int = 0, images: int = 0, fallback_tokens: int = None) -> dict:
+        """
+        Admit a request, reserving its estimated cost.
+
+        Args:
+            session_id: The session making the request.
+            tokens: The estimated tokens of the request.
+            images: The images the request generates.
+            fallback_tokens: The estimated tokens of the degraded request (direct model mode instead
+                of agent mode), None if it can't be degraded.
+
+        Returns:
+            dict: The admission, with the session, the reserved tokens and images, and whether the
+                request must run degraded. Pass it to charge().
+
+        Raises:
+            BudgetExceededError: If the session's budget won't refill in time.
+        """
+        session = session_id or ANONYMOUS
+        deadline = time.monotonic() + self.max_queue_wait
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                options = [(False, {'tokens': tokens, 'images': images})]
+                if fallback_tokens is not None:
+                    options.append((True, {'tokens': fallback_tokens, 'images': images}))
+
+                waits = []
+                for degraded, costs in options:
+                    wait = self._wait(session, costs, now)
+                    if wait == 0:
+                        for kind, cost in costs.items():
+                            if self.limits[kind]:
+                                self._bucket(session, kind, now)[0] -= cost
+                        if degraded:
+                            logger.info(f"Session {session} is short on budget, degrading to direct model mode")
+                        return {'session': session, 'tokens': costs['tokens'], 'images': costs['images'], 'degraded': degraded}
+                    waits.append(wait)
+
+            # Queue for the cheapest option, as long as it refills before the deadline
+            wait = min(waits)
+            if now + wait > deadline:
+                logger.warning(f"Session {session} rejected, over budget")
+                raise BudgetExceededError(f"Session {session} is over its budget, retry in {wait:.0f}s")
+            logger.info(f"Session {session} queued for {wait:.1f}s until its budget refills")
+            time.sleep(wait)
+
+
+    @contextmanager
+    def charge(self, session_id: str = None, admission: dict = None):
+        """
+        Charge every usage recorded in this thread to a session until the request ends. On exit the
+        unused part of the admission's reservation is refunded and the usage is persisted.
+
+        Args:
+            session_id: The session making the request.
+            admission: The admission returned by admit(), None if nothing was reserved.
+
+        Yields:
+            dict: The usage of the request, updated as it runs.
+        """
+        current = getattr(self._local, "charge", None)
+        if current is not None:
+            # A nested request is part of the outer one
+            yield current
+            return
+
+        admission = admission or {}
+        current = {
+            'session': session_id or ANONYMOUS,
+            'reserved': {kind: admission.get(kind, 0) for kind in KINDS},
+            'used': {kind: 0 for kind in KINDS}
+        }
+        self._local.charge = current
+        try:
+            yield current
+        finally:
+            self._local.charge = None
+            with self._lock:
+                now = time.monotonic()
+                for kind in KINDS:
+                    unused = current['reserved'][kind] - current['used'][kind]
+                    if self.limits[kind] and unused > 0:
+                        self._bucket(current['session'], kind, now)[0] += unused
+            if any(current['used'].values()):
+                self.database.usage_saver(current['session'], tokens=current['used']['tokens'], images=current['used']['images'])
+
+
+    def record(self, session_id: str = None, tokens: int = 0, images: int = 0):
+        """
+        Charge usage to a session, by default the session of the request running in this thread.
+
+        Args:
+            session_id: The session to charge.
+            tokens: The tokens used.
+            images: The images generated.
+        """
+        current = getattr(self._local, "charge", None)
+        session = session_id or (current['session'] if current is not None else ANONYMOUS)
+        in_request = current is not None and current['session'] == session
+
+        with self._lock:
+            now = time.monotonic()
+            for kind, amount in (('tokens', tokens), ('images', images)):
+                if not amount:
+                    continue
+                debit = amount
+                if in_request:
+                    # Only the part of the usage beyond the reservation is taken from the bucket
+                    used, reserved = current['used'][kind], current['reserved'][kind]
+                    debit = max(0, used + amount - reserved) - max(0, used - reserved)
+                    current['used'][kind] += amount
+                if self.limits[kind] and debit:
+                    self._bucket(session, kind, now)[0] -= debit
+
+        if not in_request and (tokens or images):
+            self.database.usage_saver(session, tokens=tokens, images=images)
+
+
+    def check(self, session_id: str = None):
+        """
+        Raise if the session of the request running in this thread has no tokens left, counting
+        what remains of its reservation.
+
+        Raises:
+            BudgetExceededError: If the session is over its token budget.
+        """
+        if not self.limits['tokens']:
+            return
+        current = getattr(self._local, "charge", None)
+        session = session_id or (current['session'] if current is not None else ANONYMOUS)
+
+        with self._lock:
+            remaining = self._bucket(session, 'tokens', time.monotonic())[0]
+        if current is not None and current['session'] == session:
+            remaining += max(0, current['reserved']['tokens'] - current['used']['tokens'])
+        if remaining <= 0:
+            logger.warning(f"Session {session} ran out of tokens, stopping")
+            raise BudgetExceededError(f"Session {session} ran out of tokens")
+
+
+    def remaining(self, session_id: str = None) -> dict:
+        """
+        Return the tokens and images a session can still spend right now, None when unlimited.
+        """
+        session = session_id or ANONYMOUS
+        with self._lock:
+            now = time.monotonic()
+            return {kind: self._bucket(session, kind, now)[0] if self.limits[kind] else None for kind in KINDS}
+
+
+    def wrapModel(self, model):
+        """
+        Wrap a SmolAgents model so its calls are charged to the session of the current request.
+        """
+        return MeteredModel(model, controller=self)
@@ -0,0 +1,179 @@
+from src.core.model import ModelCore
+from src.core.logging_config import setup_logging
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Iterator
+from PIL import Image, ImageOps
+import base64
+import glob
+import io
+import json
+import os
+import time
+import logging
+
+# Get logger for this module
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".webp", ".bmp", ".gif", ".tif", ".tiff"}
+
+
+def prepareImage(image_path: str, max_side: int, quality: int) -> str:
+    """
+    Decode, downscale and re-encode an image as a base64 JPEG. Runs in a worker process, so it
+    must stay a module level function.
+
+    Args:
+        image_path: The path to the image.
+        max_side: The longest side of the image sent to the vision model.
+        quality: The JPEG quality.
+
+    Returns:
+        str: The base64 encoded JPEG.
+    """
+    with Image.open(image_path) as image:
+        image.draft("RGB", (max_side, max_side))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+        buffer = io.BytesIO()
+        image.convert("RGB").save(buffer, format="JPEG", quality=quality)
+    return base64.b64encode(buffer.getvalue()).decode("utf-8")
+
+
+class BulkAnalyzer:
+    def __init__(self, model: ModelCore,
+                       verbose: bool,
+                       concurrency: int = 4,
+                       workers: int = None,
+                       max_side: int = 1024,
+                       quality: int = 85):
+        """
+        Initialize the BulkAnalyzer class.
+
+        Images are discovered lazily, decoded and downscaled in a process pool, and analysed by the
+        vision model with at most `concurrency` calls in flight. At most 2 * concurrency images are
+        held in memory at once, however many images the source holds.
+
+        Args:
+            model: The model analysing the images.
+            verbose: Whether to enable verbose logging.
+            concurrency: The maximum number of vision calls in flight.
+            workers: The number of preprocessing processes, defaults to the number of CPUs.
+            max_side: The longest side of the images sent to the vision model.
+            quality: The JPEG quality of the images sent to the vision model.
+        """
+        self.model = model
+        self.concurrency = max(1, concurrency)
+        self.workers = workers or os.cpu_count() or 1
+        self.max_side = max_side
+        self.quality = quality
+        self.verbose = verbose
+        setup_logging(verbose=verbose)
+
+
+    def iterImages(self, source: str) -> Iterator[str]:
+        """
+        Lazily list the images of a directory (recursively) or matching a glob pattern.
+
+        Args:
+            source: A directory or a glob pattern such as "portfolio/**/*.jpg".
+
+        Yields:
+            str: The path of each image.
+        """
+        if os.path.isdir(source):
+            for directory, subdirectories, filenames in os.walk(source):
+                subdirectories.sort()
+                for filename in sorted(filenames):
+                    if os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS:
+                        yield os.path.join(directory, filename)
+        else:
+            for path in glob.iglob(source, recursive=True):
+                if os.path.isfile(path) and os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS:
+                    yield path
+
+
+    def iterAnalyses(self, source: str, prompt: str, session_id: str = None) -> Iterator[dict]:
+        """
+        Analyse every image of a source and yield the results as they finish, in completion order.
+        Each analysis is saved to the database by ModelCore.chattingImage as its own turn.
+
+        Args:
+            source: A directory or a glob pattern.
+            prompt: The question asked about every image.
+            session_id: The session the analyses belong to.
+
+        Yields:
+            dict: The image_path, analysis, error (None on success) and seconds of each image.
+        """
+        paths = self.iterImages(source)
+        window = 2 * self.concurrency
+
+        with ProcessPoolExecutor(max_workers=self.workers) as processes, ThreadPoolExecutor(max_workers=self.concurrency) as threads:
+            def submit():
+                # Preprocessing starts right away, the vision call waits for a free thread
+                path = next(paths, None)
+                if path is None:
+                    return False
+                prepared = processes.submit(prepareImage, path, self.max_side, self.quality)
+                pending.add(threads.submit(self.analyzeImage, path, prepared, prompt, session_id))
+                return True
+
+            pending = set()
+            while len(pending) < window and submit():
+                pass
+
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+                    submit()
+
+
+    def analyzeImage(self, image_path: str, prepared, prompt: str, session_id: str = None) -> dict:
+        """Wait for the preprocessed image and run the vision call, never raising."""
+        start = time.perf_counter()
+        try:
+            analysis = self.model.chattingImage(prompt, image_path, session_id=session_id, base64_image=prepared.result())
+            error = None
+        except Exception as e:
+            logger.error(f"Failed to analyze {image_path}: {str(e)}")
+            analysis, error = None, str(e)
+        return {'image_path': image_path, 'analysis': analysis, 'error': error, 'seconds': round(time.perf_counter() - start, 3)}
+
+
+    def analyze(self, source: str, prompt: str, output_path: str = None, session_id: str = None) -> dict:
+        """
+        Analyse every image of a source, appending each result to a JSONL file as soon as it finishes.
+
+        Args:
+            source: A directory or a glob pattern.
+            prompt: The question asked about every image.
+            output_path: The JSONL file the results are appended to, none if not given.
+            session_id: The session the analyses belong to.
+
+        Returns:
+            dict: The number of analysed and failed images and the elapsed seconds.
+        """
+        logger.info(f"Bulk analysis of {source} with {self.concurrency} concurrent calls and {self.workers} workers")
+        start = time.perf_counter()
+        analysed, failed = 0, 0
+
+        output = open(output_path, "a", encoding="utf-8") if output_path else None
+        try:
+            for result in self.iterAnalyses(source, prompt, session_id=session_id):
+                if result['error'] is None:
+                    analysed += 1
+                else:
+                    failed += 1
+                if output is not None:
+                    output.write(json.dumps(result) + "\n")
+                    output.flush()
+                logger.info(f"[{analysed + failed}] {result['image_path']} analysed in {result['seconds']}s")
+        finally:
+            if output is not None:
+                output.close()
+
+        stats = {'analysed': analysed, 'failed': failed, 'seconds': round(time.perf_counter() - start, 3)}
+        logger.info(f"Bulk analysis done: {stats}")
+        return stats
@@ -1,11 +1,54 @@
 import sqlite3
 import logging
+import hashlib
+import json
+import re
+import ast
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from itertools import groupby
 from datetime import datetime
 from src.core.logging_config import setup_logging
+from src.core.profiling import activeProfile
 
 # Get logger for this module
 logger = logging.getLogger(__name__)
 
+# Bullets and numbering models put in front of the ideas of a summary
+IDEA_BULLET = re.compile(r"^\s*(?:[-*\u2022]|\d+[.)])\s+")
+
+IDEA_COLUMNS = ('id', 'idea', 'date', 'last_seen', 'mentions', 'uses', 'last_used')
+
+# Orders of idea_top_retriever, each backed by an index of the idea table
+IDEA_ORDERS = {
+    'recent': "last_seen DESC, uses ASC, id ASC",
+    'usage': "uses DESC, last_used DESC",
+    'last_used': "last_used DESC",
+}
+
+
+def synchronized(method):
+    """Serialize the calls sharing the sqlite connection across threads"""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        session = activeProfile()
+        if session is None:
+            with self.lock:
+                return method(self, *args, **kwargs)
+
+        # In a profiled request, account the time waiting for the lock and running the call
+        start = time.perf_counter()
+        with self.lock:
+            acquired = time.perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                session.recordDatabaseCall(method.__name__, acquired - start, time.perf_counter() - acquired)
+    return wrapper
+
+
 class DatabaseCore:
     def __init__(self, verbose: bool, 
                        database_type: str, 
@@ -18,11 +61,26 @@ class DatabaseCore:
         self.database_type = database_type
         self.database_path = database_path
 
+        # Agents and workers may run in several threads sharing this connection
+        self.lock = threading.RLock()
+        self._migrated_tables = set()
+
+        # Turns are per thread: each request buffers its own records
+        self._local = threading.local()
+
         self.db = self.connect()
         if self.db is None:
             logger.error("Error connecting to the database")
             raise Exception("Error connecting to the database")
 
+        # Ideas saved before they were stored one per row are migrated now rather than by the first read
+        try:
+            tables = {row[0] for row in self.db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            if tables & {"ideas", "ideas_legacy"}:
+                self._create_idea_tables(self.db.cursor(), "ideas")
+        except sqlite3.Error as e:
+            logger.error(f"Error migrating the ideas table: {e}")
+
 
     def connect(self):
         """Connect to the database
@@ -32,7 +90,7 @@ class DatabaseCore:
         """
         try:
             if self.database_type == "sqlite":
-                db = sqlite3.connect(self.database_path)
+                db = sqlite3.connect(self.database_path, check_same_thread=False)
             logger.info(f"Connected to {self.database_type} database")
         except sqlite3.Error as e:
             logger.error(f"Error connecting to database: {e}")
@@ -40,6 +98,7 @@ class DatabaseCore:
         return db
 
 
+    @synchronized
     def conversation_retriever(self, basedOnDate: bool=False, top_k: int=20, data_table: str="conversations", date: str=None, exclude_image: bool=False, exclude_text: bool=False, role: str=None):
         """Return the data from the database in chronological order (oldest to newest)
 
@@ -157,103 +216,549 @@ class DatabaseCore:
             return False
 
 
+    @synchronized
     def conversation_saver(self, data: dict, data_table: str="conversations"):
         """Save the data to the database
 
+        Inside a turn, the data is buffered and written with the rest of the turn when it ends.
+
         Args:
-            data (dict): The data to save, which can contain text, base64 encoded image, or both
+            data (dict): The data to save, which can contain text, base64 encoded image (or data URL), or both, and the session_id of the turn
             data_table (str): The table of the data to save
+
+        Returns:
+            int: The id of the saved row, None if buffered in a turn, False if nothing was saved
         """
         # Get the current date
         date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
+        # Extract data from the dictionary
+        record = {
+            'date': date,
+            'role': data.get('role', 'user'),  # Default to 'user' if not specified
+            'text': str(data['text']) if data.get('text') is not None else None,
+            'image': data.get('image', None),
+            'session_id': data.get('session_id', None),
+            'parent_id': None
+        }
+
+        # Validate role
+        if record['role'] not in ['user', 'system', 'agent']:
+            logger.error(f"Invalid role: {record['role']}. Must be 'user', 'system', or 'agent'")
+            return False
+
+        if record['text'] is None and record['image'] is None:
+            logger.error("No data provided to save")
+            return False
+
+        current = getattr(self._local, "turn", None)
+        if current is not None:
+            self._buffer_record(current, record, data_table)
+            return None
+
         try:
             cursor = self.db.cursor()
             
             # Create table if it doesn't exist with our columns
+            self._create_conversation_table(cursor, data_table)
+            row_id = self._insert_conversation(cursor, record, data_table)
+                
+            self.db.commit()
+            logger.info(f"Data saved to {data_table} table")
+            return row_id
+        except sqlite3.Error as e:
+            logger.error(f"Error saving data: {e}")
+            raise e
+
+
+    def _insert_conversation(self, cursor: sqlite3.Cursor, record: dict, data_table: str) -> int:
+        """Insert one conversation record and return its id"""
+        # A data URL image is stored as its base64 payload, cut by SQLite so no copy is made in Python
+        image = record['image']
+        image_start = image.index(",") + 2 if isinstance(image, str) and image.startswith("data:") else 1
+        cursor.execute(
+            f"INSERT INTO {data_table} (date, role, text, image, session_id, parent_id) VALUES (?, ?, ?, substr(?, ?), ?, ?)",
+            (record['date'], record['role'], record['text'], image, image_start, record['session_id'], record['parent_id'])
+        )
+        return cursor.lastrowid
+
+
+    @synchronized
+    def conversation_bulk_saver(self, records: list[dict], id_map: dict=None, data_table: str="conversations"):
+        """Save a batch of conversation records in one transaction, e.g. when importing history
+
+        Records keep their date and session_id. Their parent_id refers to the id they had when
+        exported, and is translated through id_map, which is filled with the new id of every record
+        so batches of the same import can refer to each other.
+
+        Args:
+            records (list[dict]): The records, with date, role, text, image, session_id, and optionally id and parent_id
+            id_map (dict): The new id of each exported id, shared by the batches of an import
+            data_table (str): The table of the data to save
+
+        Returns:
+            int: The number of saved records
+        """
+        id_map = {} if id_map is None else id_map
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+        try:
+            cursor = self.db.cursor()
+            self._create_conversation_table(cursor, data_table)
+
+            # Ids are assigned here rather than by SQLite, so parents can be mapped without reading them back
+            next_id = cursor.execute(f"SELECT COALESCE(MAX(id), 0) FROM {data_table}").fetchone()[0]
+            sequence = cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (data_table,)).fetchone()
+            next_id = max(next_id, sequence[0] if sequence else 0) + 1
+
+            rows = []
+            for record in records:
+                if record.get('role') not in ['user', 'system', 'agent'] or (record.get('text') is None and record.get('image') is None):
+                    continue
+                parent_id = record.get('parent_id')
+                if record.get('id') is not None:
+                    id_map[record['id']] = next_id
+                rows.append((
+                    next_id, record.get('date') or now, record['role'], record.get('text'), record.get('image'),
+                    record.get('session_id'), id_map.get(parent_id) if parent_id is not None else None
+                ))
+                next_id += 1
+
+            cursor.executemany(
+                f"INSERT INTO {data_table} (id, date, role, text, image, session_id, parent_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            self.db.commit()
+            logger.info(f"{len(rows)} records saved to {data_table} table in one transaction")
+            return len(rows)
+        except sqlite3.Error as e:
+            self.db.rollback()
+            logger.error(f"Error saving records: {e}")
+            raise e
+
+
+    def conversation_streamer(self, batch_size: int=10000, data_table: str="conversations"):
+        """Stream every conversation row, e.g. when exporting history
+
+        Rows are read through a cursor of a dedicated read-only connection, fetched batch_size at a
+        time, so the export neither loads the table in memory nor holds the connection lock.
+
+        Args:
+            batch_size (int): The number of rows fetched at once
+            data_table (str): The table of the data to stream
+
+        Yields:
+            dict: The id, date, role, text, image, session_id and parent_id of each row, ordered by id
+        """
+        yield from self._stream(
+            f"SELECT id, date, role, text, image, session_id, parent_id FROM {data_table} ORDER BY id ASC",
+            ('id', 'date', 'role', 'text', 'image', 'session_id', 'parent_id'),
+            batch_size
+        )
+
+
+    def _stream(self, query: str, columns: tuple, batch_size: int):
+        """Run a query on a read-only connection and yield its rows as dictionaries"""
+        try:
+            connection = sqlite3.connect(f"file:{self.database_path}?mode=ro", uri=True)
+        except sqlite3.Error as e:
+            logger.error(f"Error opening read connection: {e}")
+            return
+
+        try:
+            cursor = connection.execute(query)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield dict(zip(columns, row))
+        except sqlite3.Error as e:
+            # The table only exists once a first record was saved
+            logger.debug(f"Nothing to stream: {e}")
+        finally:
+            connection.close()
+
+
+    @contextmanager
+    def turn(self, session_id: str=None):
+        """Group every record of one request into a single transaction
+
+        Records saved inside the block are buffered and committed at once when it exits. A turn
+        opened inside another one (e.g. a model call made by an agent tool) joins the enclosing
+        turn, and its records are saved as children of the turn's first record instead of as
+        new top-level rows.
+
+        Args:
+            session_id (str): The session of the turn
+
+        Yields:
+            dict: The turn, holding its buffered records and spans
+        """
+        current = getattr(self._local, "turn", None)
+        if current is not None:
+            current['depth'] += 1
+            try:
+                yield current
+            finally:
+                current['depth'] -= 1
+            return
+
+        current = {'session_id': session_id, 'records': [], 'spans': [], 'depth': 0}
+        self._local.turn = current
+        try:
+            yield current
+        finally:
+            # Whatever was buffered is kept even if the request failed, like with direct saves
+            self._local.turn = None
+            self._commit_turn(current)
+
+
+    def _buffer_record(self, current: dict, record: dict, data_table: str):
+        """Buffer a record in the active turn, folding nested duplicates of the root prompt into it"""
+        record['child'] = current['depth'] > 0
+        record['table'] = data_table
+        if record['session_id'] is None:
+            record['session_id'] = current['session_id']
+
+        if record['child'] and record['role'] == 'user' and current['records']:
+            root = current['records'][0]
+            if root['role'] == 'user' and root['text'] == record['text']:
+                # Same prompt forwarded to a tool: only keep what it adds (e.g. the image)
+                if root['image'] is None:
+                    root['image'] = record['image']
+                logger.info("Nested prompt merged into the turn's prompt")
+                return
+
+        current['records'].append(record)
+
+
+    @synchronized
+    def _commit_turn(self, current: dict):
+        """Write the records and spans of a turn in one transaction"""
+        if not current['records'] and not current['spans']:
+            return
+
+        try:
+            cursor = self.db.cursor()
+            root_id = None
+            for record in current['records']:
+                self._create_conversation_table(cursor, record['table'])
+                if record['child'] or (root_id is not None and record['role'] == 'agent'):
+                    record['parent_id'] = root_id
+                row_id = self._insert_conversation(cursor, record, record['table'])
+                if root_id is None:
+                    root_id = row_id
+
+            if current['spans']:
+                for span in current['spans']:
+                    if span['conversation_id'] is None:
+                        span['conversation_id'] = root_id
+                self._insert_spans(cursor, current['spans'], "spans")
+
+            self.db.commit()
+            logger.info(f"Turn saved: {len(current['records'])} records, {len(current['spans'])} spans in one transaction")
+        except sqlite3.Error as e:
+            self.db.rollback()
+            logger.error(f"Error saving turn: {e}")
+            raise e
+
+
+    def _create_conversation_table(self, cursor: sqlite3.Cursor, data_table: str):
+        """Create a conversation table if it doesn't exist"""
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {data_table} (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                date TEXT NOT NULL,
+                role TEXT NOT NULL,
+                text TEXT,
+                image TEXT,
+                session_id TEXT,
+                parent_id INTEGER
+            )
+        """)
+        self._migrate_conversation_table(cursor, data_table)
+
+
+    def _migrate_conversation_table(self, cursor: sqlite3.Cursor, data_table: str):
+        """Add the session_id and parent_id columns to conversation tables created before they existed"""
+        if data_table in self._migrated_tables:
+            return
+
+        columns = [row[1] for row in cursor.execute(f"PRAGMA table_info({data_table})").fetchall()]
+        if "session_id" not in columns:
+            cursor.execute(f"ALTER TABLE {data_table} ADD COLUMN session_id TEXT")
+            logger.info(f"Added session_id column to {data_table} table")
+        if "parent_id" not in columns:
+            cursor.execute(f"ALTER TABLE {data_table} ADD COLUMN parent_id INTEGER")
+            logger.info(f"Added parent_id column to {data_table} table")
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{data_table}_session ON {data_table} (session_id, id)")
+        self._migrated_tables.add(data_table)
+
+
+    @synchronized
+    def session_retriever(self, session_id: str, after_id: int=0, data_table: str="conversations"):
+        """Retrieve the text turns of a session in chronological order
+
+        Args:
+            session_id (str): The session to retrieve
+            after_id (int): Only retrieve turns saved after this row id
+            data_table (str): The table of the data to retrieve
+
+        Returns:
+            list: List of [id, role, text] for each top-level text turn, ordered from oldest to newest
+        """
+        try:
+            cursor = self.db.cursor()
+            cursor.execute(
+                f"""
+                    SELECT id, role, text
+                    FROM {data_table}
+                    WHERE session_id = ? AND id > ? AND text IS NOT NULL AND parent_id IS NULL
+                    ORDER BY id ASC
+                """,
+                (session_id, after_id)
+            )
+            return [list(row) for row in cursor.fetchall()]
+        except sqlite3.Error as e:
+            logger.error(f"Error retrieving session: {e}")
+            return []
+
+
+    @synchronized
+    def session_summary_retriever(self, session_id: str, data_table: str="session_summaries"):
+        """Retrieve the rolling summary of a session
+
+        Args:
+            session_id (str): The session of the summary
+            data_table (str): The table of the data to retrieve
+
+        Returns:
+            dict: The summary and the id of the last conversation row it covers, None if the session has no summary
+        """
+        try:
+            cursor = self.db.cursor()
+            cursor.execute(f"SELECT summary, last_conversation_id FROM {data_table} WHERE session_id = ?", (session_id,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            return {'summary': row[0], 'last_conversation_id': row[1]}
+        except sqlite3.Error as e:
+            # The table only exists once a first summary was saved
+            logger.debug(f"No session summary available: {e}")
+            return None
+
+
+    @synchronized
+    def session_summary_saver(self, session_id: str, summary: str, last_conversation_id: int, data_table: str="session_summaries"):
+        """Save the rolling summary of a session, replacing the previous one
+
+        Args:
+            session_id (str): The session of the summary
+            summary (str): The summary of every turn up to last_conversation_id
+            last_conversation_id (int): The id of the last conversation row covered by the summary
+            data_table (str): The table of the data to save
+
+        Returns:
+            bool: True if successful, False otherwise
+        """
+        date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+        try:
+            cursor = self.db.cursor()
             cursor.execute(f"""
                 CREATE TABLE IF NOT EXISTS {data_table} (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    session_id TEXT PRIMARY KEY,
                     date TEXT NOT NULL,
-                    role TEXT NOT NULL,
-                    text TEXT,
-                    image TEXT
+                    summary TEXT NOT NULL,
+                    last_conversation_id INTEGER NOT NULL
                 )
             """)
-            
-            # Extract data from the dictionary
-            text_data = data.get('text', None)
-            image_data = data.get('image', None)
-            role = data.get('role', 'user')  # Default to 'user' if not specified
-            
-            # Validate role
-            if role not in ['user', 'system', 'agent']:
-                logger.error(f"Invalid role: {role}. Must be 'user', 'system', or 'agent'")
-                return False
-            
-            # Build the query based on available data
-            if text_data is not None and image_data is not None:
-                cursor.execute(
-                    f"INSERT INTO {data_table} (date, role, text, image) VALUES (?, ?, ?, ?)",
-                    (date, role, str(text_data), image_data)
-                )
-            elif text_data is not None:
-                cursor.execute(
-                    f"INSERT INTO {data_table} (date, role, text) VALUES (?, ?, ?)",
-                    (date, role, str(text_data))
-                )
-            elif image_data is not None:
-                cursor.execute(
-                    f"INSERT INTO {data_table} (date, role, image) VALUES (?, ?, ?)",
-                    (date, role, image_data)
-                )
-            else:
-                logger.error("No data provided to save")
-                return False
-                
+            cursor.execute(
+                f"INSERT OR REPLACE INTO {data_table} (session_id, date, summary, last_conversation_id) VALUES (?, ?, ?, ?)",
+                (session_id, date, summary, last_conversation_id)
+            )
             self.db.commit()
-            logger.info(f"Data saved to {data_table} table")
+            logger.info(f"Summary of session {session_id} saved to {data_table} table")
             return True
         except sqlite3.Error as e:
-            logger.error(f"Error saving data: {e}")
-            raise e
+            logger.error(f"Error saving session summary: {e}")
+            return False
+
+
+    def _create_idea_tables(self, cursor: sqlite3.Cursor, data_table: str):
+        """Create the idea tables and their indexes, migrating newline-joined idea rows created before them
+
+        Ideas are stored one per row in data_table, deduplicated by the hash of their normalized
+        text. Each save is a summary in {data_table}_summaries, and {data_table}_mentions links a
+        summary to its ideas in their original order.
+        """
+        if data_table in self._migrated_tables:
+            return
+
+        # One transaction, so an interrupted migration leaves the legacy rows where they were
+        cursor.execute("SAVEPOINT create_idea_tables")
+        try:
+            columns = [row[1] for row in cursor.execute(f"PRAGMA table_info({data_table})").fetchall()]
+            legacy = bool(columns) and "hash" not in columns
+            # A legacy table left by a migration that didn't complete still has to be copied
+            leftover = not legacy and cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (f"{data_table}_legacy",)
+            ).fetchone() is not None
+            if legacy:
+                cursor.execute(f"ALTER TABLE {data_table} RENAME TO {data_table}_legacy")
+
+            cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS {data_table}_summaries (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    date TEXT NOT NULL,
+                    summary TEXT NOT NULL
+                )
+            """)
+            cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS {data_table} (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    hash TEXT NOT NULL UNIQUE,
+                    idea TEXT NOT NULL,
+                    date TEXT NOT NULL,
+                    last_seen TEXT NOT NULL,
+                    mentions INTEGER NOT NULL DEFAULT 1,
+                    uses INTEGER NOT NULL DEFAULT 0,
+                    last_used TEXT
+                )
+            """)
+            cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS {data_table}_mentions (
+                    summary_id INTEGER NOT NULL,
+                    position INTEGER NOT NULL,
+                    idea_id INTEGER NOT NULL,
+                    PRIMARY KEY (summary_id, position)
+                ) WITHOUT ROWID
+            """)
+            # One index per order of idea_top_retriever, so top N reads stop after N rows
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{data_table}_recent ON {data_table} (last_seen DESC, uses, id)")
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{data_table}_usage ON {data_table} (uses, last_used)")
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{data_table}_last_used ON {data_table} (last_used)")
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{data_table}_summaries_date ON {data_table}_summaries (date, id)")
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{data_table}_mentions_idea ON {data_table}_mentions (idea_id)")
+
+            if legacy or leftover:
+                rows = cursor.execute(f"SELECT date, idea FROM {data_table}_legacy ORDER BY id ASC").fetchall()
+                summaries = []
+                for date, idea_text in rows:
+                    # Summaries used to be saved as the repr of their record
+                    if idea_text.startswith("{'"):
+                        try:
+                            idea_text = str(ast.literal_eval(idea_text).get('idea', idea_text))
+                        except (ValueError, SyntaxError, AttributeError):
+                            pass
+                    summaries.append({'date': date, 'idea': idea_text})
+                self._insert_ideas(cursor, summaries, data_table)
+                cursor.execute(f"DROP TABLE {data_table}_legacy")
+                logger.info(f"Migrated {len(rows)} rows of {data_table} table to one idea per row")
+            cursor.execute("RELEASE create_idea_tables")
+        except sqlite3.Error:
+            cursor.execute("ROLLBACK TO create_idea_tables")
+            cursor.execute("RELEASE create_idea_tables")
+            raise
+        self._migrated_tables.add(data_table)
+
+
+    @staticmethod
+    def _split_ideas(data) -> list[str]:
+        """Split a summary, or a list of ideas, into its ideas without bullets or numbering"""
+        lines = data if isinstance(data, list) else str(data).split("\n")
+        ideas = (IDEA_BULLET.sub("", str(line)).strip() for line in lines)
+        return [idea for idea in ideas if idea]
+
+
+    @staticmethod
+    def _idea_hash(idea: str) -> str:
+        """The hash of an idea, equal for ideas differing only in case, spacing or final punctuation"""
+        normalized = " ".join(idea.casefold().split()).rstrip(".;:!")
+        return hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+
 
+    def _insert_ideas(self, cursor: sqlite3.Cursor, records: list[dict], data_table: str) -> int:
+        """Insert summaries and their ideas, counting a mention of every idea already saved
 
+        Args:
+            cursor (sqlite3.Cursor): The cursor of the transaction
+            records (list[dict]): The summaries, with their date, idea (text or list of ideas), and optionally uses and last_used
+            data_table (str): The table of the ideas
+
+        Returns:
+            int: The number of saved summaries
+        """
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+        # Ids are assigned here rather than by SQLite, so mentions can be written without reading them back
+        next_id = cursor.execute(f"SELECT COALESCE(MAX(id), 0) FROM {data_table}_summaries").fetchone()[0]
+        sequence = cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (f"{data_table}_summaries",)).fetchone()
+        next_id = max(next_id, sequence[0] if sequence else 0) + 1
+
+        summaries, ideas, mentions = [], [], []
+        for record in records:
+            split = self._split_ideas(record.get('idea') or "")
+            if not split:
+                continue
+            date = record.get('date') or now
+            summaries.append((next_id, date, "\n".join(split)))
+            hashes = {}
+            for idea in split:
+                hashes.setdefault(self._idea_hash(idea), idea)
+            for position, (idea_hash, idea) in enumerate(hashes.items()):
+                ideas.append((idea_hash, idea, date, date, record.get('uses') or 0, record.get('last_used')))
+                mentions.append((next_id, position, idea_hash))
+            next_id += 1
+
+        cursor.executemany(f"INSERT INTO {data_table}_summaries (id, date, summary) VALUES (?, ?, ?)", summaries)
+        cursor.executemany(f"""
+            INSERT INTO {data_table} (hash, idea, date, last_seen, uses, last_used) VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (hash) DO UPDATE SET
+                mentions = mentions + 1,
+                date = MIN(date, excluded.date),
+                last_seen = MAX(last_seen, excluded.last_seen),
+                uses = uses + excluded.uses,
+                last_used = CASE WHEN excluded.last_used > COALESCE(last_used, '') THEN excluded.last_used ELSE last_used END
+        """, ideas)
+        cursor.executemany(
+            f"INSERT INTO {data_table}_mentions (summary_id, position, idea_id) SELECT ?, ?, id FROM {data_table} WHERE hash = ?",
+            mentions
+        )
+        return len(summaries)
+
+
+    @synchronized
     def idea_retriever(self, num_rows: int=4, data_table: str="ideas"):
-        """Retrieve the most recent ideas from the database
+        """Retrieve the most recent ideas from the database, grouped by the summary they were saved in
 
         Args:
-            num_rows (int): Number of most recent rows to retrieve (default: 4)
+            num_rows (int): Number of most recent summaries to retrieve (default: 4)
             data_table (str): The table of the data to retrieve
 
         Returns:
-            list: List of dictionaries containing id, date, and ideas for each entry
+            list: List of dictionaries containing id, date, and ideas for each summary
         """
         try:
             cursor = self.db.cursor()
-            
-            # Build the query to get the most recent rows
-            query = f"SELECT id, date, idea FROM {data_table} ORDER BY date DESC LIMIT ?"
-            
-            cursor.execute(query, (num_rows,))
-            results = cursor.fetchall()
-            
-            # Convert results to list of dictionaries
+            self._create_idea_tables(cursor, data_table)
+
+            cursor.execute(f"""
+                SELECT summary.id, summary.date, idea.idea
+                FROM (SELECT id, date FROM {data_table}_summaries ORDER BY date DESC, id DESC LIMIT ?) AS summary
+                JOIN {data_table}_mentions AS mention ON mention.summary_id = summary.id
+                JOIN {data_table} AS idea ON idea.id = mention.idea_id
+                ORDER BY summary.date DESC, summary.id DESC, mention.position ASC
+            """, (num_rows,))
+
             ideas = []
-            for row in results:
-                # Split the idea text back into a list if it contains newlines
-                idea_text = row[2]
-                if "\n" in idea_text:
-                    ideas_list = idea_text.split("\n")
-                else:
-                    ideas_list = [idea_text]
-                
+            for (summary_id, date), rows in groupby(cursor.fetchall(), key=lambda row: row[:2]):
                 ideas.append({
-                    'id': row[0],
-                    'date': row[1],
-                    'ideas': ideas_list
+                    'id': summary_id,
+                    'date': date,
+                    'ideas': [row[2] for row in rows]
                 })
-            
             return ideas
 
         except sqlite3.Error as e:
@@ -261,50 +766,760 @@ class DatabaseCore:
             return []
 
 
-    def idea_saver(self, data: list, data_table: str="ideas"):
-        """Save an idea to the database
+    @synchronized
+    def idea_top_retriever(self, limit: int=10, order_by: str="recent", data_table: str="ideas"):
+        """Retrieve the top ideas, each idea once however many summaries mention it
+
+        Args:
+            limit (int): The number of ideas to retrieve
+            order_by (str): "recent" for the most recently mentioned first, least used first among
+                them, "usage" for the most used first, or "last_used" for the most recently used first
+            data_table (str): The table of the data to retrieve
+
+        Returns:
+            list: List of dictionaries containing id, idea, date, last_seen, mentions, uses and last_used for each idea
+        """
+        if order_by not in IDEA_ORDERS:
+            logger.error(f"Invalid idea order: {order_by}. Must be one of {list(IDEA_ORDERS)}")
+            return []
+
+        try:
+            cursor = self.db.cursor()
+            self._create_idea_tables(cursor, data_table)
+            cursor.execute(f"""
+                SELECT id, idea, date, last_seen, mentions, uses, last_used FROM {data_table}
+                {"WHERE last_used IS NOT NULL" if order_by == "last_used" else ""}
+                ORDER BY {IDEA_ORDERS[order_by]} LIMIT ?
+            """, (limit,))
+            return [dict(zip(IDEA_COLUMNS, row)) for row in cursor.fetchall()]
+        except sqlite3.Error as e:
+            logger.error(f"Error retrieving top ideas: {e}")
+            return []
+
+
+    @synchronized
+    def idea_summary_retriever(self, summary_id: int, data_table: str="ideas"):
+        """Retrieve the ideas of one summary, in their original order
+
+        Args:
+            summary_id (int): The id of the summary, as returned by idea_retriever
+            data_table (str): The table of the data to retrieve
+
+        Returns:
+            list: List of dictionaries containing id, idea, date, last_seen, mentions, uses and last_used for each idea
+        """
+        try:
+            cursor = self.db.cursor()
+            self._create_idea_tables(cursor, data_table)
+            cursor.execute(f"""
+                SELECT {", ".join(f"idea.{column}" for column in IDEA_COLUMNS)}
+                FROM {data_table}_mentions AS mention
+                JOIN {data_table} AS idea ON idea.id = mention.idea_id
+                WHERE mention.summary_id = ?
+                ORDER BY mention.position ASC
+            """, (summary_id,))
+            return [dict(zip(IDEA_COLUMNS, row)) for row in cursor.fetchall()]
+        except sqlite3.Error as e:
+            logger.error(f"Error retrieving ideas of summary {summary_id}: {e}")
+            return []
+
+
+    @synchronized
+    def idea_use_saver(self, idea_ids: list[int], data_table: str="ideas"):
+        """Count a use of ideas, e.g. when an image is generated from them
 
         Args:
-            data (list): List of prompts or texts that are ideas
+            idea_ids (list[int]): The ids of the used ideas
             data_table (str): The table of the data to save
 
         Returns:
             bool: True if successful, False otherwise
         """
-        # Get the current date
         date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
         try:
             cursor = self.db.cursor()
-            
-            # Create table if it doesn't exist
-            cursor.execute(f"""
-                CREATE TABLE IF NOT EXISTS {data_table} (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    date TEXT NOT NULL,
-                    idea TEXT NOT NULL
-                )
-            """)
-            
-            # Convert list of ideas to a single string if needed
-            if isinstance(data, list):
-                idea_text = "\n".join(str(item) for item in data)
-            else:
-                idea_text = str(data)
-            
-            # Save the idea to the database
-            cursor.execute(
-                f"INSERT INTO {data_table} (date, idea) VALUES (?, ?)",
-                (date, idea_text)
+            self._create_idea_tables(cursor, data_table)
+            cursor.executemany(
+                f"UPDATE {data_table} SET uses = uses + 1, last_used = ? WHERE id = ?",
+                [(date, idea_id) for idea_id in idea_ids]
             )
             self.db.commit()
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"Error saving idea use: {e}")
+            return False
+
+
+    @synchronized
+    def idea_saver(self, data: list, data_table: str="ideas"):
+        """Save a summary of ideas to the database, one row per new idea
+
+        Args:
+            data (list): List of prompts or texts that are ideas, or a summary with one idea per line
+            data_table (str): The table of the data to save
+
+        Returns:
+            bool: True if successful, False otherwise
+        """
+        try:
+            cursor = self.db.cursor()
+            self._create_idea_tables(cursor, data_table)
+            saved = self._insert_ideas(cursor, [{'idea': data}], data_table)
+            self.db.commit()
+            if not saved:
+                logger.warning("No idea to save")
+                return False
             logger.info(f"Idea saved to {data_table} table")
             return True
         except sqlite3.Error as e:
+            self.db.rollback()
             logger.error(f"Error saving idea: {e}")
             return False
 
 
+    @synchronized
+    def idea_bulk_saver(self, records: list[dict], data_table: str="ideas"):
+        """Save a batch of ideas in one transaction, e.g. when importing them
+
+        Args:
+            records (list[dict]): The summaries, each with its date and idea text (or list of ideas),
+                and optionally the uses and last_used of its ideas
+            data_table (str): The table of the data to save
+
+        Returns:
+            int: The number of saved summaries
+        """
+        try:
+            cursor = self.db.cursor()
+            self._create_idea_tables(cursor, data_table)
+            saved = self._insert_ideas(cursor, records, data_table)
+            self.db.commit()
+            logger.info(f"{saved} ideas saved to {data_table} table in one transaction")
+            return saved
+        except sqlite3.Error as e:
+            self.db.rollback()
+            logger.error(f"Error saving ideas: {e}")
+            return 0
+
+
+    def idea_streamer(self, batch_size: int=10000, data_table: str="ideas"):
+        """Stream every idea, see conversation_streamer
+
+        Yields:
+            dict: The id, date, idea, uses and last_used of each idea, ordered by id
+        """
+        with self.lock:
+            # Legacy tables are migrated before the read-only connection reads them
+            try:
+                self._create_idea_tables(self.db.cursor(), data_table)
+                self.db.commit()
+            except sqlite3.Error as e:
+                logger.error(f"Error preparing the {data_table} table: {e}")
+        columns = ('id', 'date', 'idea', 'uses', 'last_used')
+        yield from self._stream(f"SELECT {', '.join(columns)} FROM {data_table} ORDER BY id ASC", columns, batch_size)
+
+
+    @synchronized
+    def image_hash_retriever(self, data_table: str="image_hashes"):
+        """Retrieve every perceptual hash of analysed and generated images
+
+        Args:
+            data_table (str): The table of the data to retrieve
+
+        Returns:
+            list: List of dictionaries containing id, date, hash, image_path, prompt and analysis for each image
+        """
+        try:
+            cursor = self.db.cursor()
+            cursor.execute(f"SELECT id, date, hash, image_path, prompt, analysis FROM {data_table} ORDER BY id ASC")
+            return [
+                {'id': row[0], 'date': row[1], 'hash': row[2], 'image_path': row[3], 'prompt': row[4], 'analysis': row[5]}
+                for row in cursor.fetchall()
+            ]
+        except sqlite3.Error as e:
+            # The table only exists once a first hash was saved
+            logger.debug(f"No image hashes available: {e}")
+            return []
+
+
+    @synchronized
+    def image_hash_saver(self, image_hash: str, image_path: str, prompt: str=None, analysis: str=None, data_table: str="image_hashes"):
+        """Save the perceptual hash of an image, with the analysis made of it if any
+
+        Args:
+            image_hash (str): The hex perceptual hash of the image
+            image_path (str): The path of the image
+            prompt (str): The prompt the image was analysed with
+            analysis (str): The analysis of the image
+            data_table (str): The table of the data to save
+
+        Returns:
+            int: The id of the saved row, None if saving failed
+        """
+        date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+        try:
+            cursor = self.db.cursor()
+            cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS {data_table} (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    date TEXT NOT NULL,
+                    hash TEXT NOT NULL,
+                    image_path TEXT NOT NULL,
+                    prompt TEXT,
+                    analysis TEXT
+                )
+            """)
+            cursor.execute(
+                f"INSERT INTO {data_table} (date, hash, image_path, prompt, analysis) VALUES (?, ?, ?, ?, ?)",
+                (date, image_hash, image_path, prompt, analysis)
+            )
+            self.db.commit()
+            logger.info(f"Hash of {image_path} saved to {data_table} table")
+            return cursor.lastrowid
+        except sqlite3.Error as e:
+            logger.error(f"Error saving image hash: {e}")
+            return None
+
+
+    @synchronized
+    def usage_retriever(self, since: str, data_table: str="usage"):
+        """Retrieve the usage of every session since a date
+
+        Args:
+            since (str): The date from which usage is summed
+            data_table (str): The table of the data to retrieve
+
+        Returns:
+            dict: The tokens and images used by each session
+        """
+        try:
+            cursor = self.db.cursor()
+            cursor.execute(f"SELECT session_id, SUM(tokens), SUM(images) FROM {data_table} WHERE date >= ? GROUP BY session_id", (since,))
+            return {row[0]: {'tokens': row[1], 'images': row[2]} for row in cursor.fetchall()}
+        except sqlite3.Error as e:
+            # The table only exists once a first usage was saved
+            logger.debug(f"No usage available: {e}")
+            return {}
+
+
+    @synchronized
+    def usage_saver(self, session_id: str, tokens: int=0, images: int=0, data_table: str="usage"):
+        """Save the usage of one request
+
+        Args:
+            session_id (str): The session that made the request
+            tokens (int): The tokens used
+            images (int): The images generated
+            data_table (str): The table of the data to save
+
+        Returns:
+            bool: True if successful, False otherwise
+        """
+        date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+        try:
+            cursor = self.db.cursor()
+            cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS {data_table} (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    date TEXT NOT NULL,
+                    session_id TEXT NOT NULL,
+                    tokens INTEGER NOT NULL,
+                    images INTEGER NOT NULL
+                )
+            """)
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{data_table}_date ON {data_table} (date)")
+            cursor.execute(
+                f"INSERT INTO {data_table} (date, session_id, tokens, images) VALUES (?, ?, ?, ?)",
+                (date, session_id, tokens, images)
+            )
+            self.db.commit()
+            logger.debug(f"Usage of session {session_id} saved to {data_table} table")
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"Error saving usage: {e}")
+            return False
+
+
+    @synchronized
+    def route_latency_retriever(self, limit: int=200, data_table: str="routing"):
+        """Retrieve the most recent latencies of each mode and route
+
+        Args:
+            limit (int): The number of latencies retrieved per mode and route
+            data_table (str): The table of the data to retrieve
+
+        Returns:
+            dict: The latencies in seconds, oldest first, for each (mode, route) pair
+        """
+        try:
+            cursor = self.db.cursor()
+            cursor.execute(f"""
+                SELECT mode, route, latency FROM (
+                    SELECT mode, route, latency, id, ROW_NUMBER() OVER (PARTITION BY mode, route ORDER BY id DESC) AS position
+                    FROM {data_table}
+                ) WHERE position <= ? ORDER BY id ASC
+            """, (limit,))
+            latencies = {}
+            for mode, route, latency in cursor.fetchall():
+                latencies.setdefault((mode, route), []).append(latency)
+            return latencies
+        except sqlite3.Error as e:
+            # The table only exists once a first request was routed
+            logger.debug(f"No routing history available: {e}")
+            return {}
+
+
+    @synchronized
+    def route_saver(self, mode: str, route: str, latency: float, auto: bool=False, score: float=None, data_table: str="routing"):
+        """Save the route and latency of one request
+
+        Args:
+            mode (str): The mode of the request
+            route (str): 'model' or 'agent'
+            latency (float): The latency of the request in seconds
+            auto (bool): Whether the route was chosen by the router
+            score (float): The router's score of the prompt, if it chose the route
+            data_table (str): The table of the data to save
+
+        Returns:
+            bool: True if successful, False otherwise
+        """
+        date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+        try:
+            cursor = self.db.cursor()
+            cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS {data_table} (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    date TEXT NOT NULL,
+                    mode TEXT NOT NULL,
+                    route TEXT NOT NULL,
+                    latency REAL NOT NULL,
+                    auto INTEGER NOT NULL,
+                    score REAL
+                )
+            """)
+            cursor.execute(
+                f"INSERT INTO {data_table} (date, mode, route, latency, auto, score) VALUES (?, ?, ?, ?, ?, ?)",
+                (date, mode, route, latency, int(auto), score)
+            )
+            self.db.commit()
+            logger.debug(f"Route of a {mode} request saved to {data_table} table")
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"Error saving route: {e}")
+            return False
+
+
+    def _create_job_table(self, cursor: sqlite3.Cursor, data_table: str):
+        """Create the job table and its indexes if they don't exist"""
+        if data_table in self._migrated_tables:
+            return
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {data_table} (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                date TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                payload TEXT,
+                priority INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                dedup_key TEXT,
+                run_after REAL NOT NULL,
+                error TEXT,
+                updated TEXT,
+                result TEXT
+            )
+        """)
+        # Job tables created before results were stored
+        columns = [row[1] for row in cursor.execute(f"PRAGMA table_info({data_table})").fetchall()]
+        if "result" not in columns:
+            cursor.execute(f"ALTER TABLE {data_table} ADD COLUMN result TEXT")
+            logger.info(f"Added result column to {data_table} table")
+        # Workers pick the most urgent runnable job, oldest first
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{data_table}_queue ON {data_table} (status, priority, id)")
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{data_table}_dedup ON {data_table} (dedup_key, status)")
+        self._migrated_tables.add(data_table)
+
+
+    @synchronized
+    def job_saver(self, kind: str, payload: dict=None, priority: int=10, dedup_key: str=None, run_after: float=0, data_table: str="jobs"):
+        """Enqueue a job, unless a pending or running job has the same dedup_key
+
+        Args:
+            kind (str): The kind of the job, which selects its handler
+            payload (dict): The JSON serializable arguments of the job
+            priority (int): The priority of the job, lower runs first
+            dedup_key (str): Jobs sharing this key are only queued once at a time
+            run_after (float): The epoch time before which the job doesn't run
+            data_table (str): The table of the data to save
+
+        Returns:
+            int: The id of the queued job or of the existing duplicate, None if saving failed
+        """
+        date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+        try:
+            cursor = self.db.cursor()
+            self._create_job_table(cursor, data_table)
+
+            if dedup_key is not None:
+                cursor.execute(
+                    f"SELECT id FROM {data_table} WHERE dedup_key = ? AND status IN ('pending', 'running') LIMIT 1",
+                    (dedup_key,)
+                )
+                row = cursor.fetchone()
+                if row is not None:
+                    logger.debug(f"Job {kind} already queued as {row[0]}")
+                    return row[0]
+
+            cursor.execute(
+                f"INSERT INTO {data_table} (date, kind, payload, priority, status, dedup_key, run_after, updated) VALUES (?, ?, ?, ?, 'pending', ?, ?, ?)",
+                (date, kind, json.dumps(payload or {}), priority, dedup_key, run_after, date)
+            )
+            self.db.commit()
+            logger.info(f"Job {kind} queued in {data_table} table")
+            return cursor.lastrowid
+        except sqlite3.Error as e:
+            logger.error(f"Error saving job: {e}")
+            return None
+
+
+    @synchronized
+    def job_claimer(self, now: float, max_priority: int=None, kinds: tuple=None, data_table: str="jobs"):
+        """Atomically mark the most urgent runnable job as running and return it
+
+        Args:
+            now (float): The current epoch time, jobs with a later run_after are skipped
+            max_priority (int): Only claim jobs with a priority up to this value
+            kinds (tuple): Only claim jobs of these kinds, any kind if None
+            data_table (str): The table of the data to claim from
+
+        Returns:
+            dict: The id, kind, payload, priority and attempts of the job, None if no job is runnable
+        """
+        date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+        try:
+            cursor = self.db.cursor()
+            self._create_job_table(cursor, data_table)
+
+            query = f"SELECT id FROM {data_table} WHERE status = 'pending' AND run_after <= ?"
+            params = [now]
+            if max_priority is not None:
+                query += " AND priority <= ?"
+                params.append(max_priority)
+            if kinds is not None:
+                query += f" AND kind IN ({', '.join('?' * len(kinds))})"
+                params.extend(kinds)
+            query += " ORDER BY priority ASC, id ASC LIMIT 1"
+
+            cursor.execute(
+                f"UPDATE {data_table} SET status = 'running', attempts = attempts + 1, updated = ? WHERE id = ({query}) RETURNING id, kind, payload, priority, attempts",
+                (date, *params)
+            )
+            row = cursor.fetchone()
+            self.db.commit()
+            if row is None:
+                return None
+            return {'id': row[0], 'kind': row[1], 'payload': json.loads(row[2] or "{}"), 'priority': row[3], 'attempts': row[4]}
+        except sqlite3.Error as e:
+            logger.error(f"Error claiming job: {e}")
+            return None
+
+
+    @synchronized
+    def job_updater(self, job_id: int, status: str, error: str=None, run_after: float=None, result=None, data_table: str="jobs"):
+        """Update the status of a job
+
+        Args:
+            job_id (int): The job to update
+            status (str): The new status: 'pending' (to retry), 'running', 'done' or 'failed'
+            error (str): The error of the last attempt
+            run_after (float): The epoch time before which a retried job doesn't run
+            result: The JSON serializable result of a done job, values that aren't are saved as strings
+            data_table (str): The table of the data to update
+
+        Returns:
+            bool: True if successful, False otherwise
+        """
+        date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+        try:
+            cursor = self.db.cursor()
+            cursor.execute(
+                f"UPDATE {data_table} SET status = ?, error = ?, run_after = COALESCE(?, run_after), result = COALESCE(?, result), updated = ? WHERE id = ?",
+                (status, error, run_after, json.dumps(result, default=str) if result is not None else None, date, job_id)
+            )
+            self.db.commit()
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"Error updating job: {e}")
+            return False
+
+
+    @synchronized
+    def job_recoverer(self, kinds: tuple=None, data_table: str="jobs"):
+        """Put the jobs left running by a previous process back in the queue
+
+        Args:
+            kinds (tuple): Only recover jobs of these kinds, any kind if None
+            data_table (str): The table of the data to update
+
+        Returns:
+            int: The number of recovered jobs
+        """
+        try:
+            cursor = self.db.cursor()
+            self._create_job_table(cursor, data_table)
+            query = f"UPDATE {data_table} SET status = 'pending' WHERE status = 'running'"
+            if kinds is not None:
+                query += f" AND kind IN ({', '.join('?' * len(kinds))})"
+            cursor.execute(query, tuple(kinds or ()))
+            self.db.commit()
+            return cursor.rowcount
+        except sqlite3.Error as e:
+            logger.error(f"Error recovering jobs: {e}")
+            return 0
+
+
+    @synchronized
+    def job_retriever(self, job_id: int, data_table: str="jobs"):
+        """Retrieve a job
+
+        Returns:
+            dict: The job, with its result once done, None if it doesn't exist
+        """
+        try:
+            cursor = self.db.cursor()
+            self._create_job_table(cursor, data_table)
+            cursor.execute(f"SELECT id, date, kind, payload, priority, status, attempts, error, updated, result FROM {data_table} WHERE id = ?", (job_id,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            return {
+                'id': row[0], 'date': row[1], 'kind': row[2], 'payload': json.loads(row[3] or "{}"), 'priority': row[4],
+                'status': row[5], 'attempts': row[6], 'error': row[7], 'updated': row[8],
+                'result': json.loads(row[9]) if row[9] is not None else None
+            }
+        except sqlite3.Error as e:
+            logger.error(f"Error retrieving job: {e}")
+            return None
+
+
+    @synchronized
+    def job_depth_retriever(self, kinds: tuple=None, data_table: str="jobs"):
+        """Retrieve the number of jobs by status and priority
+
+        Args:
+            kinds (tuple): Only count jobs of these kinds, any kind if None
+            data_table (str): The table of the data to retrieve
+
+        Returns:
+            dict: For each status, the number of jobs of each priority
+        """
+        try:
+            cursor = self.db.cursor()
+            self._create_job_table(cursor, data_table)
+            where = f"WHERE kind IN ({', '.join('?' * len(kinds))})" if kinds is not None else ""
+            cursor.execute(f"SELECT status, priority, COUNT(*) FROM {data_table} {where} GROUP BY status, priority", tuple(kinds or ()))
+            depth = {}
+            for status, priority, count in cursor.fetchall():
+                depth.setdefault(status, {})[priority] = count
+            return depth
+        except sqlite3.Error as e:
+            logger.error(f"Error retrieving job depth: {e}")
+            return {}
+
+
+    @synchronized
+    def span_saver(self, spans: list[dict], data_table: str="spans"):
+        """Save the spans of an agent trace to the database
+
+        Inside a turn, the spans are buffered and linked to the turn's first record when it ends.
+
+        Args:
+            spans (list[dict]): The spans to save, as produced by the Tracer
+            data_table (str): The table of the data to save
+
+        Returns:
+            bool: True if successful, False otherwise
+        """
+        current = getattr(self._local, "turn", None)
+        if current is not None:
+            current['spans'].extend(spans)
+            return True
+
+        try:
+            cursor = self.db.cursor()
+            self._insert_spans(cursor, spans, data_table)
+            self.db.commit()
+            logger.info(f"{len(spans)} spans saved to {data_table} table")
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"Error saving spans: {e}")
+            return False
+
+
+    def _insert_spans(self, cursor: sqlite3.Cursor, spans: list[dict], data_table: str):
+        """Create the spans table if it doesn't exist and insert the spans"""
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {data_table} (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                trace_id TEXT NOT NULL,
+                conversation_id INTEGER,
+                agent TEXT,
+                name TEXT NOT NULL,
+                category TEXT NOT NULL,
+                start REAL NOT NULL,
+                duration REAL NOT NULL,
+                attributes TEXT
+            )
+        """)
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{data_table}_trace ON {data_table} (trace_id)")
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{data_table}_conversation ON {data_table} (conversation_id)")
+
+        cursor.executemany(
+            f"INSERT INTO {data_table} (trace_id, conversation_id, agent, name, category, start, duration, attributes) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (span['trace_id'], span['conversation_id'], span['agent'], span['name'], span['category'],
+                 span['start'], span['duration'], json.dumps(span['attributes']))
+                for span in spans
+            ]
+        )
+
+
+    @synchronized
+    def span_retriever(self, trace_id: str=None, conversation_id: int=None, data_table: str="spans"):
+        """Retrieve the spans of one trace or of all traces linked to a conversation row
+
+        Args:
+            trace_id (str): The trace to retrieve
+            conversation_id (int): The conversation row the traces are linked to
+            data_table (str): The table of the data to retrieve
+
+        Returns:
+            list: List of dictionaries describing each span, ordered by start time
+        """
+        try:
+            cursor = self.db.cursor()
+
+            where_clauses = []
+            params = []
+            if trace_id is not None:
+                where_clauses.append("trace_id = ?")
+                params.append(trace_id)
+            if conversation_id is not None:
+                where_clauses.append("conversation_id = ?")
+                params.append(conversation_id)
+
+            query = f"SELECT trace_id, conversation_id, agent, name, category, start, duration, attributes FROM {data_table}"
+            if where_clauses:
+                query += " WHERE " + " AND ".join(where_clauses)
+            query += " ORDER BY start ASC"
+            cursor.execute(query, tuple(params))
+
+            return [
+                {
+                    'trace_id': row[0],
+                    'conversation_id': row[1],
+                    'agent': row[2],
+                    'name': row[3],
+                    'category': row[4],
+                    'start': row[5],
+                    'duration': row[6],
+                    'attributes': json.loads(row[7]) if row[7] else {}
+                }
+                for row in cursor.fetchall()
+            ]
+        except sqlite3.Error as e:
+            logger.error(f"Error retrieving spans: {e}")
+            return []
+
+
+    @synchronized
+    def conversation_page_retriever(self, before_date: str, after_id: int=0, limit: int=1000, data_table: str="conversations"):
+        """Retrieve a page of conversation rows older than a date, walking the table by id
+
+        Args:
+            before_date (str): Only retrieve rows saved before this date
+            after_id (int): Only retrieve rows with a greater id, used to page through the table
+            limit (int): The maximum number of rows to retrieve
+            data_table (str): The table of the data to retrieve
+
+        Returns:
+            list: List of [id, date, role, text, image, session_id, parent_id] ordered by id
+        """
+        try:
+            cursor = self.db.cursor()
+            self._migrate_conversation_table(cursor, data_table)
+            cursor.execute(
+                f"SELECT id, date, role, text, image, session_id, parent_id FROM {data_table} WHERE id > ? AND date < ? ORDER BY id ASC LIMIT ?",
+                (after_id, before_date, limit)
+            )
+            return [list(row) for row in cursor.fetchall()]
+        except sqlite3.Error as e:
+            logger.error(f"Error retrieving conversations: {e}")
+            return []
+
+
+    @synchronized
+    def conversation_deleter(self, ids: list[int], data_table: str="conversations"):
+        """Delete conversation rows by id in one transaction
+
+        Args:
+            ids (list[int]): The ids of the rows to delete
+            data_table (str): The table of the data to delete
+
+        Returns:
+            int: The number of deleted rows
+        """
+        try:
+            cursor = self.db.cursor()
+            cursor.executemany(f"DELETE FROM {data_table} WHERE id = ?", [(row_id,) for row_id in ids])
+            self.db.commit()
+            logger.info(f"{cursor.rowcount} rows deleted from {data_table} table")
+            return cursor.rowcount
+        except sqlite3.Error as e:
+            self.db.rollback()
+            logger.error(f"Error deleting conversations: {e}")
+            raise e
+
+
+    @synchronized
+    def reclaim_space(self, full: bool=False):
+        """Give the pages freed by deleted rows back to the file system
+
+        Incremental vacuum is used when the database runs with auto_vacuum=INCREMENTAL. A full
+        VACUUM rewrites the file and switches it to incremental mode for the next runs.
+
+        Args:
+            full (bool): Force a full VACUUM
+
+        Returns:
+            bool: True if successful, False otherwise
+        """
+        try:
+            auto_vacuum = self.db.execute("PRAGMA auto_vacuum").fetchone()[0]
+            if full or auto_vacuum != 2:
+                self.db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                self.db.execute("VACUUM")
+                logger.info("Database vacuumed")
+            else:
+                # The pragma frees one page per step: execute() only steps it once, and fetching
+                # its (empty) result doesn't step it further, executescript runs it to the end
+                self.db.executescript("PRAGMA incremental_vacuum;")
+                logger.info("Database incrementally vacuumed")
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"Error reclaiming space: {e}")
+            return False
+
+
+    @synchronized
     def __len__(self):
         """Return the number of rows in the database
 
@@ -0,0 +1,163 @@
+from src.core.logging_config import setup_logging
+
+from concurrent.futures import ThreadPoolExecutor
+from openai import OpenAI
+from urllib.parse import urlsplit
+import importlib.util
+import threading
+import httpx
+import logging
+
+# Get logger for this module
+logger = logging.getLogger(__name__)
+
+OPENAI_BASE_URL = "https://api.openai.com/v1"
+
+
+class HttpTransport:
+    def __init__(self, verbose: bool,
+                       timeout: float = 60,
+                       connect_timeout: float = 5,
+                       max_connections: int = 20,
+                       max_keepalive_connections: int = 10,
+                       keepalive_expiry: float = 120,
+                       http2: bool = True,
+                       warm_urls: list[str] = None,
+                       warm_connections: int = 2,
+                       keep_warm_interval: float = 0):
+        """
+        Initialize the HttpTransport class.
+
+        One pooled httpx client shared by every outbound HTTP call: the OpenAI client of ModelCore,
+        the server model of the agents and the image downloads of Utils. Connections and TLS sessions
+        are kept alive and reused, over HTTP/2 when the h2 package is installed. The pool can be
+        pre-warmed at startup, and kept warm while idle, so first calls don't pay the handshakes.
+
+        Args:
+            verbose: Whether to enable verbose logging.
+            timeout: The seconds a request may take to read, write or wait for a pooled connection.
+            connect_timeout: The seconds a connection may take to open.
+            max_connections: The maximum number of open connections.
+            max_keepalive_connections: The maximum number of idle connections kept open.
+            keepalive_expiry: The seconds an idle connection is kept open.
+            http2: Whether to use HTTP/2 when the h2 package is installed.
+            warm_urls: The origins to open connections to at startup.
+            warm_connections: The number of connections opened to each origin when warming.
+            keep_warm_interval: The seconds between two re-warmings of the origins, so idle
+                connections are refreshed before the server closes them. 0 disables it.
+        """
+        self.warm_urls = warm_urls or []
+        self.warm_connections = warm_connections
+        self.keep_warm_interval = keep_warm_interval
+        self.verbose = verbose
+        setup_logging(verbose=verbose)
+
+        self.http2 = http2 and importlib.util.find_spec("h2") is not None
+        if http2 and not self.http2:
+            logger.info("h2 is not installed, using HTTP/1.1 with keep-alive")
+
+        self.client = httpx.Client(
+            http2=self.http2,
+            timeout=httpx.Timeout(timeout, connect=connect_timeout),
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+                keepalive_expiry=keepalive_expiry
+            ),
+            follow_redirects=True
+        )
+        self._stop = threading.Event()
+        self._keep_warm = None
+        logger.info(f"HTTP transport ready: {max_connections} connections, {'HTTP/2' if self.http2 else 'HTTP/1.1'}")
+
+
+    def openaiClient(self, api_key: str = None, base_url: str = None) -> OpenAI:
+        """
+        Create an OpenAI client sending its requests through the shared pool.
+
+        Args:
+            api_key: The API key, read from OPENAI_API_KEY if None.
+            base_url: The base URL of the API, the OpenAI API if None.
+        """
+        return OpenAI(api_key=api_key, base_url=base_url, http_client=self.client)
+
+
+    def clientKwargs(self) -> dict:
+        """The client_kwargs making a SmolAgents OpenAIServerModel use the shared pool."""
+        return {'http_client': self.client}
+
+
+    def download(self, url: str, path: str, chunk_size: int = 1024 * 1024):
+        """
+        Stream a URL to a file through the shared pool.
+
+        Args:
+            url: The URL to download.
+            path: The path of the file to write.
+            chunk_size: The bytes written at once.
+
+        Raises:
+            httpx.HTTPError: If the download fails.
+        """
+        with self.client.stream("GET", url) as response:
+            response.raise_for_status()
+            with open(path, "wb") as f:
+                for chunk in response.iter_bytes(chunk_size):
+                    f.write(chunk)
+
+
+    def warm(self, urls: list[str] = None) -> int:
+        """
+        Open connections to origins ahead of the first real requests. Each origin gets
+        warm_connections concurrent HEAD requests; their status doesn't matter, only the
+        connections and TLS sessions they leave in the pool.
+
+        Args:
+            urls: The origins to warm, warm_urls if None.
+
+        Returns:
+            int: The number of connections warmed.
+        """
+        origins = {f"{parts.scheme}://{parts.netloc}" for parts in map(urlsplit, urls or self.warm_urls) if parts.netloc}
+        if not origins:
+            return 0
+
+        def head(origin):
+            try:
+                self.client.head(origin)
+                return True
+            except httpx.HTTPError as e:
+                logger.debug(f"Warming {origin} failed: {str(e)}")
+                return False
+
+        targets = [origin for origin in origins for _ in range(self.warm_connections)]
+        with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+            warmed = sum(executor.map(head, targets))
+        logger.debug(f"{warmed} connections warmed to {', '.join(sorted(origins))}")
+        return warmed
+
+
+    def start(self):
+        """
+        Warm the pool in the background, so startup doesn't wait on the network, then keep it warm
+        every keep_warm_interval seconds if set.
+        """
+        if self._keep_warm is None and self.warm_urls:
+            self._stop.clear()
+            self._keep_warm = threading.Thread(target=self.keepWarm, name="http-keep-warm", daemon=True)
+            self._keep_warm.start()
+
+
+    def keepWarm(self):
+        logger.info(f"{self.warm()} connections warmed")
+        while self.keep_warm_interval > 0 and not self._stop.wait(self.keep_warm_interval):
+            self.warm()
+
+
+    def close(self):
+        """Stop keeping the pool warm and close its connections."""
+        self._stop.set()
+        if self._keep_warm is not None:
+            self._keep_warm.join()
+            self._keep_warm = None
+        self.client.close()
@@ -0,0 +1,167 @@
+from src.core.logging_config import setup_logging
+
+from PIL import Image, ImageOps, features
+import threading
+import hashlib
+import os
+import logging
+
+# Get logger for this module
+logger = logging.getLogger(__name__)
+
+class ImageCache:
+    # Longest side in pixels of each derivative variant
+    VARIANTS = {
+        'thumbnail': 256,
+        'web': 1024
+    }
+
+    def __init__(self, cache_path: str, verbose: bool, max_bytes: int = 512 * 1024 * 1024, quality: int = 80):
+        """
+        Initialize the ImageCache class.
+
+        Derivatives (thumbnails and web-optimized copies) of generated and uploaded images are stored
+        on disk, keyed by the content hash of the original and the variant size, and the least
+        recently used ones are evicted when the cache grows over max_bytes.
+
+        Args:
+            cache_path: The directory of the derivatives.
+            verbose: Whether to enable verbose logging.
+            max_bytes: The maximum size of the cache on disk.
+            quality: The encoder quality of the derivatives.
+        """
+        self.cache_path = cache_path
+        self.max_bytes = max_bytes
+        self.quality = quality
+        self.verbose = verbose
+        setup_logging(verbose=verbose)
+
+        # WebP is much smaller than JPEG for the same quality, fall back to JPEG if Pillow lacks it
+        self.format, self.extension = ("WEBP", "webp") if features.check("webp") else ("JPEG", "jpg")
+
+        os.makedirs(self.cache_path, exist_ok=True)
+        self._lock = threading.Lock()
+        self._size = sum(entry.stat().st_size for entry in os.scandir(self.cache_path) if entry.is_file())
+        logger.info(f"Image cache at {self.cache_path}: {self._size / 1e6:.1f} MB of {self.format} derivatives")
+
+
+    def contentHash(self, image_path: str) -> str:
+        """
+        Hash the content of an image, so re-saved copies of the same file share their derivatives.
+
+        Args:
+            image_path: The path to the image.
+
+        Returns:
+            str: The hex SHA-256 of the file.
+        """
+        with open(image_path, "rb") as f:
+            return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+    def getDerivative(self, image_path: str, variant: str = "thumbnail") -> str:
+        """
+        Return the path of a derivative of an image, generating it on first access.
+
+        Args:
+            image_path: The path to the original image.
+            variant: The derivative to return, one of VARIANTS.
+
+        Returns:
+            str: The path of the derivative.
+        """
+        size = self.VARIANTS[variant]
+        derivative_path = self.derivativePath(self.contentHash(image_path), size)
+
+        if os.path.exists(derivative_path):
+            # The modification time is the recency used by the LRU eviction
+            os.utime(derivative_path)
+            return derivative_path
+
+        return self.createDerivative(image_path, derivative_path, size)
+
+
+    def generateDerivatives(self, image_path: str) -> dict[str, str]:
+        """
+        Generate every derivative of an image, decoding the original only once.
+
+        Args:
+            image_path: The path to the original image.
+
+        Returns:
+            dict[str, str]: The path of each variant.
+        """
+        content_hash = self.contentHash(image_path)
+        paths = {}
+        with Image.open(image_path) as image:
+            # draft() lets the JPEG decoder downscale while decoding, much cheaper than a full decode
+            image.draft("RGB", (max(self.VARIANTS.values()),) * 2)
+            image = ImageOps.exif_transpose(image)
+            # Largest variant first, each smaller one is resized from the previous one
+            for variant, size in sorted(self.VARIANTS.items(), key=lambda item: -item[1]):
+                derivative_path = self.derivativePath(content_hash, size)
+                if not os.path.exists(derivative_path):
+                    image = self.writeDerivative(image, derivative_path, size)
+                paths[variant] = derivative_path
+
+        self.evict(keep=set(paths.values()))
+        return paths
+
+
+    def derivativePath(self, content_hash: str, size: int) -> str:
+        return os.path.join(self.cache_path, f"{content_hash[:32]}_{size}.{self.extension}")
+
+
+    def createDerivative(self, image_path: str, derivative_path: str, size: int) -> str:
+        with Image.open(image_path) as image:
+            image.draft("RGB", (size, size))
+            self.writeDerivative(ImageOps.exif_transpose(image), derivative_path, size)
+        self.evict(keep={derivative_path})
+        return derivative_path
+
+
+    def writeDerivative(self, image: Image.Image, derivative_path: str, size: int) -> Image.Image:
+        """
+        Resize an image to fit in size x size and write it. Returns the resized image.
+        """
+        resized = image.copy()
+        resized.thumbnail((size, size), Image.Resampling.LANCZOS)
+        if resized.mode not in ("RGB", "RGBA"):
+            resized = resized.convert("RGBA" if "A" in resized.getbands() else "RGB")
+        if self.format == "JPEG" and resized.mode == "RGBA":
+            resized = resized.convert("RGB")
+
+        # Write to a temporary file first so readers never see a partial derivative
+        temporary_path = f"{derivative_path}.tmp"
+        resized.save(temporary_path, format=self.format, quality=self.quality, optimize=True)
+        os.replace(temporary_path, derivative_path)
+
+        with self._lock:
+            self._size += os.path.getsize(derivative_path)
+        logger.info(f"Derivative {derivative_path} created")
+        return resized
+
+
+    def evict(self, keep: set[str] = frozenset()):
+        """
+        Remove the least recently used derivatives until the cache fits in max_bytes.
+
+        Args:
+            keep: Paths never evicted, the derivatives just handed to the caller.
+        """
+        with self._lock:
+            if self._size <= self.max_bytes:
+                return
+
+            entries = sorted(
+                (entry for entry in os.scandir(self.cache_path) if entry.is_file()),
+                key=lambda entry: entry.stat().st_mtime
+            )
+            for entry in entries:
+                if self._size <= self.max_bytes:
+                    break
+                if entry.path in keep:
+                    continue
+                self._size -= entry.stat().st_size
+                os.remove(entry.path)
+                logger.info(f"Evicted derivative {entry.path}")
@@ -0,0 +1,272 @@
+from src.core.database import DatabaseCore
+from src.core.logging_config import setup_logging
+
+from typing import Iterable
+from PIL import Image, ImageOps
+import numpy as np
+import threading
+import os
+import logging
+
+# Get logger for this module
+logger = logging.getLogger(__name__)
+
+HASH_SIZE = 8
+PHASH_SIZE = 32
+
+# Orthonormal DCT-II matrix, the 2D DCT of X is D @ X @ D.T
+_k = np.arange(PHASH_SIZE)
+_DCT = np.sqrt(2 / PHASH_SIZE) * np.cos(np.pi * (2 * _k[None, :] + 1) * _k[:, None] / (2 * PHASH_SIZE))
+_DCT[0] /= np.sqrt(2)
+
+
+def _grayscale(image_path: str, size: tuple[int, int]) -> np.ndarray:
+    """Decode an image to a small grayscale float array, letting the decoder downscale when it can."""
+    with Image.open(image_path) as image:
+        image.draft("L", (size[0] * 4, size[1] * 4))
+        image = ImageOps.exif_transpose(image).convert("L").resize(size, Image.Resampling.LANCZOS)
+        return np.asarray(image, dtype=np.float32)
+
+
+def _pack(bits: np.ndarray) -> list[int]:
+    """Pack rows of 64 booleans into 64-bit integers."""
+    return [int.from_bytes(row.tobytes(), "big") for row in np.packbits(bits.reshape(len(bits), -1), axis=1)]
+
+
+def dHashes(pixels: np.ndarray) -> list[int]:
+    """
+    Difference hashes of a batch of (N, 8, 9) grayscale images: one bit per horizontal gradient sign.
+    """
+    return _pack(pixels[:, :, 1:] > pixels[:, :, :-1])
+
+
+def pHashes(pixels: np.ndarray) -> list[int]:
+    """
+    Perceptual hashes of a batch of (N, 32, 32) grayscale images: one bit per low frequency DCT
+    coefficient above the median of the block, which survives resizing, re-encoding and small crops.
+    """
+    low = np.einsum("ij,njk,lk->nil", _DCT, pixels, _DCT)[:, :HASH_SIZE, :HASH_SIZE].reshape(len(pixels), -1)
+    # The DC coefficient only carries the mean brightness, keep it out of the median
+    median = np.median(low[:, 1:], axis=1, keepdims=True)
+    return _pack(low > median)
+
+
+# Decoded size and batch hash function of each method. pHash is more robust, dHash is cheaper
+METHODS = {
+    'phash': ((PHASH_SIZE, PHASH_SIZE), pHashes),
+    'dhash': ((HASH_SIZE + 1, HASH_SIZE), dHashes)
+}
+
+
+def hammingDistance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class MultiIndexHash:
+    def __init__(self, chunks: int = 4):
+        """
+        Multi-index hashing over 64-bit hashes. Each hash is split into `chunks` substrings, each
+        indexed in its own table. Two hashes within distance r differ by at most r // chunks bits on
+        at least one substring (pigeonhole), so a radius search only probes the substrings within
+        that small distance and checks the few hashes found there, instead of scanning every hash.
+        (A BK-tree prunes badly on 64-bit perceptual hashes, whose distances cluster around 32.)
+
+        Args:
+            chunks: The number of substrings, 64 must be divisible by it.
+        """
+        self.chunks = chunks
+        self.bits = 64 // chunks
+        self.mask = (1 << self.bits) - 1
+        self.tables = [{} for _ in range(chunks)]
+        self.items = {}
+
+
+    @property
+    def size(self) -> int:
+        return len(self.items)
+
+
+    def substrings(self, value: int) -> list[int]:
+        return [(value >> (index * self.bits)) & self.mask for index in range(self.chunks)]
+
+
+    def add(self, value: int, item):
+        if value not in self.items:
+            self.items[value] = []
+            for table, substring in zip(self.tables, self.substrings(value)):
+                table.setdefault(substring, []).append(value)
+        self.items[value].append(item)
+
+
+    def neighbours(self, substring: int, radius: int) -> list[int]:
+        """Every substring within radius bits of substring."""
+        found = [substring]
+        for _ in range(radius):
+            found = {neighbour ^ (1 << bit) for neighbour in found for bit in range(self.bits)} | set(found)
+        return list(found)
+
+
+    def search(self, value: int, radius: int) -> list[tuple[int, object]]:
+        """
+        Return every item whose hash is within radius of value.
+
+        Returns:
+            list[tuple[int, object]]: The (distance, item) pairs, closest first.
+        """
+        candidates = set()
+        for table, substring in zip(self.tables, self.substrings(value)):
+            for neighbour in self.neighbours(substring, radius // self.chunks):
+                candidates.update(table.get(neighbour, ()))
+
+        matches = []
+        for candidate in candidates:
+            distance = hammingDistance(value, candidate)
+            if distance <= radius:
+                matches.extend((distance, item) for item in self.items[candidate])
+        matches.sort(key=lambda match: match[0])
+        return matches
+
+
+class ImageHashIndex:
+    def __init__(self, database: DatabaseCore, verbose: bool, threshold: int = 6, method: str = "phash"):
+        """
+        Initialize the ImageHashIndex class.
+
+        Analysed and generated images are indexed by their 64-bit perceptual hash with multi-index hashing, so
+        re-saved, resized or slightly cropped copies of a known image are found in sub-linear time and
+        their earlier analysis can be reused. The hashes are persisted in the database and loaded at startup.
+
+        Args:
+            database: The database holding the hashes.
+            verbose: Whether to enable verbose logging.
+            threshold: The maximum Hamming distance (out of 64 bits) between near-duplicates.
+            method: "phash" or "dhash". Hashes of different methods can't be compared, the stored
+                hashes must be rebuilt when it changes.
+        """
+        self.database = database
+        self.threshold = threshold
+        self.size, self.hasher = METHODS[method]
+        self.verbose = verbose
+        setup_logging(verbose=verbose)
+
+        self._lock = threading.Lock()
+        self.hashes = MultiIndexHash()
+        for entry in self.database.image_hash_retriever():
+            self.hashes.add(int(entry['hash'], 16), entry)
+        logger.info(f"Image hash index loaded with {self.hashes.size} hashes")
+
+
+    def hash(self, image_path: str) -> int:
+        """Perceptual hash of an image."""
+        return self.hasher(_grayscale(image_path, self.size)[None])[0]
+
+
+    def hashMany(self, image_paths: list[str]) -> dict[str, int]:
+        """
+        Perceptual hashes of many images, computed in one vectorized batch. Files that are not
+        readable images are skipped.
+
+        Returns:
+            dict[str, int]: The hash of each readable image.
+        """
+        pixels = {}
+        for path in image_paths:
+            try:
+                pixels[path] = _grayscale(path, self.size)
+            except (OSError, ValueError):
+                logger.debug(f"Skipping {path}, not a readable image")
+        if not pixels:
+            return {}
+        return dict(zip(pixels, self.hasher(np.stack(list(pixels.values())))))
+
+
+    def lookup(self, image_path: str, image_hash: int = None, prompt: str = None) -> dict:
+        """
+        Find the closest known near-duplicate of an image that has an analysis, preferring the ones
+        analysed with the same prompt.
+
+        Args:
+            image_path: The path to the image.
+            image_hash: The hash of the image, computed if not given.
+            prompt: The prompt the image is about to be analysed with.
+
+        Returns:
+            dict: The matching entry (hash, image_path, prompt, analysis) with its distance and whether
+                its prompt is the same, None if there is no match.
+        """
+        if image_hash is None:
+            image_hash = self.hash(image_path)
+        with self._lock:
+            matches = [(distance, entry) for distance, entry in self.hashes.search(image_hash, self.threshold) if entry['analysis']]
+        if not matches:
+            return None
+
+        same_prompt = [(distance, entry) for distance, entry in matches if self.samePrompt(entry['prompt'], prompt)]
+        distance, entry = (same_prompt or matches)[0]
+        logger.info(f"{image_path} is a near-duplicate of {entry['image_path']} (distance {distance})")
+        return {**entry, 'distance': distance, 'same_prompt': bool(same_prompt)}
+
+
+    @staticmethod
+    def samePrompt(a: str, b: str) -> bool:
+        """Compare prompts ignoring case and whitespace."""
+        if a is None or b is None:
+            return False
+        return " ".join(a.casefold().split()) == " ".join(b.casefold().split())
+
+
+    def add(self, image_path: str, image_hash: int = None, prompt: str = None, analysis: str = None):
+        """
+        Index an image, with the analysis made of it if any.
+
+        Args:
+            image_path: The path to the image.
+            image_hash: The hash of the image, computed if not given.
+            prompt: The prompt the image was analysed with.
+            analysis: The analysis of the image.
+        """
+        if image_hash is None:
+            image_hash = self.hash(image_path)
+        entry = {'hash': f"{image_hash:016x}", 'image_path': image_path, 'prompt': prompt, 'analysis': analysis}
+        self.database.image_hash_saver(entry['hash'], image_path, prompt=prompt, analysis=analysis)
+        with self._lock:
+            self.hashes.add(image_hash, entry)
+
+
+    def findDuplicates(self, image_paths: Iterable[str], batch_size: int = 256) -> list[list[str]]:
+        """
+        Group near-duplicate images, e.g. to dedupe data/generated_images. Nothing is deleted.
+
+        Args:
+            image_paths: The images to compare, or a directory whose files are compared.
+            batch_size: The number of images hashed per vectorized batch.
+
+        Returns:
+            list[list[str]]: The groups of two or more near-duplicates, each sorted by path.
+        """
+        if isinstance(image_paths, str):
+            directory = image_paths
+            image_paths = (os.path.join(directory, name) for name in sorted(os.listdir(directory)))
+
+        hashes = MultiIndexHash()
+        groups = {}
+
+        def flush(batch):
+            for path, image_hash in self.hashMany(batch).items():
+                matches = hashes.search(image_hash, self.threshold)
+                # Join the group of the closest image already seen, or start a new one
+                group = matches[0][1] if matches else path
+                groups.setdefault(group, []).append(path)
+                hashes.add(image_hash, group)
+
+        batch = []
+        for path in image_paths:
+            batch.append(path)
+            if len(batch) >= batch_size:
+                flush(batch)
+                batch = []
+        flush(batch)
+
+        duplicates = [sorted(paths) for paths in groups.values() if len(paths) > 1]
+        logger.info(f"{len(duplicates)} groups of near-duplicate images found")
+        return duplicates
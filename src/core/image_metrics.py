@@ -0,0 +1,245 @@
+from PIL import Image, ImageOps
+import numpy as np
+import logging
+
+# Get logger for this module
+logger = logging.getLogger(__name__)
+
+# Longest side the image is analysed at. Metrics are statistics, they don't need full resolution
+ANALYSIS_SIZE = 256
+PALETTE_SAMPLES = 4096
+
+# Hue families, by the start of their range in degrees
+HUE_NAMES = [(0, "red"), (15, "orange"), (45, "yellow"), (70, "yellow-green"), (90, "green"), (150, "cyan"),
+             (190, "blue"), (250, "violet"), (290, "magenta"), (330, "red")]
+VALUE_BANDS = ["deep shadows", "shadows", "midtones", "light", "highlights"]
+SATURATION_BANDS = ["grey", "muted", "moderate", "vivid"]
+
+
+def loadPixels(image_path: str, size: int = ANALYSIS_SIZE) -> np.ndarray:
+    """Decode an image to an (H, W, 3) float array in [0, 1], downscaled so its longest side is size."""
+    with Image.open(image_path) as image:
+        image.draft("RGB", (size * 2, size * 2))
+        image = ImageOps.exif_transpose(image).convert("RGB")
+        image.thumbnail((size, size), Image.Resampling.BILINEAR)
+        return np.asarray(image, dtype=np.float32) / 255.0
+
+
+def luminance(rgb: np.ndarray) -> np.ndarray:
+    """Relative luminance (Rec. 709) of RGB pixels."""
+    return rgb @ np.array([0.2126, 0.7152, 0.0722], dtype=np.float32)
+
+
+def toHsv(rgb: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Hue in degrees, saturation and value of RGB pixels, vectorized."""
+    maximum = rgb.max(axis=-1)
+    minimum = rgb.min(axis=-1)
+    delta = maximum - minimum
+    safe = np.where(delta == 0, 1, delta)
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    hue = np.select(
+        [maximum == r, maximum == g],
+        [((g - b) / safe) % 6, (b - r) / safe + 2],
+        (r - g) / safe + 4
+    ) * 60
+    hue = np.where(delta == 0, 0, hue)
+    saturation = np.where(maximum == 0, 0, delta / np.where(maximum == 0, 1, maximum))
+    return hue, saturation, maximum
+
+
+def hueName(hue: float, saturation: float, value: float) -> str:
+    """A plain name for a color, so the agent can cite it."""
+    if value < 0.15:
+        return "black"
+    if saturation < 0.12:
+        return "white" if value > 0.85 else "grey"
+    name = next(name for start, name in reversed(HUE_NAMES) if hue >= start)
+    return f"dark {name}" if value < 0.4 else name
+
+
+def kMeans(pixels: np.ndarray, k: int, iterations: int = 12, seed: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Cluster pixels with k-means++ seeding and Lloyd iterations, fully vectorized.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: The (k, 3) centers and the label of each pixel.
+    """
+    rng = np.random.default_rng(seed)
+    k = min(k, len(pixels))
+    centers = [pixels[rng.integers(len(pixels))]]
+    distances = ((pixels - centers[0]) ** 2).sum(axis=1)
+    for _ in range(1, k):
+        total = distances.sum()
+        index = rng.choice(len(pixels), p=distances / total) if total > 0 else rng.integers(len(pixels))
+        centers.append(pixels[index])
+        distances = np.minimum(distances, ((pixels - pixels[index]) ** 2).sum(axis=1))
+    centers = np.array(centers)
+
+    for _ in range(iterations):
+        # |p - c|^2 = |p|^2 - 2 p.c + |c|^2, the |p|^2 term doesn't change the argmin
+        labels = np.argmin((centers ** 2).sum(axis=1) - 2 * pixels @ centers.T, axis=1)
+        counts = np.bincount(labels, minlength=k)
+        sums = np.zeros_like(centers)
+        np.add.at(sums, labels, pixels)
+        updated = np.where(counts[:, None] > 0, sums / np.maximum(counts, 1)[:, None], centers)
+        if np.allclose(updated, centers, atol=1e-4):
+            break
+        centers = updated
+    return centers, labels
+
+
+def palette(rgb: np.ndarray, colors: int = 6) -> list[dict]:
+    """
+    The dominant colors of an image, largest share first.
+
+    Returns:
+        list[dict]: Each color with its hex code, name and share of the image.
+    """
+    pixels = rgb.reshape(-1, 3)
+    if len(pixels) > PALETTE_SAMPLES:
+        pixels = pixels[np.random.default_rng(0).choice(len(pixels), PALETTE_SAMPLES, replace=False)]
+    centers, labels = kMeans(pixels, colors)
+    shares = np.bincount(labels, minlength=len(centers)) / len(labels)
+    hue, saturation, value = toHsv(centers)
+
+    result = []
+    for index in np.argsort(-shares):
+        # Clusters of stray edge pixels aren't colors of the image
+        if shares[index] < 0.005:
+            continue
+        red, green, blue = (np.clip(centers[index], 0, 1) * 255).round().astype(int)
+        result.append({
+            'hex': f"#{red:02x}{green:02x}{blue:02x}",
+            'name': hueName(hue[index], saturation[index], value[index]),
+            'share': round(float(shares[index]), 3),
+            'hue': round(float(hue[index])),
+            'saturation': round(float(saturation[index]), 2),
+            'value': round(float(value[index]), 2)
+        })
+    return result
+
+
+def harmony(colors: list[dict]) -> str:
+    """Name the relationship between the hues of the chromatic palette colors."""
+    hues = [color['hue'] for color in colors if color['saturation'] >= 0.2 and color['value'] >= 0.2 and color['share'] >= 0.05]
+    if len(hues) < 2:
+        return "achromatic or monochromatic"
+    gaps = [abs((a - b + 180) % 360 - 180) for i, a in enumerate(hues) for b in hues[i + 1:]]
+    if max(gaps) <= 40:
+        return "analogous"
+    if any(150 <= gap <= 210 for gap in gaps) and len(hues) <= 3:
+        return "complementary"
+    if sum(100 <= gap <= 140 for gap in gaps) >= 2:
+        return "triadic"
+    return "varied"
+
+
+def histogram(values: np.ndarray, names: list[str]) -> dict:
+    """Share of values in equal bands of [0, 1]."""
+    counts = np.bincount(np.minimum((values * len(names)).astype(int), len(names) - 1).ravel(), minlength=len(names))
+    return {name: round(float(count), 3) for name, count in zip(names, counts / values.size)}
+
+
+def edgeMagnitude(gray: np.ndarray) -> np.ndarray:
+    """Sobel gradient magnitude of a grayscale image."""
+    padded = np.pad(gray, 1, mode="edge")
+    gx = (padded[:-2, 2:] + 2 * padded[1:-1, 2:] + padded[2:, 2:]) - (padded[:-2, :-2] + 2 * padded[1:-1, :-2] + padded[2:, :-2])
+    gy = (padded[2:, :-2] + 2 * padded[2:, 1:-1] + padded[2:, 2:]) - (padded[:-2, :-2] + 2 * padded[:-2, 1:-1] + padded[:-2, 2:])
+    return np.hypot(gx, gy)
+
+
+def composition(gray: np.ndarray, saturation: np.ndarray) -> dict:
+    """
+    Where the visual weight of an image sits. Weight is edge density plus saturation and contrast
+    against the mean value, a cheap proxy for where the eye goes.
+    """
+    edges = edgeMagnitude(gray)
+    weight = edges / (edges.mean() + 1e-6) + saturation / (saturation.mean() + 1e-6) + np.abs(gray - gray.mean()) / (np.abs(gray - gray.mean()).mean() + 1e-6)
+    height, width = gray.shape
+    if not weight.any():
+        # A flat image weighs the same everywhere
+        weight = np.ones_like(gray)
+    total = weight.sum()
+
+    ys, xs = np.mgrid[0:height, 0:width]
+    center_x = float((weight * xs).sum() / total / max(width - 1, 1))
+    center_y = float((weight * ys).sum() / total / max(height - 1, 1))
+
+    # Share of the weight and of the edges in each cell of the rule-of-thirds grid. Images under
+    # 3 pixels on a side leave some cells empty, they have no weight and no edges
+    rows = np.array_split(np.arange(height), 3)
+    columns = np.array_split(np.arange(width), 3)
+    grid = [[round(float(weight[np.ix_(row, column)].sum() / total), 3) for column in columns] for row in rows]
+    edge_grid = [[round(float(edges[np.ix_(row, column)].mean()), 3) if len(row) and len(column) else 0.0 for column in columns] for row in rows]
+
+    thirds = [(x, y) for x in (1 / 3, 2 / 3) for y in (1 / 3, 2 / 3)]
+    nearest = min(thirds, key=lambda point: (point[0] - center_x) ** 2 + (point[1] - center_y) ** 2)
+    names = {(1 / 3, 1 / 3): "upper left", (2 / 3, 1 / 3): "upper right", (1 / 3, 2 / 3): "lower left", (2 / 3, 2 / 3): "lower right"}
+
+    return {
+        'center_of_weight': {'x': round(center_x, 3), 'y': round(center_y, 3)},
+        'nearest_thirds_point': names[nearest],
+        'distance_to_thirds_point': round(float(np.hypot(nearest[0] - center_x, nearest[1] - center_y)), 3),
+        'distance_to_center': round(float(np.hypot(0.5 - center_x, 0.5 - center_y)), 3),
+        'balance': {
+            'left_right': round(float(weight[:, :width // 2].sum() / total), 3),
+            'top_bottom': round(float(weight[:height // 2].sum() / total), 3)
+        },
+        'weight_grid': grid,
+        'edge_density_grid': edge_grid,
+        'edge_density': round(float((edges > 0.25).mean()), 3)
+    }
+
+
+def analyzeImage(image_path: str, colors: int = 6) -> dict:
+    """
+    Measure the color and composition of an image.
+
+    Args:
+        image_path: The path to the image.
+        colors: The number of palette colors.
+
+    Returns:
+        dict: The palette and harmony, value and saturation distributions, contrast, color
+            temperature and composition metrics.
+    """
+    rgb = loadPixels(image_path)
+    gray = luminance(rgb)
+    hue, saturation, value = toHsv(rgb)
+    colors = palette(rgb, colors)
+
+    # Hasler and Suesstrunk colorfulness, on 0-255 channels
+    rg = (rgb[..., 0] - rgb[..., 1]) * 255
+    yb = (0.5 * (rgb[..., 0] + rgb[..., 1]) - rgb[..., 2]) * 255
+    colorfulness = np.hypot(rg.std(), yb.std()) + 0.3 * np.hypot(rg.mean(), yb.mean())
+
+    chromatic = saturation >= 0.15
+    warm = chromatic & ((hue < 70) | (hue >= 330))
+    cool = chromatic & (hue >= 150) & (hue < 290)
+    low, high = np.percentile(gray, [5, 95])
+
+    return {
+        'size': {'width': rgb.shape[1], 'height': rgb.shape[0], 'analysed_at': ANALYSIS_SIZE},
+        'palette': colors,
+        'harmony': harmony(colors),
+        'value': {
+            'mean': round(float(gray.mean()), 3),
+            'key': "low key" if gray.mean() < 0.35 else "high key" if gray.mean() > 0.65 else "middle key",
+            'histogram': histogram(gray, VALUE_BANDS)
+        },
+        'contrast': {
+            'rms': round(float(gray.std()), 3),
+            'dynamic_range': round(float(high - low), 3)
+        },
+        'saturation': {
+            'mean': round(float(saturation.mean()), 3),
+            'colorfulness': round(float(colorfulness), 1),
+            'histogram': histogram(saturation, SATURATION_BANDS)
+        },
+        'temperature': {
+            'warm_share': round(float(warm.mean()), 3),
+            'cool_share': round(float(cool.mean()), 3),
+            'dominant': "warm" if warm.sum() > 1.2 * cool.sum() else "cool" if cool.sum() > 1.2 * warm.sum() else "balanced"
+        },
+        'composition': composition(gray, saturation)
+    }
@@ -0,0 +1,294 @@
+from src.core.database import DatabaseCore
+from src.core.logging_config import setup_logging
+
+from contextlib import contextmanager
+from typing import Callable
+import threading
+import time
+import logging
+
+# Get logger for this module
+logger = logging.getLogger(__name__)
+
+# Priority classes, lower runs first. Background jobs never start while an interactive request is running
+PRIORITIES = {
+    'interactive': 0,
+    'normal': 5,
+    'background': 10
+}
+
+FINISHED = ("done", "failed")
+
+
+class JobQueue:
+    def __init__(self, database: DatabaseCore,
+                       verbose: bool,
+                       workers: int = 1,
+                       max_attempts: int = 3,
+                       poll_interval: float = 1.0,
+                       retry_delay: float = 5.0,
+                       kinds: tuple = None):
+        """
+        Initialize the JobQueue class.
+
+        Jobs are persisted in the `jobs` table, so queued work survives restarts, and run by worker
+        threads by priority class then age. Jobs with the same dedup_key are only queued once at a
+        time, failed jobs are retried with exponential backoff, and background jobs wait while
+        interactive requests are running so they never compete with them.
+
+        Whatever a handler returns is saved as the result of its job. Callers submitting work they
+        need the outcome of (e.g. an image generation) get the job id at once, then poll status(),
+        block on wait(), or register a callback run when the job is done or has failed.
+
+        Args:
+            database: The database holding the jobs.
+            verbose: Whether to enable verbose logging.
+            workers: The number of worker threads.
+            max_attempts: The number of attempts before a job is marked failed.
+            poll_interval: The seconds between two polls of an idle worker.
+            retry_delay: The delay before the first retry, doubled at each attempt.
+            kinds: The kinds of job run by this queue's workers, any kind if None. Queues sharing
+                the jobs table with disjoint kinds get their own pool of workers.
+        """
+        self.database = database
+        self.num_workers = workers
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.retry_delay = retry_delay
+        self.kinds = tuple(kinds) if kinds is not None else None
+        self.verbose = verbose
+        setup_logging(verbose=verbose)
+
+        self.handlers = {}
+        self._interactive = 0
+        self._running = 0
+        self._condition = threading.Condition()
+        self._stop = threading.Event()
+        self._workers = []
+        # Job id -> callbacks run once the job is done or has failed
+        self._callbacks = {}
+
+        recovered = self.database.job_recoverer(kinds=self.kinds)
+        if recovered:
+            logger.info(f"{recovered} interrupted jobs put back in the queue")
+
+
+    def register(self, kind: str, handler: Callable[[dict], object]):
+        """
+        Register the handler running the jobs of a kind.
+
+        Args:
+            kind: The kind of job.
+            handler: Called with the payload of the job.
+        """
+        self.handlers[kind] = handler
+
+
+    def submit(self, kind: str, payload: dict = None, priority: str = "background", dedup_key: str = None, callback: Callable[[dict], None] = None) -> int:
+        """
+        Queue a job.
+
+        Args:
+            kind: The kind of job, which must have a registered handler when it runs.
+            payload: The JSON serializable arguments passed to the handler.
+            priority: The priority class: 'interactive', 'normal' or 'background'.
+            dedup_key: Jobs with the same key are only queued once at a time. Defaults to the kind.
+            callback: Called with the job once it is done or has failed, see onComplete.
+
+        Returns:
+            int: The id of the job, or of the identical job already queued.
+
+        Raises:
+            ValueError: If this queue's workers don't run jobs of this kind, so it would never run.
+        """
+        if self.kinds is not None and kind not in self.kinds:
+            raise ValueError(f"This queue only runs {', '.join(self.kinds)} jobs, not {kind}")
+        job_id = self.database.job_saver(kind, payload=payload, priority=PRIORITIES[priority], dedup_key=dedup_key or kind)
+        if job_id is not None and callback is not None:
+            self.onComplete(job_id, callback)
+        with self._condition:
+            self._condition.notify()
+        return job_id
+
+
+    def status(self, job_id: int) -> dict:
+        """
+        Poll a job.
+
+        Returns:
+            dict: The job with its status ('pending', 'running', 'done' or 'failed'), attempts,
+                error, and result once done. None if it doesn't exist.
+        """
+        return self.database.job_retriever(job_id)
+
+
+    def onComplete(self, job_id: int, callback: Callable[[dict], None]):
+        """
+        Run a callback once a job is done or has failed, in the worker thread that ran it. If the job
+        is already finished, the callback runs at once in the calling thread.
+
+        Args:
+            job_id: The job to wait for.
+            callback: Called with the job, see status.
+        """
+        with self._condition:
+            job = self.database.job_retriever(job_id)
+            if job is None or job['status'] not in FINISHED:
+                self._callbacks.setdefault(job_id, []).append(callback)
+                return
+        self.runCallback(callback, job)
+
+
+    def runCallback(self, callback: Callable[[dict], None], job: dict):
+        try:
+            callback(job)
+        except Exception as e:
+            logger.error(f"Callback of job {job['id']} failed: {str(e)}")
+
+
+    def wait(self, job_id: int, timeout: float = None) -> dict:
+        """
+        Block until a job is done or has failed.
+
+        Args:
+            job_id: The job to wait for.
+            timeout: The maximum seconds to wait, forever if None.
+
+        Returns:
+            dict: The job, see status. None on timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while True:
+                job = self.database.job_retriever(job_id)
+                if job is None or job['status'] in FINISHED:
+                    return job
+                remaining = self.poll_interval if deadline is None else min(self.poll_interval, deadline - time.monotonic())
+                if remaining <= 0:
+                    return None
+                # Woken up as soon as a worker of this queue finishes a job, polling covers other processes
+                self._condition.wait(remaining)
+
+
+    @contextmanager
+    def interactive(self):
+        """
+        Mark an interactive request as running. Workers don't start background jobs until it ends.
+        """
+        with self._condition:
+            self._interactive += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._interactive -= 1
+                self._condition.notify_all()
+
+
+    def start(self):
+        """Start the worker threads."""
+        self._stop.clear()
+        for index in range(self.num_workers - len(self._workers)):
+            worker = threading.Thread(target=self.work, name=f"job-worker-{index}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        logger.info(f"Job queue started with {self.num_workers} workers")
+
+
+    def work(self):
+        """Worker loop: claim the most urgent runnable job, run it, repeat."""
+        while not self._stop.is_set():
+            with self._condition:
+                # Background jobs yield to interactive requests
+                max_priority = PRIORITIES['background'] - 1 if self._interactive else None
+                job = self.database.job_claimer(now=time.time(), max_priority=max_priority, kinds=self.kinds)
+                if job is None:
+                    self._condition.wait(self.poll_interval)
+                    continue
+                self._running += 1
+
+            try:
+                self.runJob(job)
+            finally:
+                with self._condition:
+                    self._running -= 1
+                    self._condition.notify_all()
+
+
+    def runJob(self, job: dict):
+        """Run a claimed job and record its outcome, scheduling a retry if it failed."""
+        handler = self.handlers.get(job['kind'])
+        start = time.perf_counter()
+        try:
+            if handler is None:
+                raise KeyError(f"No handler registered for jobs of kind {job['kind']}")
+            result = handler(job['payload'])
+        except Exception as e:
+            if job['attempts'] < self.max_attempts:
+                delay = self.retry_delay * 2 ** (job['attempts'] - 1)
+                logger.warning(f"Job {job['id']} ({job['kind']}) failed, retrying in {delay:.0f}s: {str(e)}")
+                self.database.job_updater(job['id'], status="pending", error=str(e), run_after=time.time() + delay)
+                return
+            logger.error(f"Job {job['id']} ({job['kind']}) failed after {job['attempts']} attempts: {str(e)}")
+            self.database.job_updater(job['id'], status="failed", error=str(e))
+        else:
+            self.database.job_updater(job['id'], status="done", result=result)
+            logger.info(f"Job {job['id']} ({job['kind']}) done in {time.perf_counter() - start:.2f}s")
+
+        with self._condition:
+            callbacks = self._callbacks.pop(job['id'], [])
+        if callbacks:
+            finished = self.database.job_retriever(job['id'])
+            for callback in callbacks:
+                self.runCallback(callback, finished)
+
+
+    def depth(self) -> dict:
+        """
+        Return the visibility on the queue: jobs by status and priority class.
+
+        Returns:
+            dict: For each status, the number of jobs of each priority class.
+        """
+        names = {value: name for name, value in PRIORITIES.items()}
+        return {
+            status: {names.get(priority, priority): count for priority, count in counts.items()}
+            for status, counts in self.database.job_depth_retriever(kinds=self.kinds).items()
+        }
+
+
+    def join(self, timeout: float = None) -> bool:
+        """
+        Wait until no job is pending or running, including retries.
+
+        Args:
+            timeout: The maximum seconds to wait, forever if None.
+
+        Returns:
+            bool: True if the queue drained, False on timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            depth = self.database.job_depth_retriever(kinds=self.kinds)
+            if not depth.get('pending') and not depth.get('running'):
+                return True
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(self.poll_interval)
+
+
+    def shutdown(self, wait: bool = True):
+        """
+        Stop the workers once their current job is done. Queued jobs stay in the table.
+
+        Args:
+            wait: Whether to wait for the workers to stop.
+        """
+        self._stop.set()
+        with self._condition:
+            self._condition.notify_all()
+        if wait:
+            for worker in self._workers:
+                worker.join()
+        self._workers = []
+        logger.info("Job queue stopped")
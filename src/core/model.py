@@ -2,8 +2,15 @@ from src.core.utils import Utils
 from src.core.database import DatabaseCore
 from src.core.logging_config import setup_logging
 from src.core.prompts import Prompts
+from src.core.image_hash import ImageHashIndex
+from src.core.budget import BudgetController
+from src.core.single_flight import SingleFlight
+from src.core.http_transport import HttpTransport
 
 from openai import OpenAI
+from typing import Callable
+import asyncio
+import os
 import logging
 
 # Get logger for this module
@@ -17,7 +24,11 @@ class ModelCore:
                        API_TOKEN: str,
                        database: DatabaseCore,
                        prompts: Prompts,
-                       verbose: bool):
+                       verbose: bool,
+                       image_index: ImageHashIndex = None,
+                       budget: BudgetController = None,
+                       single_flight: SingleFlight = None,
+                       transport: HttpTransport = None):
         """
         Initialize the model core.
         
@@ -26,6 +37,10 @@ class ModelCore:
             model_name: The name of the model
             API_TOKEN: API token for authentication
             verbose: Whether to enable verbose logging
+            image_index: The perceptual hash index used to reuse analyses of near-duplicate images
+            budget: The budget controller the usage of every call is charged to
+            single_flight: Coalesces identical upstream calls in flight. Every call goes upstream if not provided
+            transport: The shared HTTP connection pool. The OpenAI client uses its own if not provided
         """
         self.model_provider = model_provider
         self.model_name = model_name
@@ -35,6 +50,10 @@ class ModelCore:
         self.verbose = verbose
         self.database = database
         self.prompts = prompts
+        self.image_index = image_index
+        self.budget = budget
+        self.single_flight = single_flight
+        self.transport = transport
 
         # Configure logging based on verbose mode
         setup_logging(verbose=self.verbose)
@@ -48,7 +67,7 @@ class ModelCore:
             raise
 
 
-    def imageGenerator(self, prompt: str, size: str = "1024x1024", quality: str = "low", save_path: str="data/generated_images") -> tuple[str, str]:
+    def imageGenerator(self, prompt: str, size: str = "1024x1024", quality: str = "low", save_path: str="data/generated_images", session_id: str = None) -> tuple[str, str]:
         """
         Generate an image from a prompt using OpenAI's DALL-E 3 model.
         
@@ -56,6 +75,8 @@ class ModelCore:
             prompt: The text description of the desired image
             size: The size of the generated image. Options: "256x256", "512x512", "1024x1024", "1024x1792", "1792x1024"
             quality: The quality of the generated image. Options: "low", "medium", "high"
+            save_path: The directory where the generated image is saved
+            session_id: The session the turn belongs to
             
         Returns:
             tuple[str, str]: URL of the generated image and the local path where it was saved
@@ -63,182 +84,426 @@ class ModelCore:
         Raises:
             Exception: If image generation fails
         """
-        # Format the prompt
-        formatted_prompt, original_prompt = self.prompts.promptFormatter(task="image_generation", prompt=prompt)
-
-        # Save user's prompt to database
-        self.database.conversation_saver(
-            data={
-                'role': 'user',
-                'text': original_prompt
-            },
-            data_table='conversations'
-        )
-        logger.info("User's image generation prompt saved to database")
-
-        try:
-            logger.info(f"Generating image with prompt: {formatted_prompt}")
-            
-            # Generate the image
-            response = self.client.images.generate(
-                model=self.image_model_name,
-                prompt=formatted_prompt,
-                n=1,
-                size=size,
-                # quality=quality
-            )
-            image_url = response.data[0].url
-
-            # Save the image to the local directory
-            path_to_image = self.utils.imgSaver(image_url=image_url, formatted_prompt=formatted_prompt, save_path=save_path)
-            logger.info(f"Image saved successfully to {save_path}")
+        # Every record of the request is committed at once when the turn ends
+        with self.database.turn(session_id=session_id):
+            # Format the prompt
+            formatted_prompt, original_prompt = self.prompts.promptFormatter(task="image_generation", prompt=prompt)
 
-            # Encode the generated image to base64
-            base64_image = self.utils.encode_image(image_path=path_to_image)
-
-            # Save the generated image to database
+            # Save user's prompt to database
             self.database.conversation_saver(
                 data={
-                    'role': 'system',
-                    'image': base64_image
+                    'role': 'user',
+                    'text': original_prompt,
+                    'session_id': session_id
                 },
                 data_table='conversations'
             )
-            logger.info("Generated image saved to database")
+            logger.info("User's image generation prompt saved to database")
 
-            return path_to_image
-        except Exception as e:
-            logger.error(f"Failed to generate image: {str(e)}")
-            raise
+            try:
+                def generate():
+                    logger.info(f"Generating image with prompt: {formatted_prompt}")
+
+                    # Generate the image
+                    response = self.client.images.generate(
+                        model=self.image_model_name,
+                        prompt=formatted_prompt,
+                        n=1,
+                        size=size,
+                        # quality=quality
+                    )
+                    image_url = response.data[0].url
+                    self.recordUsage(session_id, images=1)
+
+                    # Save the image to the local directory
+                    path_to_image = self.utils.imgSaver(image_url=image_url, formatted_prompt=formatted_prompt, save_path=save_path)
+                    logger.info(f"Image saved successfully to {save_path}")
+
+                    # Index the generated image so later uploads of it are recognized
+                    if self.image_index is not None:
+                        try:
+                            self.image_index.add(path_to_image, prompt=formatted_prompt)
+                        except Exception as e:
+                            logger.warning(f"Failed to index {path_to_image}: {str(e)}")
+                    return path_to_image
+
+                # Identical requests in flight share the generated image, each still gets its own rows
+                path_to_image = self.coalesced(
+                    {'call': "images.generate", 'model': self.image_model_name, 'prompt': formatted_prompt, 'size': size, 'save_path': save_path},
+                    generate
+                )
+
+                # Encode the generated image to base64
+                base64_image = self.utils.encode_image(image_path=path_to_image)
 
+                # Save the generated image to database
+                self.database.conversation_saver(
+                    data={
+                        'role': 'system',
+                        'image': base64_image,
+                        'session_id': session_id
+                    },
+                    data_table='conversations'
+                )
+                logger.info("Generated image saved to database")
 
-    def chattingImage(self, prompt: str, image_path: str) -> str:
+                return path_to_image
+            except Exception as e:
+                logger.error(f"Failed to generate image: {str(e)}")
+                raise
+
+
+    def chattingImage(self, prompt: str, image_path: str, session_id: str = None, base64_image: str = None) -> str:
         """
         Generate a response from the model.
         
         Args:
             prompt: The input prompt for the model
             image_path: The path to the image to analyze
+            session_id: The session the turn belongs to
+            base64_image: The already encoded image, read from image_path if not given
             
         Returns:
             str: Generated response from the model
         """
-        logger.info(f"Processing image chat with prompt: {prompt}")
-        logger.info(f"Using image from path: {image_path}")
+        # Every record of the request is committed at once when the turn ends
+        with self.database.turn(session_id=session_id):
+            logger.info(f"Processing image chat with prompt: {prompt}")
+            logger.info(f"Using image from path: {image_path}")
 
-        base64_image = self.utils.encode_image(image_path=image_path) 
-
-        # Format the prompt
-        formatted_prompt, original_prompt = self.prompts.promptFormatter(task="chattingImage", prompt=prompt, image_path=image_path)
+            # The request and the database record share the same data URL string
+            if base64_image is None:
+                image_url = self.utils.imageDataUrl(image_path=image_path)
+            else:
+                image_url = f"data:image/jpeg;base64,{base64_image}"
 
-        # Save user's original prompt and image to database
-        self.database.conversation_saver(
-            data={
-                'role': 'user',
-                'text': original_prompt,
-                'image': base64_image
-            },
-            data_table='conversations'
-        )
-        logger.info("User's original prompt and image saved to database")
+            # Format the prompt
+            formatted_prompt, original_prompt = self.prompts.promptFormatter(task="chattingImage", prompt=prompt, image_path=image_path)
 
-        try:
-            response = self.client.chat.completions.create(
-                model=self.model_name,
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": formatted_prompt
-                            },
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{base64_image}"
-                                }
-                            }
-                        ]
-                    }
-                ]
-            )
-            result = response.choices[0].message.content
-            logger.info(f"Model has generated a response: {result}")
-
-            # Save system's response to database
+            # Save user's original prompt and image to database
             self.database.conversation_saver(
                 data={
-                    'role': 'system',
-                    'text': result
+                    'role': 'user',
+                    'text': original_prompt,
+                    'image': image_url,
+                    'session_id': session_id
                 },
                 data_table='conversations'
             )
-            logger.info("System's response saved to database")
+            logger.info("User's original prompt and image saved to database")
 
-            return result
-        except Exception as e:
-            logger.error(f"Failed to generate response: {str(e)}")
-            raise
+            # Look for a near-duplicate of the image that was already analysed
+            image_hash, earlier = None, None
+            if self.image_index is not None:
+                try:
+                    image_hash = self.image_index.hash(image_path)
+                    earlier = self.image_index.lookup(image_path, image_hash=image_hash, prompt=original_prompt)
+                except Exception as e:
+                    logger.warning(f"Failed to hash {image_path}: {str(e)}")
+
+            try:
+                if earlier is not None and earlier['same_prompt']:
+                    # Same question about the same artwork, no need for a new vision call
+                    result = earlier['analysis']
+                    logger.info(f"Reusing the analysis of {earlier['image_path']}")
+                else:
+                    messages = [
+                        {
+                            "role": "user",
+                            "content": [
+                                {
+                                    "type": "text",
+                                    "text": formatted_prompt
+                                },
+                                {
+                                    "type": "image_url",
+                                    "image_url": {
+                                        "url": image_url
+                                    }
+                                }
+                            ]
+                        }
+                    ]
+                    if earlier is not None:
+                        # A different question about a known artwork, build on what was already said about it
+                        messages.insert(0, {"role": "system", "content": f"An earlier analysis of a near-duplicate of this image: {earlier['analysis']}"})
+
+                    def complete():
+                        response = self.client.chat.completions.create(
+                            model=self.model_name,
+                            messages=messages
+                        )
+                        self.recordUsage(session_id, response=response)
+                        return response.choices[0].message.content
+
+                    # The image is keyed by its file rather than its payload, to avoid hashing megabytes of base64
+                    image_stat = os.stat(image_path)
+                    result = self.coalesced(
+                        {'call': "chat.completions", 'model': self.model_name, 'prompt': formatted_prompt, 'seed': messages[0]['content'] if earlier is not None else None,
+                         'image': f"{os.path.realpath(image_path)}@{image_stat.st_size}:{image_stat.st_mtime_ns}"},
+                        complete
+                    )
+                    logger.info(f"Model has generated a response: {result}")
+
+                    if image_hash is not None:
+                        self.image_index.add(image_path, image_hash=image_hash, prompt=original_prompt, analysis=result)
+
+                # Save system's response to database
+                self.database.conversation_saver(
+                    data={
+                        'role': 'system',
+                        'text': result,
+                        'session_id': session_id
+                    },
+                    data_table='conversations'
+                )
+                logger.info("System's response saved to database")
+
+                return result
+            except Exception as e:
+                logger.error(f"Failed to generate response: {str(e)}")
+                raise
 
 
-    def chatting(self, prompt: str) -> str:
+    def chatting(self, prompt: str, history: list[dict] = None, session_id: str = None) -> str:
         """
         Generate a response from the model.
         
         Args:
             prompt: The input prompt for the model
+            history: Previous messages of the session, sent before the prompt
+            session_id: The session the turn belongs to
             
         Returns:
             str: Generated response from the model
         """
-        logger.info(f"Processing chat with prompt: {prompt}")
+        # Every record of the request is committed at once when the turn ends
+        with self.database.turn(session_id=session_id):
+            logger.info(f"Processing chat with prompt: {prompt}")
 
-        # Format the prompt
-        formatted_prompt, original_prompt = self.prompts.promptFormatter(task="chatting", prompt=prompt)
+            # Format the prompt
+            formatted_prompt, original_prompt = self.prompts.promptFormatter(task="chatting", prompt=prompt)
 
-        # Save user's prompt to database before being processed
-        self.database.conversation_saver(
-            data={
-                'role': 'user',
-                'text': original_prompt
-            },
-            data_table='conversations'
-        )
-        logger.info(f"User's original prompt saved to database")
+            # Save user's prompt to database before being processed
+            self.database.conversation_saver(
+                data={
+                    'role': 'user',
+                    'text': original_prompt,
+                    'session_id': session_id
+                },
+                data_table='conversations'
+            )
+            logger.info(f"User's original prompt saved to database")
 
-        try:
-            logger.info(f"Model is processing user's prompt: {prompt}")
-            response = self.client.chat.completions.create(
-                model=self.model_name,
-                messages=[
+            try:
+                logger.info(f"Model is processing user's prompt: {prompt}")
+                messages = (history or []) + [
                     {
                         "role": "user", 
                         "content": formatted_prompt
                     }
-                ],
-                temperature=0.7,
-                max_tokens=512
-            )
-            result = response.choices[0].message.content
-            logger.info(f"Model has generated a response: {result}")
+                ]
 
-            # Save system's response to database
-            self.database.conversation_saver(
-                data={
-                    'role': 'system',
-                    'text': result
-                },
-                data_table='conversations'
-            )
-            logger.info(f"System's response saved to database")
+                def complete():
+                    response = self.client.chat.completions.create(
+                        model=self.model_name,
+                        messages=messages,
+                        temperature=0.7,
+                        max_tokens=512
+                    )
+                    self.recordUsage(session_id, response=response)
+                    return response.choices[0].message.content
+
+                # Identical prompts with identical history in flight share one upstream call
+                result = self.coalesced(
+                    {'call': "chat.completions", 'model': self.model_name, 'messages': messages, 'temperature': 0.7, 'max_tokens': 512},
+                    complete
+                )
+                logger.info(f"Model has generated a response: {result}")
+
+                # Save system's response to database
+                self.database.conversation_saver(
+                    data={
+                        'role': 'system',
+                        'text': result,
+                        'session_id': session_id
+                    },
+                    data_table='conversations'
+                )
+                logger.info(f"System's response saved to database")
+
+                return result
+            except Exception as e:
+                logger.error(f"Failed to generate response: {str(e)}")
+                raise
+
+
+    def completion(self, messages: list[dict], temperature: float = 0.3, max_tokens: int = 512) -> str:
+        """
+        Run a chat completion without saving anything to the conversations. Used for internal
+        bookkeeping calls such as compacting session memory.
 
-            return result
+        Args:
+            messages: The messages to send
+            temperature: The sampling temperature
+            max_tokens: The maximum number of tokens to generate
+
+        Returns:
+            str: Generated response from the model
+        """
+        try:
+            response = self.client.chat.completions.create(
+                model=self.model_name,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens
+            )
+            self.recordUsage(response=response)
+            return response.choices[0].message.content
         except Exception as e:
-            logger.error(f"Failed to generate response: {str(e)}")
+            logger.error(f"Failed to generate completion: {str(e)}")
             raise
 
 
+    def coalesced(self, key_parts: dict, call: Callable):
+        """
+        Make an upstream call, sharing it with the identical calls in flight. Only the caller that
+        actually makes the call is charged for it.
+
+        Args:
+            key_parts: The arguments identifying the call
+            call: The function making the call
+
+        Returns:
+            The result of the call
+        """
+        if self.single_flight is None:
+            return call()
+        return self.single_flight.do(self.single_flight.makeKey(key_parts), call)
+
+
+    async def acoalesced(self, key_parts: dict, lead: Callable, follow: Callable):
+        """
+        Coroutine version of coalesced, for a whole request. The first coroutine making it runs lead,
+        the sync request, in a worker thread. Identical coroutine requests arriving meanwhile await
+        its result without holding a thread, then run follow in a worker thread to save their own
+        conversation rows.
+
+        Args:
+            key_parts: The arguments identifying the request
+            lead: The sync request, run by the first caller
+            follow: Called with the shared result, None if the request failed, by the other callers
+
+        Returns:
+            The result of the request
+        """
+        if self.single_flight is None:
+            return await asyncio.to_thread(lead)
+
+        led = False
+        def run():
+            nonlocal led
+            led = True
+            return lead()
+
+        # Keyed apart from the upstream calls made inside lead, so the leader doesn't wait on itself
+        key = self.single_flight.makeKey({'caller': "async", **key_parts})
+        try:
+            result = await self.single_flight.doAsync(key, run)
+        except Exception:
+            if not led:
+                await asyncio.to_thread(follow, None)
+            raise
+        if not led:
+            await asyncio.to_thread(follow, result)
+        return result
+
+
+    def saveTurn(self, session_id: str, records: list[dict]):
+        """Save the conversation rows of a request in one turn."""
+        with self.database.turn(session_id=session_id):
+            for record in records:
+                self.database.conversation_saver(data={**record, 'session_id': session_id}, data_table='conversations')
+
+
+    async def achatting(self, prompt: str, history: list[dict] = None, session_id: str = None) -> str:
+        """
+        Coroutine version of chatting, run in a worker thread so its database turn stays in one thread.
+        Identical requests in flight wait for it without holding a thread, see acoalesced.
+        """
+        formatted_prompt, original_prompt = self.prompts.promptFormatter(task="chatting", prompt=prompt)
+        messages = (history or []) + [{"role": "user", "content": formatted_prompt}]
+
+        def follow(result):
+            records = [{'role': 'user', 'text': original_prompt}]
+            if result is not None:
+                records.append({'role': 'system', 'text': result})
+            self.saveTurn(session_id, records)
+
+        return await self.acoalesced(
+            {'call': "chatting", 'model': self.model_name, 'messages': messages},
+            lambda: self.chatting(prompt, history=history, session_id=session_id),
+            follow
+        )
+
+
+    async def achattingImage(self, prompt: str, image_path: str, session_id: str = None) -> str:
+        """
+        Coroutine version of chattingImage, run in a worker thread so its database turn stays in one thread.
+        Identical requests in flight wait for it without holding a thread, see acoalesced.
+        """
+        formatted_prompt, original_prompt = self.prompts.promptFormatter(task="chattingImage", prompt=prompt, image_path=image_path)
+        image_stat = os.stat(image_path)
+
+        def follow(result):
+            records = [{'role': 'user', 'text': original_prompt, 'image': self.utils.imageDataUrl(image_path=image_path)}]
+            if result is not None:
+                records.append({'role': 'system', 'text': result})
+            self.saveTurn(session_id, records)
+
+        return await self.acoalesced(
+            {'call': "chattingImage", 'model': self.model_name, 'prompt': formatted_prompt,
+             'image': f"{os.path.realpath(image_path)}@{image_stat.st_size}:{image_stat.st_mtime_ns}"},
+            lambda: self.chattingImage(prompt, image_path, session_id=session_id),
+            follow
+        )
+
+
+    async def aimageGenerator(self, prompt: str, size: str = "1024x1024", quality: str = "low", save_path: str="data/generated_images", session_id: str = None) -> str:
+        """
+        Coroutine version of imageGenerator, run in a worker thread so its database turn stays in one thread.
+        Identical requests in flight wait for it without holding a thread, see acoalesced.
+        """
+        formatted_prompt, original_prompt = self.prompts.promptFormatter(task="image_generation", prompt=prompt)
+
+        def follow(path_to_image):
+            records = [{'role': 'user', 'text': original_prompt}]
+            if path_to_image is not None:
+                records.append({'role': 'system', 'image': self.utils.encode_image(image_path=path_to_image)})
+            self.saveTurn(session_id, records)
+
+        return await self.acoalesced(
+            {'call': "imageGenerator", 'model': self.image_model_name, 'prompt': formatted_prompt, 'size': size, 'save_path': save_path},
+            lambda: self.imageGenerator(prompt, size=size, quality=quality, save_path=save_path, session_id=session_id),
+            follow
+        )
+
+
+    def recordUsage(self, session_id: str = None, response=None, images: int = 0):
+        """
+        Charge the tokens of a completion response, or generated images, to a session.
+
+        Args:
+            session_id: The session to charge, the session of the running request if None
+            response: The completion response carrying the token usage
+            images: The number of generated images
+        """
+        if self.budget is None:
+            return
+        usage = getattr(response, "usage", None)
+        self.budget.record(session_id, tokens=getattr(usage, "total_tokens", None) or 0, images=images)
+
+
     def loadOpenAIClient(self) -> OpenAI:
         """
         Load and configure OpenAI Client.
@@ -248,7 +513,10 @@ class ModelCore:
         """
         try:
             logger.info("Initializing OpenAI client...")
-            client = OpenAI(api_key=self.API_TOKEN)
+            if self.transport is not None:
+                client = self.transport.openaiClient(api_key=self.API_TOKEN)
+            else:
+                client = OpenAI(api_key=self.API_TOKEN)
             logger.info("OpenAI client initialized successfully")
             return client
         except Exception as e:
@@ -0,0 +1,264 @@
+from src.core.logging_config import setup_logging
+
+from contextlib import contextmanager
+import cProfile
+import json
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+import logging
+
+# Get logger for this module
+logger = logging.getLogger(__name__)
+
+MODES = ("sampling", "cprofile")
+
+# The profile of the request running in each thread, read by the database hooks, and whether
+# sampling was already decided for it
+_local = threading.local()
+
+
+def activeProfile() -> "ProfileSession":
+    """The profile of the request running in this thread, None if it isn't profiled."""
+    return getattr(_local, "session", None)
+
+
+class StackSampler:
+    """
+    Samples the stack of one thread from a background thread every `interval` seconds. Unlike
+    cProfile, the profiled code runs untouched, so the overhead stays low enough for production.
+    """
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.frames = {}
+        self.samples = []
+        self.weights = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.sample, name="profiler-sampler", daemon=True)
+
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self._thread.start()
+
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.end_time = time.perf_counter()
+
+
+    def sample(self):
+        last = time.perf_counter()
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            now = time.perf_counter()
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(self.frames.setdefault((code.co_name, code.co_filename, code.co_firstlineno), len(self.frames)))
+                frame = frame.f_back
+            stack.reverse()
+            self.samples.append(stack)
+            self.weights.append(now - last)
+            last = now
+
+
+    def speedscope(self, name: str) -> dict:
+        """The samples as a speedscope file, see https://www.speedscope.app/file-format-schema.json"""
+        return {
+            '$schema': "https://www.speedscope.app/file-format-schema.json",
+            'name': name,
+            'exporter': "ArtBuddy",
+            'shared': {'frames': [{'name': frame[0], 'file': frame[1], 'line': frame[2]} for frame in self.frames]},
+            'profiles': [{
+                'type': "sampled",
+                'name': name,
+                'unit': "seconds",
+                'startValue': 0,
+                'endValue': self.end_time - self.start_time,
+                'samples': self.samples,
+                'weights': self.weights
+            }]
+        }
+
+
+class ProfileSession:
+    """The profile of one request: its CPU profile, its database calls and its memory snapshot."""
+    def __init__(self, name: str, request_id: str):
+        self.name = name
+        self.request_id = request_id
+        self.database = {}
+
+
+    def recordDatabaseCall(self, method: str, lock_wait: float, duration: float):
+        """Account one DatabaseCore call: the time waiting for the connection lock and the time running."""
+        calls = self.database.setdefault(method, {'calls': 0, 'lock_wait': 0.0, 'time': 0.0})
+        calls['calls'] += 1
+        calls['lock_wait'] += lock_wait
+        calls['time'] += duration
+
+
+class Profiler:
+    def __init__(self, verbose: bool,
+                       enabled: bool = False,
+                       mode: str = "sampling",
+                       sample_rate: float = 0.01,
+                       interval: float = 0.01,
+                       memory: bool = False,
+                       output_path: str = "data/profiles"):
+        """
+        Initialize the Profiler class.
+
+        Profiles requests on demand (profile=True on a request) or, when enabled, a random
+        sample_rate share of all requests. Each profiled request writes, named after its request id:
+            - its CPU profile: a speedscope file in "sampling" mode, low overhead enough to stay on
+              in production, or a pstats file in "cprofile" mode, exact but several times slower
+            - a summary with its duration, its DatabaseCore calls (count, lock wait, time) and,
+              with memory, the top allocations of a tracemalloc snapshot and the snapshot itself
+
+        Args:
+            verbose: Whether to enable verbose logging.
+            enabled: Whether requests are sampled without being asked to.
+            mode: "sampling" or "cprofile".
+            sample_rate: The share of requests profiled when enabled, between 0 and 1.
+            interval: The seconds between two stack samples in "sampling" mode.
+            memory: Whether to trace memory allocations. tracemalloc slows every allocation of the
+                process while a profiled request runs, keep it for investigations.
+            output_path: The directory of the profile files.
+        """
+        if mode not in MODES:
+            raise ValueError(f"Unknown profiling mode {mode}, must be one of {MODES}")
+        self.enabled = enabled
+        self.mode = mode
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.memory = memory
+        self.output_path = output_path
+        self.verbose = verbose
+        setup_logging(verbose=verbose)
+
+        self._memory_lock = threading.Lock()
+        self._memory_users = 0
+        if enabled:
+            logger.info(f"Profiling {sample_rate:.1%} of requests in {mode} mode to {output_path}")
+
+
+    def shouldProfile(self, force: bool = False) -> bool:
+        """Whether a new request is profiled."""
+        return force or (self.enabled and random.random() < self.sample_rate)
+
+
+    @contextmanager
+    def profile(self, name: str, request_id: str = None, force: bool = False):
+        """
+        Profile the block if it is sampled or forced. Blocks nested in a profiled one (e.g. the
+        agent run of a profiled request) are part of its profile. Only the outermost block is
+        sampled: blocks nested in one that wasn't sampled aren't profiled unless forced, so the
+        sample rate stays per request.
+
+        Args:
+            name: The name of the profiled operation, e.g. "run" or "runAgent".
+            request_id: The id of the request, used to name the files. Generated if None.
+            force: Whether to profile regardless of sampling.
+
+        Yields:
+            ProfileSession: The profile of the request, None if it isn't profiled.
+        """
+        current = activeProfile()
+        if current is not None or (getattr(_local, "sampled", False) and not force):
+            yield current
+            return
+        if not self.shouldProfile(force):
+            _local.sampled = True
+            try:
+                yield None
+            finally:
+                _local.sampled = False
+            return
+
+        session = ProfileSession(name, request_id or uuid.uuid4().hex[:12])
+        profiler = sampler = None
+        if self.mode == "cprofile":
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # Another profiler is active, only the summary is recorded
+                logger.warning(f"cProfile busy, request {session.request_id} not CPU profiled")
+                profiler = None
+        else:
+            sampler = StackSampler(threading.get_ident(), self.interval)
+            sampler.start()
+        if self.memory:
+            self.startMemory()
+
+        _local.session = session
+        start = time.perf_counter()
+        try:
+            yield session
+        finally:
+            duration = time.perf_counter() - start
+            _local.session = None
+            if profiler is not None:
+                profiler.disable()
+            if sampler is not None:
+                sampler.stop()
+            snapshot = self.stopMemory() if self.memory else None
+            try:
+                self.write(session, duration, profiler, sampler, snapshot)
+            except OSError as e:
+                logger.error(f"Error writing the profile of request {session.request_id}: {str(e)}")
+
+
+    def startMemory(self):
+        with self._memory_lock:
+            if self._memory_users == 0 and not tracemalloc.is_tracing():
+                tracemalloc.start(10)
+            self._memory_users += 1
+
+
+    def stopMemory(self) -> tracemalloc.Snapshot:
+        with self._memory_lock:
+            snapshot = tracemalloc.take_snapshot()
+            self._memory_users -= 1
+            if self._memory_users == 0:
+                tracemalloc.stop()
+            return snapshot
+
+
+    def write(self, session: ProfileSession, duration: float, profiler: cProfile.Profile = None, sampler: StackSampler = None, snapshot: tracemalloc.Snapshot = None):
+        """Write the profile files of a request."""
+        os.makedirs(self.output_path, exist_ok=True)
+        prefix = os.path.join(self.output_path, f"{session.request_id}-{session.name}")
+
+        if profiler is not None:
+            profiler.dump_stats(f"{prefix}.pstats")
+        if sampler is not None:
+            with open(f"{prefix}.speedscope.json", "w") as f:
+                json.dump(sampler.speedscope(f"{session.name} {session.request_id}"), f)
+
+        summary = {
+            'request_id': session.request_id,
+            'name': session.name,
+            'duration': duration,
+            'database': session.database
+        }
+        if snapshot is not None:
+            snapshot.dump(f"{prefix}.tracemalloc")
+            summary['memory'] = [
+                {'location': str(stat.traceback[0]), 'size': stat.size, 'count': stat.count}
+                for stat in snapshot.statistics("lineno")[:20]
+            ]
+        with open(f"{prefix}.summary.json", "w") as f:
+            json.dump(summary, f, indent=2)
+
+        database_time = sum(calls['time'] + calls['lock_wait'] for calls in session.database.values())
+        logger.info(f"Request {session.request_id} profiled: {duration:.2f}s, {database_time:.2f}s in the database, written to {prefix}.*")
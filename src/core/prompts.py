@@ -1,29 +1,166 @@
+from src.core.utils import Utils
+
+from typing import Callable
+import textwrap
+import logging
+
+# Get logger for this module
+logger = logging.getLogger(__name__)
+
+class PromptTemplate:
+    def __init__(self, task: str, instructions: str, body: str, prepare: Callable[[object, str], dict]):
+        """
+        A prompt template compiled once at import time.
+
+        The static instructions always come first and the request specific body last, so every
+        prompt of a task shares the same prefix and benefits from provider-side prefix caching.
+
+        Args:
+            task: The task the template formats prompts for.
+            instructions: The static instructions of the template.
+            body: The variable part of the template, with str.format fields.
+            prepare: Maps the (prompt, image_path) given to promptFormatter to the body fields.
+        """
+        self.task = task
+        self.instructions = textwrap.dedent(instructions).strip()
+        self.body = textwrap.dedent(body).strip()
+        self.prepare = prepare
+        self.static_tokens = Utils.countTokens(self.instructions)
+
+
+    def render(self, prompt, image_path: str = None) -> str:
+        return f"{self.instructions}\n\n{self.body.format(**self.prepare(prompt, image_path))}"
+
+
+def _text(prompt) -> str:
+    """A plain string prompt is the user's text, a list holds it as its first element."""
+    return prompt if isinstance(prompt, str) else prompt[0]
+
+
+def _conversations(prompt) -> str:
+    """Join the text column of conversation rows ([role, text, ...]) in linear time."""
+    return "\n".join(str(row[1]) for row in prompt if len(row) > 1 and row[1] is not None)
+
+
+TEMPLATES = {
+    template.task: template for template in [
+        PromptTemplate(
+            task="sumUpIdeas",
+            instructions="""
+            Following is a long conversation that we had together about how to be a good designer. You, now, as a smart summarizer and designer,
+            are responsible for creating a short summary of all the very important ideas that are mentioned in the following conversations.
+            Avoid being verbose, rather focus on keeping all the ideas and explaining them very shortly. The important part for you is
+            to mention all the ideas and summarize them perfectly.
+            """,
+            body="""
+            Here are the conversations:
+            {conversations}
+            """,
+            prepare=lambda prompt, image_path: {'conversations': _conversations(prompt)}
+        ),
+        PromptTemplate(
+            task="generatingImageWithIdeas",
+            instructions="""
+            You are a designer. You are given a prompt and an idea. You need to generate an image based on the prompt and the idea.
+            """,
+            body="""
+            Here is the prompt: {prompt}
+            Here is the idea: {idea}
+            """,
+            prepare=lambda prompt, image_path: {'prompt': prompt[0], 'idea': prompt[1]}
+        ),
+        PromptTemplate(
+            task="chattingImage",
+            instructions="""
+            You are a designer. You are given a prompt and an image. You need to analyze the image and provide a response to the prompt.
+            """,
+            body="""
+            Here is the prompt: {prompt}
+            Here is the image: {image_path}
+            """,
+            prepare=lambda prompt, image_path: {'prompt': _text(prompt), 'image_path': image_path}
+        ),
+        PromptTemplate(
+            task="chattingImageAgent",
+            instructions="""
+            You are a designer. You are given a prompt and an image. You need to analyze the image and provide a response to the prompt.
+            """,
+            body="""
+            Here is the prompt: {prompt}
+            Here is the image: {image_path}
+            """,
+            prepare=lambda prompt, image_path: {'prompt': _text(prompt), 'image_path': image_path}
+        ),
+        PromptTemplate(
+            task="agentImageAnalysis",
+            instructions="""
+            You are an AI assistant that can analyze images. You have access to an image analysis tool and a color and composition tool.
+
+            To analyze the image, you should:
+            1. Use the color_composition tool for measurable facts (palette, values, contrast, saturation, balance, rule of thirds), it is fast and free
+            2. Use the image_analysis tool with the image path and the user's question only for what the measurements can't tell (subject, style, meaning)
+            3. Use those results to provide a helpful response to the user's question, citing the measurements
+
+            Remember to:
+            - Be specific about what you see in the image
+            - Address the user's question directly
+            - Provide insights and explanations based on the image analysis
+            - Defend your answer
+            """,
+            body="""
+            The user has provided an image at this path: {image_path}
+            Their question about the image is: {prompt}
+            """,
+            prepare=lambda prompt, image_path: {'prompt': _text(prompt), 'image_path': image_path}
+        ),
+        PromptTemplate(
+            task="summarizeSession",
+            instructions="""
+            You are keeping the memory of a long conversation between a user and an art assistant.
+            Merge the previous summary and the new turns into one short summary that keeps every fact, preference,
+            decision and open question the assistant needs to continue the conversation. Avoid being verbose.
+            """,
+            body="""
+            Here is the previous summary: {summary}
+            Here are the new turns:
+            {turns}
+            """,
+            prepare=lambda prompt, image_path: {'summary': prompt[0], 'turns': prompt[1]}
+        ),
+        PromptTemplate(
+            task="agentWithHistory",
+            instructions="""
+            You are continuing a conversation with the user. Use the conversation so far as context for the new request.
+            """,
+            body="""
+            Here is the conversation you had with the user so far:
+            {history}
+
+            Here is the user's new request: {request}
+            """,
+            prepare=lambda prompt, image_path: {'history': prompt[0], 'request': prompt[1]}
+        ),
+    ]
+}
 
 
 class Prompts:
     def __init__(self):
-        pass
+        self.templates = TEMPLATES
 
 
     def agentPromptTemplate(self, image_path: str, prompt: str):
-        self.agentPromptTemplate = f"""
-        You are an AI assistant that can analyze images. You have access to an image analysis tool.
-
-        The user has provided an image at this path: {image_path}
-        Their question about the image is: {prompt}
-
-        To analyze the image, you should:
-        1. Use the image_analysis tool with the image path and the user's question
-        2. The tool will return an analysis of the image
-        3. Use that analysis to provide a helpful response to the user's question
-
-        Remember to:
-        - Be specific about what you see in the image
-        - Address the user's question directly
-        - Provide insights and explanations based on the image analysis
-        - Defend your answer
         """
-        return self.agentPromptTemplate
+        Build the prompt instructing the agent to analyze an image with the image analysis tool.
+
+        Args:
+            image_path: The path to the image to analyze
+            prompt: The user's question about the image
+
+        Returns:
+            str: The agent prompt
+        """
+        return self.templates["agentImageAnalysis"].render(prompt, image_path)
 
 
     def promptFormatter(self, task: str, prompt: [str], image_path: str = None) -> str:
@@ -36,39 +173,25 @@ class Prompts:
             image_path: The path to the image to analyze
 
         Returns:
-            str: The formatted prompt
+            str: The formatted prompt, unchanged for tasks without a template, and the original prompt
         """
         original_prompt = prompt
 
-        if task == "sumUpIdeas":
-            all_conversations = ""
-            for conversation in prompt[0]:
-                all_conversations += f"{conversation[1]}\n"
-            
-            prompt = f"""
-            Following is a long conversation that we had together about how to be a good designer. You, now, as a smart summarizer and designer,
-            are responsible for creating a short summary of all the very important ideas that are mentioned in the following conversations.
-            Avoid being verbose, rather focus on keeping all the ideas and explaining them very shortly. The important part for you is 
-            to mention all the ideas and summarize them perfectly.Here are the conversations: {all_conversations}
-            """
-        elif task == "generatingImageWithIdeas":
-            prompt = f"""
-            You are a designer. You are given a prompt and an idea. You need to generate an image based on the prompt and the idea.
-            Here is the prompt: {prompt[0]}
-            Here is the idea: {prompt[1]}
-            """
-        elif task == "chattingImage":
-            prompt = f"""
-            You are a designer. You are given a prompt and an image. You need to analyze the image and provide a response to the prompt.
-            Here is the prompt: {prompt[0]}
-            Here is the image: {image_path}
-            """
-            
-        elif task == "chattingImageAgent":
-            prompt = f"""
-            You are a designer. You are given a prompt and an image. You need to analyze the image and provide a response to the prompt.
-            Here is the prompt: {prompt[0]}
-            Here is the image: {image_path}
-            """
-            
-        return prompt, original_prompt
\ No newline at end of file
+        template = self.templates.get(task)
+        if template is None:
+            return prompt, original_prompt
+
+        prompt = template.render(prompt, image_path)
+        logger.debug(f"Prompt {task}: {template.static_tokens} static tokens, {Utils.countTokens(prompt) - template.static_tokens} variable tokens")
+        return prompt, original_prompt
+
+
+    def templateTokenCounts(self) -> dict[str, int]:
+        """
+        Return the estimated number of tokens of the static instructions of every template,
+        which is the part of each prompt providers can serve from their prefix cache.
+
+        Returns:
+            dict[str, int]: The number of static tokens per task
+        """
+        return {task: template.static_tokens for task, template in self.templates.items()}
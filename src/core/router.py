@@ -0,0 +1,143 @@
+from src.core.database import DatabaseCore
+from src.core.logging_config import setup_logging
+
+from collections import deque
+import statistics
+import threading
+import re
+import logging
+
+# Get logger for this module
+logger = logging.getLogger(__name__)
+
+# Cues that a prompt needs the agent's tools, with their weight. A prompt is routed to the agent
+# when its score reaches the threshold
+AGENT_CUES = [
+    # Fresh or external information only the Web Agent can get
+    (1.0, re.compile(r"\b(search|look(ing)? up|google|browse|latest|recent(ly)?|news|today|currently|this (week|month|year)|up[- ]to[- ]date|upcoming|exhibitions?|websites?|online|sources?|cite|citations?|references?)\b", re.IGNORECASE)),
+    (1.0, re.compile(r"https?://|www\.", re.IGNORECASE)),
+    (1.0, re.compile(r"\b20[2-9]\d\b")),
+    # Multi-step work the manager plans
+    (0.5, re.compile(r"\b(research|investigate|compare|comparison|step[- ]by[- ]step|and then|find (me )?(some |a few )?(examples|artists|galleries|museums|works)|list (of|all))\b", re.IGNORECASE)),
+    # Analyses the image tools go deeper on
+    (0.5, re.compile(r"\b(analy[sz]e|composition|color theory|palette|in depth|detailed)\b", re.IGNORECASE)),
+]
+
+ROUTES = ("model", "agent")
+
+
+class ModeRouter:
+    def __init__(self, database: DatabaseCore, verbose: bool, threshold: float = 1.0, history: int = 200):
+        """
+        Initialize the ModeRouter class.
+
+        Decides, for requests made with agent_mode="auto", whether a prompt is answered by a direct
+        model call or by the agent. Prompts are scored with cheap local heuristics (cues of web
+        search, multi-step work, deep image analysis, long multi-question prompts), and the recent
+        latency of each route, persisted in the `routing` table, is used to honor a per-request
+        latency SLO.
+
+        Args:
+            database: The database where routing decisions and their latency are persisted.
+            verbose: Whether to enable verbose logging.
+            threshold: The score from which a prompt is routed to the agent.
+            history: The number of recent latencies kept per mode and route.
+        """
+        self.database = database
+        self.threshold = threshold
+        self.history = history
+        self.verbose = verbose
+        setup_logging(verbose=verbose)
+
+        self._lock = threading.Lock()
+        # (mode, route) -> recent latencies in seconds
+        self.latencies = {}
+        for (mode, route), latencies in self.database.route_latency_retriever(limit=history).items():
+            self.latencies[(mode, route)] = deque(latencies, maxlen=history)
+        logger.info(f"Mode router loaded with the latency of {sum(len(latencies) for latencies in self.latencies.values())} requests")
+
+
+    def score(self, mode: str, user_prompt: str) -> tuple[float, list[str]]:
+        """
+        Score how much a prompt needs the agent.
+
+        Args:
+            mode: The mode of the request.
+            user_prompt: The prompt of the user.
+
+        Returns:
+            tuple[float, list[str]]: The score and the cues found.
+        """
+        prompt = user_prompt or ""
+        score, cues = 0.0, []
+        for weight, pattern in AGENT_CUES:
+            match = pattern.search(prompt)
+            if match:
+                score += weight
+                cues.append(match.group(0).lower())
+
+        # Long prompts with several questions are usually several tasks
+        if prompt.count("?") >= 2:
+            score += 0.5
+            cues.append("several questions")
+        if len(prompt.split()) > 80:
+            score += 0.5
+            cues.append("long prompt")
+        return score, cues
+
+
+    def median(self, mode: str, route: str) -> float:
+        """The median latency of a route for a mode, None without history."""
+        with self._lock:
+            latencies = list(self.latencies.get((mode, route), ()))
+        return statistics.median(latencies) if latencies else None
+
+
+    def route(self, mode: str, user_prompt: str, latency_slo: float = None) -> dict:
+        """
+        Choose the route of a request.
+
+        Args:
+            mode: The mode of the request.
+            user_prompt: The prompt of the user.
+            latency_slo: The latency in seconds the request should be answered within, if any. The
+                agent is skipped when it is usually slower, unless the prompt clearly needs its tools.
+
+        Returns:
+            dict: The decision, with whether the agent runs, the score and the reason.
+        """
+        # Image generation has no agent route
+        if mode == "generatingImage":
+            return {'agent': False, 'score': 0.0, 'reason': "image generation"}
+
+        score, cues = self.score(mode, user_prompt)
+        agent = score >= self.threshold
+        reason = f"cues: {', '.join(cues)}" if cues else "no cue of tool use"
+
+        if agent and latency_slo is not None:
+            agent_median = self.median(mode, "agent")
+            # Prompts scoring twice the threshold likely can't be answered without the tools
+            if agent_median is not None and agent_median > latency_slo and score < 2 * self.threshold:
+                agent = False
+                reason += f"; agent median {agent_median:.1f}s over the {latency_slo:.1f}s SLO"
+
+        decision = {'agent': agent, 'score': score, 'reason': reason}
+        logger.info(f"Routed {mode} request to the {ROUTES[agent]} (score {score:.1f}, {reason})")
+        return decision
+
+
+    def record(self, mode: str, agent: bool, latency: float, auto: bool = False, score: float = None):
+        """
+        Record the latency of a request, so the router learns the latency of each route.
+
+        Args:
+            mode: The mode of the request.
+            agent: Whether the request ran the agent.
+            latency: The latency of the request in seconds.
+            auto: Whether the route was chosen by the router.
+            score: The score of the prompt, when the router chose the route.
+        """
+        route = ROUTES[agent]
+        with self._lock:
+            self.latencies.setdefault((mode, route), deque(maxlen=self.history)).append(latency)
+        self.database.route_saver(mode, route, latency, auto=auto, score=score)
@@ -4,92 +4,207 @@ from src.core.database import DatabaseCore
 from src.core.utils import Utils
 from src.core.logging_config import setup_logging
 from src.core.prompts import Prompts
-
+from src.core.session_memory import SessionMemory
+from src.core.budget import BudgetController
+from src.core.job_queue import JobQueue
+from src.core.router import ModeRouter
+from src.core.profiling import Profiler
+
+from contextlib import nullcontext
+from typing import Callable
+import hashlib
+import json
+import time
 import logging
-from datetime import datetime
 
 # Get logger for this module
 logger = logging.getLogger(__name__)
 
 class Runner:
-    def __init__(self, model: ModelCore, agent: AgentCore, database: DatabaseCore, utils: Utils, prompts: Prompts, verbose: bool):
+    def __init__(self, model: ModelCore, agent: AgentCore, database: DatabaseCore, utils: Utils, prompts: Prompts, verbose: bool, session_memory: SessionMemory=None, budget: BudgetController=None, job_queue: JobQueue=None, router: ModeRouter=None, profiler: Profiler=None, image_queue: JobQueue=None):
         self.model = model
         self.agent = agent
         self.database = database
         self.utils = utils
         self.prompts = prompts
+        self.session_memory = session_memory or SessionMemory(model=model, database=database, utils=utils, prompts=prompts, verbose=verbose)
+        self.budget = budget or BudgetController(database=database, verbose=verbose)
+        self.job_queue = job_queue
+        self.image_queue = image_queue
+        self.router = router or ModeRouter(database=database, verbose=verbose)
+        self.profiler = profiler or Profiler(verbose=verbose)
 
         self.verbose = verbose
         setup_logging(verbose=verbose)
 
 
-    def run(self, mode: str, agent_mode: bool=False, user_prompt: str=None, use_ideas: bool=False, img_path: str=None):
+    def run(self, mode: str, agent_mode: bool | str=False, user_prompt: str=None, use_ideas: bool=False, img_path: str=None, session_id: str=None, latency_slo: float=None, request_id: str=None, profile: bool=False, stream: bool=False):
+        """
+        Run a request.
+
+        Args:
+            mode: "chatting", "chattingImage" or "generatingImage".
+            agent_mode: Whether the agent answers the request, or "auto" to let the router decide from the prompt.
+            user_prompt: The prompt of the user.
+            use_ideas: Whether image generation uses the last summarized ideas.
+            img_path: The image of a chattingImage request.
+            session_id: The session making the request.
+            latency_slo: With agent_mode="auto", the latency in seconds the request should be answered within.
+            request_id: The id of the request, naming its profile files.
+            profile: Whether to profile the request, regardless of the profiler's sampling.
+            stream: Whether to return an iterator over the events of the request (plan, tool calls,
+                steps, partial answers, final answer) as they happen instead of the result, see AgentCore.stream.
+        """
+        if stream:
+            return self.agent.stream(lambda: self.run(mode, agent_mode, user_prompt, use_ideas, img_path, session_id, latency_slo, request_id, profile))
+
+        with self.profiler.profile("run", request_id=request_id, force=profile):
+            return self.runRequest(mode, agent_mode, user_prompt, use_ideas, img_path, session_id, latency_slo)
+
+
+    def astream(self, mode: str, agent_mode: bool | str=False, user_prompt: str=None, use_ideas: bool=False, img_path: str=None, session_id: str=None, latency_slo: float=None, request_id: str=None, profile: bool=False):
+        """Async iterator over the events of a request, see run with stream=True."""
+        return self.agent.astream(lambda: self.run(mode, agent_mode, user_prompt, use_ideas, img_path, session_id, latency_slo, request_id, profile))
+
+
+    def submitGeneratingImage(self, user_prompt: str, use_ideas: bool=False, session_id: str=None, callback: Callable[[dict], None]=None) -> int:
+        """
+        Queue an image generation and return at once, instead of holding the caller for the whole
+        generation, download and save. The job runs the same request as run(mode="generatingImage")
+        on a worker of the image queue, and its result is the path of the saved image.
+
+        Args:
+            user_prompt: The prompt of the user.
+            use_ideas: Whether image generation uses the last summarized ideas.
+            session_id: The session making the request.
+            callback: Called with the job once it is done or has failed.
+
+        Returns:
+            int: The id of the job, to poll with image_queue.status() or wait for with image_queue.wait().
+                Identical requests still queued or running share one job.
+        """
+        if self.image_queue is None:
+            raise ValueError("Image generation jobs need an image queue")
+        payload = {'user_prompt': user_prompt, 'use_ideas': use_ideas, 'session_id': session_id}
+        dedup_key = "generatingImage:" + hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+        return self.image_queue.submit("generatingImage", payload=payload, priority="normal", dedup_key=dedup_key, callback=callback)
+
+
+    def runRequest(self, mode: str, agent_mode: bool | str=False, user_prompt: str=None, use_ideas: bool=False, img_path: str=None, session_id: str=None, latency_slo: float=None):
+        """Route, admit and dispatch a request, see run."""
+        decision = None
+        if agent_mode == "auto":
+            decision = self.router.route(mode, user_prompt, latency_slo=latency_slo)
+            agent_mode = decision['agent']
+            self.agent.emit("routed", route="agent" if agent_mode else "model", reason=decision['reason'])
+
+        # Admit the request against the session's budget, possibly degrading it to direct model mode
+        admission = self.admit(mode, agent_mode, user_prompt, session_id)
+        if admission['degraded']:
+            agent_mode = False
+
+        # Background jobs wait while the request runs
+        interactive = self.job_queue.interactive() if self.job_queue is not None else nullcontext()
+        with interactive, self.budget.charge(session_id, admission):
+            start = time.perf_counter()
+            result = self.dispatch(mode, agent_mode, user_prompt, use_ideas, img_path, session_id)
+            self.router.record(mode, agent_mode, time.perf_counter() - start, auto=decision is not None, score=decision['score'] if decision else None)
+            return result
+
+
+    def admit(self, mode: str, agent_mode: bool, user_prompt: str, session_id: str=None) -> dict:
+        """
+        Estimate the cost of a request and admit it against the session's budget.
+
+        Raises:
+            BudgetExceededError: If the session is over budget.
+        """
+        if mode == "generatingImage":
+            return self.budget.admit(session_id, images=1)
+
+        tokens = self.budget.estimateTokens(
+            prompt_tokens=self.utils.countTokens(user_prompt),
+            history_tokens=self.session_memory.token_budget,
+            image=mode == "chattingImage"
+        )
+        if agent_mode:
+            return self.budget.admit(session_id, tokens=tokens * self.budget.agent_factor, fallback_tokens=tokens)
+        return self.budget.admit(session_id, tokens=tokens)
+
+
+    def dispatch(self, mode: str, agent_mode: bool=False, user_prompt: str=None, use_ideas: bool=False, img_path: str=None, session_id: str=None):
         if mode == "chatting" and agent_mode:
-            return self.chattingAgent(user_prompt)
+            return self.chattingAgent(user_prompt, session_id)
         elif mode == "chatting" and not agent_mode:
-            return self.chattingModel(user_prompt)
+            return self.chattingModel(user_prompt, session_id)
         elif mode == "chattingImage" and agent_mode:
-            return self.chattingImageAgent(user_prompt, img_path)
+            return self.chattingImageAgent(user_prompt, img_path, session_id)
         elif mode == "chattingImage" and not agent_mode:
-            return self.chattingImageModel(user_prompt, img_path)
+            return self.chattingImageModel(user_prompt, img_path, session_id)
         elif mode == "generatingImage" and use_ideas:
-            return self.generatingImageWithIdeas(user_prompt)
+            return self.generatingImageWithIdeas(user_prompt, session_id)
         elif mode == "generatingImage" and not use_ideas:
-            return self.generatingImage(user_prompt)
+            return self.generatingImage(user_prompt, session_id)
 
 
-    def generatingImageWithIdeas(self, user_prompt: str):
+    def generatingImageWithIdeas(self, user_prompt: str, session_id: str=None):
         """
         Run the model directly for generating image.
         """
-        # Retrieve the last idea
-        retriever = self.database.idea_retriever(num_rows=1)
-        last_idea = retriever[0]['ideas'][0]
+        # The most recent idea, least used first so successive images go through the last summary
+        ideas = self.database.idea_top_retriever(limit=1, order_by="recent")
+        if not ideas:
+            logger.warning("No idea saved yet, generating the image from the prompt only")
+            return self.generatingImage(user_prompt, session_id)
+        self.database.idea_use_saver([ideas[0]['id']])
 
-        processed_prompt, _ = self.prompts.promptFormatter(task="generatingImageWithIdeas", prompt=[user_prompt, last_idea])
+        processed_prompt, _ = self.prompts.promptFormatter(task="generatingImageWithIdeas", prompt=[user_prompt, ideas[0]['idea']])
 
         # Run the model
-        return self.model.imageGenerator(processed_prompt)
+        return self.model.imageGenerator(processed_prompt, session_id=session_id)
 
 
-    def generatingImage(self, user_prompt: str):
+    def generatingImage(self, user_prompt: str, session_id: str=None):
         """
         Run the model directly for generating image.
         """
         logger.info("Running model")
-        return self.model.imageGenerator(user_prompt)
+        return self.model.imageGenerator(user_prompt, session_id=session_id)
 
 
-    def chattingImageAgent(self, user_prompt: str, img_path: str):
+    def chattingImageAgent(self, user_prompt: str, img_path: str, session_id: str=None):
         """
         Run the agent for chatting image.
         """
         logger.info("Running agent")
-        return self.agent.runImageAgent(user_prompt, img_path)
+        history = self.session_memory.buildContext(session_id)
+        return self.agent.runImageAgent(user_prompt, img_path, history=history, session_id=session_id)
 
 
-    def chattingImageModel(self, user_prompt: str, img_path: str):
+    def chattingImageModel(self, user_prompt: str, img_path: str, session_id: str=None):
         """
         Run the model directly for chatting image.
         """
         logger.info("Running model")
-        return self.model.chattingImage(user_prompt, img_path)
+        return self.model.chattingImage(user_prompt, img_path, session_id=session_id)
 
 
-    def chattingAgent(self, user_prompt: str):
+    def chattingAgent(self, user_prompt: str, session_id: str=None):
         """
         Run the agent for chatting.
         """
         logger.info("Running agent")
-        return self.agent.runAgent(user_prompt, [])
+        history = self.session_memory.buildContext(session_id)
+        return self.agent.runAgent(user_prompt, history, session_id=session_id)
 
 
-    def chattingModel(self, user_prompt: str):
+    def chattingModel(self, user_prompt: str, session_id: str=None):
         """
         Run the model directly for chatting.
         """
         logger.info("Running model")
-        return self.model.chatting(user_prompt)
+        history = self.session_memory.buildContext(session_id)
+        return self.model.chatting(user_prompt, history=history, session_id=session_id)
 
 
     def sumUpIdeas(self, top_k: int=100, exclude_image: bool=True):
@@ -106,11 +221,6 @@ class Runner:
         model_summarized_ideas = self.model.chatting(prompt_with_conversations)
         
         # Save the prompt to the database
-        self.database.idea_saver(
-            data={
-                'date': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                'idea': model_summarized_ideas
-            },
-            data_table='ideas')
+        self.database.idea_saver(data=model_summarized_ideas, data_table='ideas')
         return model_summarized_ideas
         
\ No newline at end of file
@@ -0,0 +1,126 @@
+from src.core.model import ModelCore
+from src.core.database import DatabaseCore
+from src.core.utils import Utils
+from src.core.prompts import Prompts
+from src.core.logging_config import setup_logging
+
+import logging
+
+# Get logger for this module
+logger = logging.getLogger(__name__)
+
+class SessionMemory:
+    def __init__(self, model: ModelCore,
+                       database: DatabaseCore,
+                       utils: Utils,
+                       prompts: Prompts,
+                       verbose: bool,
+                       token_budget: int = 2000,
+                       summary_budget: int = 400):
+        """
+        Initialize the SessionMemory class.
+
+        The context of a session is made of a rolling summary of its older turns followed by its
+        most recent turns verbatim, and never exceeds token_budget tokens. The summary is cached in
+        the database and only extended when recent turns overflow the budget.
+
+        Args:
+            model: The model used to compact older turns.
+            database: The database holding the conversations and summaries.
+            utils: The utils used to count tokens.
+            prompts: The prompts to use.
+            verbose: Whether to enable verbose logging.
+            token_budget: The maximum number of tokens of the context window.
+            summary_budget: The number of tokens reserved for the rolling summary.
+        """
+        self.model = model
+        self.database = database
+        self.utils = utils
+        self.prompts = prompts
+        self.token_budget = token_budget
+        self.summary_budget = min(summary_budget, token_budget // 2)
+        self.verbose = verbose
+        setup_logging(verbose=verbose)
+
+
+    def buildContext(self, session_id: str) -> list[dict]:
+        """
+        Build the token-bounded context window of a session.
+
+        Args:
+            session_id: The session to build the context of.
+
+        Returns:
+            list[dict]: Chat messages ready to be sent before the new prompt.
+        """
+        if session_id is None:
+            return []
+
+        cached = self.database.session_summary_retriever(session_id) or {'summary': "", 'last_conversation_id': 0}
+        turns = self.database.session_retriever(session_id, after_id=cached['last_conversation_id'])
+        turns = [turn for turn in turns if turn[1] in ('user', 'system')]
+
+        recent_budget = self.token_budget - self.summary_budget
+        recent, overflow = self.splitRecent(turns, recent_budget)
+
+        summary = cached['summary']
+        if overflow:
+            # Compact down to half of the budget so the next turns fit without compacting again
+            recent, extra = self.splitRecent(recent, recent_budget // 2)
+            summary = self.compact(session_id, summary, overflow + extra)
+
+        messages = []
+        if summary:
+            messages.append({"role": "system", "content": f"Summary of the earlier conversation: {summary}"})
+        for _, role, text in recent:
+            messages.append({"role": "user" if role == 'user' else "assistant", "content": text})
+
+        logger.info(f"Session {session_id} context: {len(recent)} recent turns, {self.countTokens(messages)} tokens")
+        return messages
+
+
+    def splitRecent(self, turns: list[list], budget: int) -> tuple[list[list], list[list]]:
+        """
+        Split turns into the most recent ones fitting the budget and the older ones.
+
+        Returns:
+            tuple[list, list]: The recent turns and the overflowing older turns, both oldest first.
+        """
+        used = 0
+        start = len(turns)
+        while start > 0:
+            tokens = self.utils.countTokens(turns[start - 1][2])
+            if used + tokens > budget:
+                break
+            used += tokens
+            start -= 1
+        return turns[start:], turns[:start]
+
+
+    def compact(self, session_id: str, summary: str, turns: list[list]) -> str:
+        """
+        Fold turns into the rolling summary of the session and cache the result.
+
+        Args:
+            session_id: The session to compact.
+            summary: The current summary.
+            turns: The turns to fold in, oldest first.
+
+        Returns:
+            str: The new summary.
+        """
+        turns_text = "\n".join(f"{role}: {text}" for _, role, text in turns)
+        formatted_prompt, _ = self.prompts.promptFormatter(task="summarizeSession", prompt=[summary or "None", turns_text])
+
+        logger.info(f"Compacting {len(turns)} turns of session {session_id}")
+        new_summary = self.model.completion(
+            messages=[{"role": "user", "content": formatted_prompt}],
+            max_tokens=self.summary_budget
+        )
+        self.database.session_summary_saver(session_id, summary=new_summary, last_conversation_id=turns[-1][0])
+        return new_summary
+
+
+    def countTokens(self, messages: list[dict]) -> int:
+        """Estimate the number of tokens of a list of messages."""
+        return sum(self.utils.countTokens(message['content']) for message in messages)
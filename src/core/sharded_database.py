@@ -0,0 +1,364 @@
+from src.core.database import DatabaseCore
+from src.core.logging_config import setup_logging
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import bisect
+import hashlib
+import heapq
+import threading
+import sqlite3
+import os
+import logging
+
+# Get logger for this module
+logger = logging.getLogger(__name__)
+
+# Conversation ids of shard k start at k * SHARD_ID_STRIDE so ids stay unique across shards
+SHARD_ID_STRIDE = 10 ** 12
+
+
+class ShardedDatabaseCore(DatabaseCore):
+    def __init__(self, verbose: bool,
+                       database_type: str,
+                       database_path: str,
+                       num_shards: int = 4,
+                       virtual_nodes: int = 64):
+        """
+        Initialize the ShardedDatabaseCore class.
+
+        Every session is stored in its own SQLite shard, picked by consistent hashing of its
+        session_id, so writes of different sessions don't contend on the same file lock. Global
+        data (ideas, spans outside of turns) lives on shard 0, and global reads are merged across shards.
+
+        Args:
+            verbose: Whether to enable verbose logging.
+            database_type: The database type, "sqlite_sharded".
+            database_path: The base path of the shards, e.g. ArtBuddy.db gives ArtBuddy.shard0.db, ...
+            num_shards: The number of shards.
+            virtual_nodes: The number of points of each shard on the hash ring.
+        """
+        self.verbose = verbose
+        setup_logging(verbose=verbose)
+
+        self.database_type = database_type
+        self.database_path = database_path
+        self.num_shards = num_shards
+        self.lock = threading.RLock()
+        self._migrated_tables = set()
+        self._local = threading.local()
+
+        root, extension = os.path.splitext(database_path)
+        self.shards = [
+            DatabaseCore(verbose=verbose, database_type="sqlite", database_path=f"{root}.shard{index}{extension or '.db'}")
+            for index in range(num_shards)
+        ]
+        for index, shard in enumerate(self.shards):
+            self._prepare_shard(shard, index)
+
+        # The primary shard holds global tables and backs self.db for code using the connection directly
+        self.primary = self.shards[0]
+        self.db = self.primary.db
+
+        self._ring = sorted(
+            (self._hash(f"shard-{index}-{node}"), index)
+            for index in range(num_shards)
+            for node in range(virtual_nodes)
+        )
+        self._ring_keys = [point for point, _ in self._ring]
+        logger.info(f"Connected to {num_shards} sqlite shards")
+
+
+    def _prepare_shard(self, shard: DatabaseCore, index: int, data_table: str="conversations"):
+        """Create the conversation table of a shard and seed its id sequence"""
+        with shard.lock:
+            cursor = shard.db.cursor()
+            shard._create_conversation_table(cursor, data_table)
+            cursor.execute(
+                "INSERT INTO sqlite_sequence (name, seq) SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = ?)",
+                (data_table, index * SHARD_ID_STRIDE, data_table)
+            )
+            shard.db.commit()
+
+
+    def _hash(self, key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+    def shard_for(self, session_id: str) -> DatabaseCore:
+        """Return the shard owning a session
+
+        Args:
+            session_id (str): The session, None goes to the shard of the empty key
+
+        Returns:
+            DatabaseCore: The shard of the session
+        """
+        position = bisect.bisect(self._ring_keys, self._hash(session_id or ""))
+        return self.shards[self._ring[position % len(self._ring)][1]]
+
+
+    def shard_for_id(self, conversation_id: int) -> DatabaseCore:
+        """Return the shard owning a conversation row"""
+        return self.shards[conversation_id // SHARD_ID_STRIDE]
+
+
+    def query_shards(self, query: str, params: tuple=()) -> list:
+        """Run a read query on every shard in parallel and concatenate the rows
+
+        Args:
+            query (str): The query to run
+            params (tuple): The query parameters
+
+        Returns:
+            list: The rows of every shard, shard by shard
+        """
+        def run(shard):
+            with shard.lock:
+                try:
+                    return shard.db.execute(query, params).fetchall()
+                except sqlite3.Error as e:
+                    logger.error(f"Error querying shard {shard.database_path}: {e}")
+                    return []
+
+        with ThreadPoolExecutor(max_workers=self.num_shards) as executor:
+            results = list(executor.map(run, self.shards))
+        return [row for rows in results for row in rows]
+
+
+    def stats(self, data_table: str="conversations") -> dict:
+        """Return global statistics of the conversations across shards
+
+        Returns:
+            dict: The number of rows per shard, in total, per role and the number of sessions
+        """
+        per_shard = [row[0] for row in self.query_shards(f"SELECT COUNT(*) FROM {data_table}")]
+        roles = {}
+        for role, count in self.query_shards(f"SELECT role, COUNT(*) FROM {data_table} GROUP BY role"):
+            roles[role] = roles.get(role, 0) + count
+        sessions = self.query_shards(f"SELECT COUNT(DISTINCT session_id) FROM {data_table}")
+        return {
+            'rows': sum(per_shard),
+            'rows_per_shard': per_shard,
+            'rows_per_role': roles,
+            'sessions': sum(row[0] for row in sessions)
+        }
+
+
+    # ---- Session routed writes and reads ---- #
+
+    @contextmanager
+    def turn(self, session_id: str=None):
+        """Open a turn on the shard of the session. Every record and span saved in this thread
+        until the turn ends goes to that shard, including nested saves without a session_id.
+        """
+        turn_shard = getattr(self._local, "turn_shard", None)
+        if turn_shard is not None:
+            with turn_shard.turn(session_id) as current:
+                yield current
+            return
+
+        turn_shard = self.shard_for(session_id)
+        self._local.turn_shard = turn_shard
+        try:
+            with turn_shard.turn(session_id) as current:
+                yield current
+        finally:
+            self._local.turn_shard = None
+
+
+    def conversation_saver(self, data: dict, data_table: str="conversations"):
+        shard = getattr(self._local, "turn_shard", None) or self.shard_for(data.get('session_id'))
+        return shard.conversation_saver(data, data_table=data_table)
+
+
+    def conversation_bulk_saver(self, records: list[dict], id_map: dict=None, data_table: str="conversations"):
+        # A session, with the parents of its records, lives on a single shard
+        id_map = {} if id_map is None else id_map
+        batches = {}
+        for record in records:
+            batches.setdefault(self.shard_for(record.get('session_id')), []).append(record)
+        return sum(shard.conversation_bulk_saver(batch, id_map=id_map, data_table=data_table) for shard, batch in batches.items())
+
+
+    def conversation_streamer(self, batch_size: int=10000, data_table: str="conversations"):
+        # Ids are ranged by shard, so streaming shard after shard keeps them ordered
+        for shard in self.shards:
+            yield from shard.conversation_streamer(batch_size=batch_size, data_table=data_table)
+
+
+    def session_retriever(self, session_id: str, after_id: int=0, data_table: str="conversations"):
+        return self.shard_for(session_id).session_retriever(session_id, after_id=after_id, data_table=data_table)
+
+
+    def session_summary_retriever(self, session_id: str, data_table: str="session_summaries"):
+        return self.shard_for(session_id).session_summary_retriever(session_id, data_table=data_table)
+
+
+    def session_summary_saver(self, session_id: str, summary: str, last_conversation_id: int, data_table: str="session_summaries"):
+        return self.shard_for(session_id).session_summary_saver(session_id, summary, last_conversation_id, data_table=data_table)
+
+
+    def usage_saver(self, session_id: str, tokens: int=0, images: int=0, data_table: str="usage"):
+        return self.shard_for(session_id).usage_saver(session_id, tokens=tokens, images=images, data_table=data_table)
+
+
+    def usage_retriever(self, since: str, data_table: str="usage"):
+        usage = {}
+        for shard in self.shards:
+            usage.update(shard.usage_retriever(since=since, data_table=data_table))
+        return usage
+
+
+    # ---- Global data on the primary shard ---- #
+
+    def idea_retriever(self, num_rows: int=4, data_table: str="ideas"):
+        return self.primary.idea_retriever(num_rows=num_rows, data_table=data_table)
+
+
+    def idea_top_retriever(self, limit: int=10, order_by: str="recent", data_table: str="ideas"):
+        return self.primary.idea_top_retriever(limit=limit, order_by=order_by, data_table=data_table)
+
+
+    def idea_summary_retriever(self, summary_id: int, data_table: str="ideas"):
+        return self.primary.idea_summary_retriever(summary_id, data_table=data_table)
+
+
+    def idea_use_saver(self, idea_ids: list[int], data_table: str="ideas"):
+        return self.primary.idea_use_saver(idea_ids, data_table=data_table)
+
+
+    def idea_saver(self, data: list, data_table: str="ideas"):
+        return self.primary.idea_saver(data, data_table=data_table)
+
+
+    def idea_bulk_saver(self, records: list[dict], data_table: str="ideas"):
+        return self.primary.idea_bulk_saver(records, data_table=data_table)
+
+
+    def idea_streamer(self, batch_size: int=10000, data_table: str="ideas"):
+        return self.primary.idea_streamer(batch_size=batch_size, data_table=data_table)
+
+
+    def image_hash_retriever(self, data_table: str="image_hashes"):
+        return self.primary.image_hash_retriever(data_table=data_table)
+
+
+    def image_hash_saver(self, image_hash: str, image_path: str, prompt: str=None, analysis: str=None, data_table: str="image_hashes"):
+        return self.primary.image_hash_saver(image_hash, image_path, prompt=prompt, analysis=analysis, data_table=data_table)
+
+
+    def route_latency_retriever(self, limit: int=200, data_table: str="routing"):
+        return self.primary.route_latency_retriever(limit=limit, data_table=data_table)
+
+
+    def route_saver(self, mode: str, route: str, latency: float, auto: bool=False, score: float=None, data_table: str="routing"):
+        return self.primary.route_saver(mode, route, latency, auto=auto, score=score, data_table=data_table)
+
+
+    def job_saver(self, kind: str, payload: dict=None, priority: int=10, dedup_key: str=None, run_after: float=0, data_table: str="jobs"):
+        return self.primary.job_saver(kind, payload=payload, priority=priority, dedup_key=dedup_key, run_after=run_after, data_table=data_table)
+
+
+    def job_claimer(self, now: float, max_priority: int=None, kinds: tuple=None, data_table: str="jobs"):
+        return self.primary.job_claimer(now, max_priority=max_priority, kinds=kinds, data_table=data_table)
+
+
+    def job_updater(self, job_id: int, status: str, error: str=None, run_after: float=None, result=None, data_table: str="jobs"):
+        return self.primary.job_updater(job_id, status, error=error, run_after=run_after, result=result, data_table=data_table)
+
+
+    def job_recoverer(self, kinds: tuple=None, data_table: str="jobs"):
+        return self.primary.job_recoverer(kinds=kinds, data_table=data_table)
+
+
+    def job_retriever(self, job_id: int, data_table: str="jobs"):
+        return self.primary.job_retriever(job_id, data_table=data_table)
+
+
+    def job_depth_retriever(self, kinds: tuple=None, data_table: str="jobs"):
+        return self.primary.job_depth_retriever(kinds=kinds, data_table=data_table)
+
+
+    def span_saver(self, spans: list[dict], data_table: str="spans"):
+        # Spans of a turn are stored next to the conversation rows they are linked to
+        shard = getattr(self._local, "turn_shard", None) or self.primary
+        return shard.span_saver(spans, data_table=data_table)
+
+
+    def span_retriever(self, trace_id: str=None, conversation_id: int=None, data_table: str="spans"):
+        if conversation_id is not None:
+            return self.shard_for_id(conversation_id).span_retriever(trace_id=trace_id, conversation_id=conversation_id, data_table=data_table)
+        spans = [shard.span_retriever(trace_id=trace_id, data_table=data_table) for shard in self.shards]
+        return sorted((span for shard_spans in spans for span in shard_spans), key=lambda span: span['start'])
+
+
+    # ---- Cross-shard reads and maintenance ---- #
+
+    def conversation_retriever(self, basedOnDate: bool=False, top_k: int=20, data_table: str="conversations", date: str=None, exclude_image: bool=False, exclude_text: bool=False, role: str=None):
+        """Return the data of every shard merged in chronological order (oldest to newest)
+
+        Takes the same arguments and returns the same shape as DatabaseCore.conversation_retriever.
+        """
+        if role is not None and role not in ['user', 'system', 'agent']:
+            logger.error(f"Invalid role: {role}. Must be 'user', 'system', or 'agent'")
+            return False
+
+        columns = ["date", "id", "role"]
+        if not exclude_text:
+            columns.append("text")
+        if not exclude_image:
+            columns.append("image")
+        columns_str = ", ".join(columns)
+
+        where_clauses = []
+        params = []
+        if not basedOnDate:
+            # The top_kth newest user message across shards is among the top_k newest of each shard
+            user_dates = sorted(
+                (row[0] for row in self.query_shards(f"SELECT date FROM {data_table} WHERE role = 'user' ORDER BY date DESC LIMIT ?", (top_k,))),
+                reverse=True
+            )
+            if len(user_dates) >= top_k:
+                where_clauses.append("date >= ?")
+                params.append(user_dates[top_k - 1])
+        else:
+            if date is not None:
+                where_clauses.append("date >= ?")
+                params.append(date)
+            if role is not None:
+                where_clauses.append("role = ?")
+                params.append(role)
+
+        query = f"SELECT {columns_str} FROM {data_table}"
+        if where_clauses:
+            query += " WHERE " + " AND ".join(where_clauses)
+        query += " ORDER BY date ASC, id ASC"
+
+        rows = sorted(self.query_shards(query, tuple(params)), key=lambda row: (row[0], row[1]))
+        return [list(row[2:]) for row in rows]
+
+
+    def conversation_page_retriever(self, before_date: str, after_id: int=0, limit: int=1000, data_table: str="conversations"):
+        """Retrieve a page of rows older than a date from every shard, merged by id"""
+        pages = [
+            shard.conversation_page_retriever(before_date=before_date, after_id=after_id, limit=limit, data_table=data_table)
+            for shard in self.shards
+        ]
+        return list(heapq.merge(*pages, key=lambda row: row[0]))[:limit]
+
+
+    def conversation_deleter(self, ids: list[int], data_table: str="conversations"):
+        shard_ids = {}
+        for row_id in ids:
+            shard_ids.setdefault(row_id // SHARD_ID_STRIDE, []).append(row_id)
+        return sum(self.shards[index].conversation_deleter(ids=row_ids, data_table=data_table) for index, row_ids in shard_ids.items())
+
+
+    def reclaim_space(self, full: bool=False):
+        for shard in self.shards:
+            shard.reclaim_space(full=full)
+
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
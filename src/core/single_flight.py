@@ -0,0 +1,108 @@
+from src.core.logging_config import setup_logging
+
+from concurrent.futures import Future
+from typing import Callable
+import asyncio
+import hashlib
+import json
+import threading
+import logging
+
+# Get logger for this module
+logger = logging.getLogger(__name__)
+
+class SingleFlight:
+    def __init__(self, verbose: bool):
+        """
+        Initialize the SingleFlight class.
+
+        Identical calls arriving while one is in flight wait for it and share its result (or its
+        exception) instead of calling upstream again. Nothing is cached: once a call completes, the
+        next identical call runs again. Thread and asyncio callers share the same in-flight calls.
+
+        Args:
+            verbose: Whether to enable verbose logging.
+        """
+        self.verbose = verbose
+        setup_logging(verbose=verbose)
+
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.stats = {'calls': 0, 'coalesced': 0}
+
+
+    @staticmethod
+    def makeKey(parts: dict) -> str:
+        """
+        Build the key of a call from its arguments.
+
+        Args:
+            parts: The JSON serializable arguments identifying the call.
+
+        Returns:
+            str: The hex SHA-256 of the canonical JSON of the arguments.
+        """
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+    def _join(self, key: str) -> tuple[Future, bool]:
+        """Return the in-flight future of a key, and whether the caller leads the call."""
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self.stats['coalesced'] += 1
+                logger.info(f"Joining in-flight call {key[:12]}")
+                return future, False
+            future = self._calls[key] = Future()
+            self.stats['calls'] += 1
+            return future, True
+
+
+    def _lead(self, key: str, future: Future, call: Callable):
+        """Run the call and hand its outcome to every caller waiting on it."""
+        try:
+            result = call()
+        except BaseException as e:
+            with self._lock:
+                self._calls.pop(key, None)
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self._calls.pop(key, None)
+        future.set_result(result)
+        return result
+
+
+    def do(self, key: str, call: Callable):
+        """
+        Run a call, or wait for the identical call in flight, from a thread.
+
+        Args:
+            key: The key of the call, see makeKey.
+            call: The function making the upstream call.
+
+        Returns:
+            The result of the call.
+        """
+        future, leader = self._join(key)
+        if leader:
+            return self._lead(key, future, call)
+        return future.result()
+
+
+    async def doAsync(self, key: str, call: Callable):
+        """
+        Run a blocking call in a worker thread, or wait for the identical call in flight, from a
+        coroutine. Waiting callers don't hold a thread.
+
+        Args:
+            key: The key of the call, see makeKey.
+            call: The blocking function making the upstream call.
+
+        Returns:
+            The result of the call.
+        """
+        future, leader = self._join(key)
+        if leader:
+            return await asyncio.to_thread(self._lead, key, future, call)
+        return await asyncio.wrap_future(future)
@@ -0,0 +1,198 @@
+from src.core.logging_config import setup_logging
+
+from smolagents import Tool
+
+from contextlib import contextmanager
+from functools import wraps
+import threading
+import inspect
+import json
+import time
+import os
+import re
+import logging
+
+# Get logger for this module
+logger = logging.getLogger(__name__)
+
+class ToolCache:
+    def __init__(self, verbose: bool, ttl: float = 0, max_entries: int = 1024, enabled: bool = True):
+        """
+        Initialize the ToolCache class.
+
+        Tool calls are memoized per agent run. When ttl is positive, results are also kept
+        in a shared tier reused across runs until they expire.
+
+        Args:
+            verbose: Whether to enable verbose logging.
+            ttl: Time to live in seconds of the cross-run tier. 0 disables it.
+            max_entries: Maximum number of entries kept in the cross-run tier.
+            enabled: Whether memoization is active.
+        """
+        self.verbose = verbose
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.enabled = enabled
+        setup_logging(verbose=verbose)
+
+        # Cross-run tier shared by every thread
+        self._shared = {}
+        self._lock = threading.Lock()
+
+        # Per-run tier, one per thread running an agent
+        self._local = threading.local()
+
+
+    def wrapTool(self, tool: Tool) -> Tool:
+        """
+        Wrap the forward method of a tool so calls with the same normalized arguments are memoized.
+        Exceptions aren't cached, nor are results the tool's isFailure method, if it has one, reports
+        as failures, so a transient error such as a rate limit isn't replayed.
+
+        Args:
+            tool: The tool to wrap.
+
+        Returns:
+            Tool: The same tool instance, memoized if the cache is enabled.
+        """
+        if not self.enabled or getattr(tool, "_memoized", False):
+            return tool
+
+        forward = tool.forward
+        signature = inspect.signature(forward)
+        is_failure = getattr(tool, "isFailure", None)
+
+        @wraps(forward)
+        def memoized_forward(*args, **kwargs):
+            arguments = signature.bind(*args, **kwargs).arguments
+            key = self.makeKey(tool.name, arguments)
+
+            found, result = self.lookup(key)
+            if found:
+                logger.info(f"Tool cache hit for {tool.name}")
+                return result
+
+            result = forward(*args, **kwargs)
+            if is_failure is not None and is_failure(result):
+                logger.info(f"Tool {tool.name} failed, result not cached")
+                return result
+            self.store(key, result)
+            return result
+
+        tool.forward = memoized_forward
+        tool._memoized = True
+        return tool
+
+
+    @contextmanager
+    def run(self, name: str):
+        """
+        Scope the per-run tier to one agent run and log its hit statistics on exit.
+
+        Args:
+            name: The name of the run, used in the logs.
+
+        Yields:
+            dict: The statistics of the run ('calls', 'hits', 'shared_hits').
+        """
+        stats = {'calls': 0, 'hits': 0, 'shared_hits': 0}
+        self._local.entries = {}
+        self._local.stats = stats
+        try:
+            yield stats
+        finally:
+            self._local.entries = None
+            self._local.stats = None
+            if self.enabled and stats['calls']:
+                logger.info(
+                    f"Tool cache for {name}: {stats['hits'] + stats['shared_hits']}/{stats['calls']} hits "
+                    f"({stats['hits']} in run, {stats['shared_hits']} cross-run)"
+                )
+
+
+    def lookup(self, key: str) -> tuple[bool, object]:
+        """
+        Look a key up in the per-run tier, then in the cross-run tier.
+
+        Returns:
+            tuple[bool, object]: Whether the key was found and the cached result
+        """
+        entries = getattr(self._local, "entries", None)
+        stats = getattr(self._local, "stats", None)
+        if stats is not None:
+            stats['calls'] += 1
+
+        if entries is not None and key in entries:
+            stats['hits'] += 1
+            return True, entries[key]
+
+        if self.ttl > 0:
+            with self._lock:
+                cached = self._shared.get(key)
+                if cached is not None and cached[0] > time.monotonic():
+                    if stats is not None:
+                        stats['shared_hits'] += 1
+                    if entries is not None:
+                        entries[key] = cached[1]
+                    return True, cached[1]
+                if cached is not None:
+                    del self._shared[key]
+
+        return False, None
+
+
+    def store(self, key: str, result):
+        """
+        Store a tool result in the per-run tier and, if enabled, in the cross-run tier.
+        """
+        entries = getattr(self._local, "entries", None)
+        if entries is not None:
+            entries[key] = result
+
+        if self.ttl > 0:
+            with self._lock:
+                if len(self._shared) >= self.max_entries:
+                    # Dicts keep insertion order, so the first key is the oldest entry
+                    self._shared.pop(next(iter(self._shared)))
+                self._shared[key] = (time.monotonic() + self.ttl, result)
+
+
+    def clear(self):
+        """Drop every entry of the cross-run tier."""
+        with self._lock:
+            self._shared.clear()
+
+
+    def makeKey(self, tool_name: str, arguments: dict) -> str:
+        """
+        Build the cache key of a tool call from its normalized arguments.
+
+        Args:
+            tool_name: The name of the tool.
+            arguments: The arguments of the call.
+
+        Returns:
+            str: The cache key.
+        """
+        normalized = {name: self.normalizeArgument(value) for name, value in sorted(arguments.items())}
+        return f"{tool_name}:{json.dumps(normalized, sort_keys=True, default=str)}"
+
+
+    def normalizeArgument(self, value):
+        """
+        Normalize an argument so trivially different calls share the same key.
+            - Paths to existing files are resolved and tagged with their size and modification time.
+            - Text is case folded, whitespace collapsed and trailing punctuation removed.
+            - Lists are normalized item by item.
+        """
+        if isinstance(value, (list, tuple)):
+            return [self.normalizeArgument(item) for item in value]
+        if not isinstance(value, str):
+            return value
+
+        if os.path.isfile(value):
+            stat = os.stat(value)
+            return f"{os.path.realpath(value)}@{stat.st_size}:{stat.st_mtime_ns}"
+
+        text = re.sub(r"\s+", " ", value.casefold()).strip()
+        return text.rstrip(" ?!.,;:")
@@ -1,9 +1,19 @@
+from src.core.image_metrics import analyzeImage
+
 from smolagents import Tool
-from typing import Optional
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Optional
+from urllib.parse import urlsplit, urlunsplit
+import re
+import requests
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
+# Heads the queries of a research result that failed or timed out
+FAILED_QUERIES = "Queries that failed or timed out:"
+
 class ImageAnalysisTool(Tool):
     name = "image_analysis"
     description = """
@@ -23,6 +33,7 @@ class ImageAnalysisTool(Tool):
     output_type = "string"
 
     def __init__(self, model_handler):
+        super().__init__()
         self.model_handler = model_handler
 
     def forward(self, image_path: str, prompt: str) -> str:
@@ -41,4 +52,217 @@ class ImageAnalysisTool(Tool):
         except Exception as e:
             logger.error(f"Error analyzing image: {str(e)}")
             return f"Error analyzing image: {str(e)}"
- 
\ No newline at end of file
+
+    def isFailure(self, result: str) -> bool:
+        """Whether a result reports a failure, which tool caches must not replay."""
+        return isinstance(result, str) and result.startswith("Error analyzing image:")
+ 
+
+class ColorCompositionTool(Tool):
+    name = "color_composition"
+    description = """
+    This is a tool that measures the color and composition of an image locally, in milliseconds, without calling the vision model.
+    It returns the dominant palette (hex, color name, share), color harmony, value distribution and key, contrast, saturation
+    and colorfulness, warm/cool balance, and composition metrics: center of visual weight, nearest rule-of-thirds point,
+    left/right and top/bottom balance, and 3x3 weight and edge density grids (rows top to bottom).
+    Use it for measurable facts about color and composition, and image_analysis for what the image depicts.
+    """
+    inputs = {
+        "image_path": {
+            "type": "string",
+            "description": "The path to the image file to measure",
+        },
+        "colors": {
+            "type": "integer",
+            "description": "The number of palette colors, 6 by default",
+            "nullable": True,
+        }
+    }
+    output_type = "object"
+
+    def forward(self, image_path: str, colors: Optional[int] = 6) -> dict:
+        """
+        Measure the color and composition of an image.
+
+        Args:
+            image_path: Path to the image file
+            colors: The number of palette colors
+
+        Returns:
+            dict: The metrics, see image_metrics.analyzeImage
+        """
+        try:
+            return analyzeImage(image_path, colors=colors or 6)
+        except Exception as e:
+            logger.error(f"Error measuring image: {str(e)}")
+            return {'error': f"Error measuring image: {str(e)}"}
+
+    def isFailure(self, result: dict) -> bool:
+        """Whether a result reports a failure, which tool caches must not replay."""
+        return isinstance(result, dict) and 'error' in result
+
+
+class ParallelResearchTool(Tool):
+    name = "parallel_research"
+    description = """
+    This is a tool that researches several queries at once. Give it all the sub-queries of a research task in one call
+    (e.g. one per art movement): the web searches, and the fetch of the top pages, run concurrently and the results
+    come back merged and deduplicated, ranked by how many queries found them.
+    """
+    inputs = {
+        "queries": {
+            "type": "array",
+            "description": "The list of search queries to run",
+        },
+        "fetch_pages": {
+            "type": "integer",
+            "description": "The number of top result pages to fetch and include, 0 for search snippets only",
+            "nullable": True,
+        }
+    }
+    output_type = "string"
+
+    def __init__(self, search_backend: Callable[[str, int], list[dict]] = None,
+                       fetch_backend: Callable[[str, float], str] = None,
+                       max_workers: int = 8,
+                       timeout: float = 10.0,
+                       max_results: int = 5,
+                       max_page_chars: int = 3000):
+        """
+        Args:
+            search_backend: Called with (query, max_results), returns results as dicts with title, href and body.
+                Defaults to DuckDuckGo. Pass a stub to run offline.
+            fetch_backend: Called with (url, timeout), returns the text of the page. Defaults to an HTTP GET converted to markdown.
+            max_workers: The maximum number of searches and fetches running at once.
+            timeout: The seconds each search or fetch may take. Late results are dropped.
+            max_results: The number of results kept per query.
+            max_page_chars: The number of characters kept per fetched page.
+        """
+        super().__init__()
+        self.search_backend = search_backend or self.duckDuckGoSearch
+        self.fetch_backend = fetch_backend or self.fetchPage
+        self.timeout = timeout
+        self.max_results = max_results
+        self.max_page_chars = max_page_chars
+        # Shared by every call, so concurrent agent runs stay within max_workers together
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="research")
+        self._ddgs = None
+
+    def forward(self, queries: list, fetch_pages: Optional[int] = 0) -> str:
+        """
+        Run every query concurrently and merge the results.
+
+        Args:
+            queries: The search queries
+            fetch_pages: The number of top result pages to fetch
+
+        Returns:
+            str: The merged results, as markdown
+        """
+        # Drop duplicate queries, ignoring case and whitespace
+        unique = {}
+        for query in queries:
+            query = " ".join(str(query).split())
+            if query:
+                unique.setdefault(query.casefold(), query)
+        unique_queries = list(unique.values())
+        if not unique_queries:
+            return "No queries given."
+
+        searches = self.runAll({query: (self.search_backend, query, self.max_results) for query in unique_queries})
+
+        # Merge the results found by several queries, keeping the best rank
+        merged = {}
+        for query in unique_queries:
+            for rank, result in enumerate((searches.get(query) or [])[:self.max_results]):
+                # A result without a link can't be cited or fetched
+                if not result.get('href'):
+                    continue
+                key = self.normalizeUrl(result['href'])
+                entry = merged.setdefault(key, {'title': result.get('title', ""), 'href': result['href'], 'body': result.get('body', ""), 'queries': [], 'rank': rank})
+                entry['queries'].append(query)
+                entry['rank'] = min(entry['rank'], rank)
+        ranked = sorted(merged.values(), key=lambda entry: (-len(entry['queries']), entry['rank']))
+
+        pages = {}
+        if fetch_pages:
+            pages = self.runAll({entry['href']: (self.fetch_backend, entry['href'], self.timeout) for entry in ranked[:fetch_pages]})
+
+        logger.info(f"Parallel research: {len(unique_queries)} queries, {len(ranked)} unique results, {len(pages)} pages fetched")
+
+        sections = []
+        for entry in ranked:
+            section = f"[{entry['title']}]({entry['href']})\nFound by: {'; '.join(entry['queries'])}\n{entry['body']}"
+            if pages.get(entry['href']):
+                section += f"\n\nPage content:\n{pages[entry['href']][:self.max_page_chars]}"
+            sections.append(section)
+
+        # A query missing from the searches failed or timed out, one found in them may just have no results
+        failed = [query for query in unique_queries if query not in searches]
+        empty = [query for query in unique_queries if query in searches and not searches[query]]
+        output = "## Research Results\n\n" + ("\n\n".join(sections) if sections else "No results found.")
+        if empty:
+            output += f"\n\nQueries without results: {'; '.join(empty)}"
+        if failed:
+            output += f"\n\n{FAILED_QUERIES} {'; '.join(failed)}"
+        return output
+
+    def isFailure(self, result: str) -> bool:
+        """Whether some queries of a result failed or timed out, which tool caches must not replay."""
+        return isinstance(result, str) and FAILED_QUERIES in result
+
+    def runAll(self, calls: dict) -> dict:
+        """
+        Run calls concurrently on the pool, each within the timeout.
+
+        The pool is shared, so a call may wait behind other work before it starts. Its timeout only
+        counts from when it starts running.
+
+        Args:
+            calls: For each key, the function and its arguments.
+
+        Returns:
+            dict: The result of each call that finished in time without error.
+        """
+        started = {}
+
+        def timed(key, function, *arguments):
+            started[key] = time.monotonic()
+            return function(*arguments)
+
+        futures = {self.pool.submit(timed, key, function, *arguments): key for key, (function, *arguments) in calls.items()}
+        results = {}
+        pending = set(futures)
+        while pending:
+            # Wake up at the earliest deadline of the running calls, or when one finishes
+            deadlines = [started[futures[future]] + self.timeout for future in pending if futures[future] in started]
+            timeout = max(min(deadlines) - time.monotonic(), 0) if deadlines else self.timeout
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    results[futures[future]] = future.result()
+                except Exception as e:
+                    logger.warning(f"Research call {futures[future]} failed: {str(e)}")
+            now = time.monotonic()
+            for future in [future for future in pending if futures[future] in started and now - started[futures[future]] >= self.timeout]:
+                pending.discard(future)
+                future.cancel()
+                logger.warning(f"Research call {futures[future]} timed out after {self.timeout}s")
+        return results
+
+    def normalizeUrl(self, url: str) -> str:
+        """Normalize a URL so the same page found by several queries is only listed once."""
+        parts = urlsplit(url.strip())
+        return urlunsplit((parts.scheme.lower(), parts.netloc.lower().removeprefix("www."), parts.path.rstrip("/"), parts.query, ""))
+
+    def duckDuckGoSearch(self, query: str, max_results: int) -> list[dict]:
+        if self._ddgs is None:
+            from duckduckgo_search import DDGS
+            self._ddgs = DDGS(timeout=int(self.timeout))
+        return self._ddgs.text(query, max_results=max_results)
+
+    def fetchPage(self, url: str, timeout: float) -> str:
+        from markdownify import markdownify
+        response = requests.get(url, timeout=timeout)
+        response.raise_for_status()
+        return re.sub(r"\n{3,}", "\n\n", markdownify(response.text).strip())
@@ -0,0 +1,305 @@
+from src.core.database import DatabaseCore
+from src.core.logging_config import setup_logging
+
+from smolagents import Tool
+from smolagents.memory import ActionStep
+
+from contextlib import contextmanager
+from functools import wraps
+import threading
+import json
+import time
+import uuid
+import logging
+
+# Get logger for this module
+logger = logging.getLogger(__name__)
+
+class TracedModel:
+    """
+    Thin proxy around a SmolAgents model that records a span for every model call.
+    Every other attribute (model_id, token counts, ...) is forwarded to the wrapped model.
+    """
+    def __init__(self, model, tracer: "Tracer", agent_name: str):
+        self._model = model
+        self._tracer = tracer
+        self._agent_name = agent_name
+
+
+    def __call__(self, messages, stop_sequences=None, **kwargs):
+        # Planning steps are the only model calls stopping on <end_plan>
+        category = "planning" if stop_sequences and "<end_plan>" in stop_sequences else "model"
+
+        start = time.time()
+        try:
+            return self._model(messages, stop_sequences=stop_sequences, **kwargs)
+        finally:
+            duration = time.time() - start
+            self._tracer.recordModelCall(
+                agent_name=self._agent_name,
+                category=category,
+                start=start,
+                duration=duration,
+                input_tokens=getattr(self._model, "last_input_token_count", None),
+                output_tokens=getattr(self._model, "last_output_token_count", None)
+            )
+
+
+    def __getattr__(self, name):
+        return getattr(self._model, name)
+
+
+class Tracer:
+    def __init__(self, database: DatabaseCore, verbose: bool, enabled: bool = True):
+        """
+        Initialize the Tracer class.
+
+        Args:
+            database: The database where spans are stored.
+            verbose: Whether to enable verbose logging.
+            enabled: Whether tracing is active. A disabled tracer leaves models and tools untouched.
+        """
+        self.database = database
+        self.enabled = enabled
+        self.verbose = verbose
+        setup_logging(verbose=verbose)
+
+        # Each thread runs its own agent, so the active trace is thread local
+        self._local = threading.local()
+
+
+    def wrapModel(self, model, agent_name: str):
+        """
+        Wrap a model so every call made by the given agent is recorded.
+
+        Args:
+            model: The SmolAgents model to wrap.
+            agent_name: The name of the agent using this model.
+
+        Returns:
+            The traced model, or the model itself if tracing is disabled.
+        """
+        if not self.enabled:
+            return model
+        return TracedModel(model, tracer=self, agent_name=agent_name)
+
+
+    def wrapTool(self, tool: Tool, agent_name: str) -> Tool:
+        """
+        Wrap the forward method of a tool so every call is recorded as a span.
+
+        Args:
+            tool: The tool to wrap.
+            agent_name: The name of the agent owning this tool.
+
+        Returns:
+            Tool: The same tool instance, instrumented if tracing is enabled.
+        """
+        if not self.enabled or getattr(tool, "_traced", False):
+            return tool
+
+        forward = tool.forward
+
+        @wraps(forward)
+        def traced_forward(*args, **kwargs):
+            start = time.time()
+            error = None
+            try:
+                return forward(*args, **kwargs)
+            except Exception as e:
+                error = str(e)
+                raise
+            finally:
+                self.addSpan(
+                    agent_name=agent_name,
+                    name=tool.name,
+                    category="tool",
+                    start=start,
+                    duration=time.time() - start,
+                    attributes={'tool': tool.name, 'error': error}
+                )
+
+        tool.forward = traced_forward
+        tool._traced = True
+        return tool
+
+
+    def stepCallback(self, agent_name: str):
+        """
+        Build a SmolAgents step callback recording one span per agent step.
+
+        Args:
+            agent_name: The name of the agent the callback is attached to.
+
+        Returns:
+            Callable: The callback to pass in `step_callbacks`.
+        """
+        def callback(memory_step, agent=None):
+            if not self.enabled or not isinstance(memory_step, ActionStep):
+                return
+            if memory_step.start_time is None or memory_step.end_time is None:
+                return
+
+            step_model = self._popStepModelStats(agent_name)
+            duration = memory_step.end_time - memory_step.start_time
+
+            self.addSpan(
+                agent_name=agent_name,
+                name=f"step {memory_step.step_number}",
+                category="step",
+                start=memory_step.start_time,
+                duration=duration,
+                attributes={
+                    'step_number': memory_step.step_number,
+                    'model_latency': step_model['latency'],
+                    'input_tokens': step_model['input_tokens'],
+                    'output_tokens': step_model['output_tokens'],
+                    'error': str(memory_step.error) if memory_step.error else None
+                }
+            )
+
+            # Whatever is not spent waiting on the model is spent executing the generated code
+            self.addSpan(
+                agent_name=agent_name,
+                name="code_execution",
+                category="code_execution",
+                start=memory_step.start_time + step_model['latency'],
+                duration=max(duration - step_model['latency'], 0.0),
+                attributes={'step_number': memory_step.step_number}
+            )
+
+        return callback
+
+
+    @contextmanager
+    def trace(self, name: str, conversation_id: int = None):
+        """
+        Trace one agent run. Spans recorded inside the block are saved to the database on exit.
+
+        Args:
+            name: The name of the run (e.g. "runAgent").
+            conversation_id: The id of the conversation row that started the run.
+
+        Yields:
+            str: The trace id, or None if tracing is disabled.
+        """
+        if not self.enabled:
+            yield None
+            return
+
+        trace_id = uuid.uuid4().hex
+        self._local.trace = {
+            'trace_id': trace_id,
+            'conversation_id': conversation_id,
+            'spans': [],
+            'step_model': {}
+        }
+        start = time.time()
+        try:
+            yield trace_id
+        finally:
+            self.addSpan(agent_name="manager", name=name, category="run", start=start, duration=time.time() - start)
+            current = self._local.trace
+            self._local.trace = None
+            self.database.span_saver(current['spans'])
+            logger.info(f"Trace {trace_id} saved with {len(current['spans'])} spans")
+
+
+    def addSpan(self, agent_name: str, name: str, category: str, start: float, duration: float, attributes: dict = None):
+        """
+        Add a span to the active trace. Spans recorded outside of a trace are dropped.
+
+        Args:
+            agent_name: The agent that produced the span.
+            name: The name of the span.
+            category: The span category ('run', 'step', 'planning', 'model', 'tool', 'code_execution').
+            start: Start time as a unix timestamp in seconds.
+            duration: Duration in seconds.
+            attributes: Extra attributes stored as JSON.
+        """
+        current = getattr(self._local, "trace", None)
+        if current is None:
+            return
+
+        current['spans'].append({
+            'trace_id': current['trace_id'],
+            'conversation_id': current['conversation_id'],
+            'agent': agent_name,
+            'name': name,
+            'category': category,
+            'start': start,
+            'duration': duration,
+            'attributes': attributes or {}
+        })
+
+
+    def recordModelCall(self, agent_name: str, category: str, start: float, duration: float, input_tokens: int, output_tokens: int):
+        """
+        Record a model call span and account its latency and tokens to the current step of the agent.
+        """
+        current = getattr(self._local, "trace", None)
+        if current is None:
+            return
+
+        stats = current['step_model'].setdefault(agent_name, {'latency': 0.0, 'input_tokens': 0, 'output_tokens': 0})
+        stats['latency'] += duration
+        stats['input_tokens'] += input_tokens or 0
+        stats['output_tokens'] += output_tokens or 0
+
+        self.addSpan(
+            agent_name=agent_name,
+            name=category,
+            category=category,
+            start=start,
+            duration=duration,
+            attributes={'input_tokens': input_tokens, 'output_tokens': output_tokens}
+        )
+
+
+    def _popStepModelStats(self, agent_name: str) -> dict:
+        current = getattr(self._local, "trace", None)
+        empty = {'latency': 0.0, 'input_tokens': 0, 'output_tokens': 0}
+        if current is None:
+            return empty
+        return current['step_model'].pop(agent_name, empty)
+
+
+    def exportChromeTrace(self, trace_id: str = None, conversation_id: int = None, output_path: str = None) -> dict:
+        """
+        Export stored spans in the Chrome trace event format (chrome://tracing, Perfetto, speedscope).
+
+        Args:
+            trace_id: Export a single trace.
+            conversation_id: Export every trace linked to this conversation row.
+            output_path: Optional path of the JSON file to write.
+
+        Returns:
+            dict: The Chrome trace document.
+        """
+        spans = self.database.span_retriever(trace_id=trace_id, conversation_id=conversation_id)
+
+        # One thread lane per agent so managed agents render under the manager
+        thread_ids = {}
+        events = []
+        for span in spans:
+            tid = thread_ids.setdefault(span['agent'], len(thread_ids) + 1)
+            events.append({
+                'name': span['name'],
+                'cat': span['category'],
+                'ph': 'X',
+                'ts': span['start'] * 1e6,
+                'dur': span['duration'] * 1e6,
+                'pid': 1,
+                'tid': tid,
+                'args': {**span['attributes'], 'trace_id': span['trace_id'], 'conversation_id': span['conversation_id']}
+            })
+
+        for agent_name, tid in thread_ids.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': {'name': agent_name}})
+
+        document = {'traceEvents': events, 'displayTimeUnit': 'ms'}
+        if output_path is not None:
+            with open(output_path, "w") as f:
+                json.dump(document, f)
+            logger.info(f"Chrome trace exported to {output_path}")
+        return document
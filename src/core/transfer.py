@@ -0,0 +1,315 @@
+from src.core.database import DatabaseCore
+from src.core.logging_config import setup_logging
+
+from typing import Iterable, Iterator
+from itertools import islice
+import argparse
+import base64
+import binascii
+import bz2
+import csv
+import gzip
+import json
+import lzma
+import os
+import sys
+import time
+import logging
+
+# Get logger for this module
+logger = logging.getLogger(__name__)
+
+# Compression of the transfer files, inferred from their extension unless given
+COMPRESSIONS = {
+    'gzip': (gzip.open, ".gz"),
+    'bz2': (bz2.open, ".bz2"),
+    'xz': (lzma.open, ".xz"),
+}
+
+FIELDS = {
+    'conversations': ['id', 'date', 'role', 'text', 'image', 'image_path', 'session_id', 'parent_id'],
+    'ideas': ['id', 'date', 'idea', 'uses', 'last_used'],
+}
+
+# File extension of exported images, by their leading bytes
+IMAGE_SIGNATURES = [
+    (b"\x89PNG", ".png"),
+    (b"\xff\xd8\xff", ".jpg"),
+    (b"GIF8", ".gif"),
+    (b"RIFF", ".webp"),
+]
+
+# Base64 images don't fit in the default CSV field size limit
+csv.field_size_limit(sys.maxsize)
+
+
+class DataTransfer:
+    def __init__(self, database: DatabaseCore, verbose: bool, batch_size: int = 50000):
+        """
+        Initialize the DataTransfer class.
+
+        Conversations and ideas are moved in and out of the database in bulk, as JSONL or CSV files,
+        optionally gzip, bz2 or xz compressed. Imports are streamed in batches of batch_size records,
+        each saved with one executemany in one transaction; exports stream rows from a cursor, so
+        neither side ever holds a whole table in memory.
+
+        Args:
+            database: The database to import into or export from.
+            verbose: Whether to enable verbose logging.
+            batch_size: The number of records saved per transaction.
+        """
+        self.database = database
+        self.batch_size = batch_size
+        self.verbose = verbose
+        setup_logging(verbose=verbose)
+
+
+    def openFile(self, path: str, mode: str, compression: str = None, level: int = None):
+        """
+        Open a transfer file as text, compressed according to `compression` or to its extension.
+
+        Args:
+            path: The path of the file.
+            mode: "r" or "w".
+            compression: "gzip", "bz2", "xz" or "none". Inferred from the extension if None.
+            level: The compression level, the default of the format if None.
+        """
+        if compression is None:
+            compression = next((name for name, (_, extension) in COMPRESSIONS.items() if path.endswith(extension)), "none")
+        if compression == "none":
+            return open(path, mode, encoding="utf-8", newline="")
+
+        opener = COMPRESSIONS[compression][0]
+        options = {}
+        if level is not None and mode == "w":
+            options = {'preset': level} if compression == "xz" else {'compresslevel': level}
+        return opener(path, mode + "t", encoding="utf-8", newline="", **options)
+
+
+    def fileFormat(self, path: str, file_format: str = None) -> str:
+        """The format of a transfer file, "jsonl" or "csv", inferred from its extension if not given."""
+        if file_format is not None:
+            return file_format
+        for _, extension in COMPRESSIONS.values():
+            path = path.removesuffix(extension)
+        return "csv" if path.endswith(".csv") else "jsonl"
+
+
+    def readRecords(self, path: str, file_format: str = None, compression: str = None) -> Iterator[dict]:
+        """
+        Stream the records of a JSONL or CSV file.
+
+        Yields:
+            dict: One record. Empty CSV fields are None.
+        """
+        with self.openFile(path, "r", compression=compression) as f:
+            if self.fileFormat(path, file_format) == "csv":
+                for row in csv.DictReader(f):
+                    record = {key: value if value != "" else None for key, value in row.items()}
+                    for key in ('id', 'parent_id', 'uses'):
+                        if record.get(key) is not None:
+                            record[key] = int(record[key])
+                    yield record
+            else:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+
+
+    def writeRecords(self, path: str, records: Iterable[dict], table: str, file_format: str = None, compression: str = None, level: int = None) -> int:
+        """
+        Stream records to a JSONL or CSV file.
+
+        Returns:
+            int: The number of written records.
+        """
+        count = 0
+        with self.openFile(path, "w", compression=compression, level=level) as f:
+            if self.fileFormat(path, file_format) == "csv":
+                writer = csv.DictWriter(f, fieldnames=FIELDS[table], extrasaction="ignore")
+                writer.writeheader()
+                for record in records:
+                    writer.writerow(record)
+                    count += 1
+            else:
+                for record in records:
+                    f.write(json.dumps({key: value for key, value in record.items() if value is not None}, ensure_ascii=False) + "\n")
+                    count += 1
+        return count
+
+
+    def batches(self, records: Iterable[dict]) -> Iterator[list[dict]]:
+        """Split records into lists of batch_size."""
+        records = iter(records)
+        while batch := list(islice(records, self.batch_size)):
+            yield batch
+
+
+    def importConversations(self, path: str, file_format: str = None, compression: str = None) -> int:
+        """
+        Import conversations, e.g. historical turns or an export of another instance.
+
+        Images are read inline from `image` (base64 or data URL) or from the file at `image_path`,
+        relative to the imported file. parent_id links between imported records are preserved.
+
+        Args:
+            path: The JSONL or CSV file.
+            file_format: "jsonl" or "csv", inferred from the extension if None.
+            compression: "gzip", "bz2", "xz" or "none", inferred from the extension if None.
+
+        Returns:
+            int: The number of imported records.
+        """
+        start = time.perf_counter()
+        base_directory = os.path.dirname(os.path.abspath(path))
+        id_map = {}
+        imported = read = 0
+
+        for batch in self.batches(self.readRecords(path, file_format=file_format, compression=compression)):
+            read += len(batch)
+            for record in batch:
+                if record.get('image') is None and record.get('image_path'):
+                    record['image'] = self.imageFromFile(os.path.join(base_directory, record['image_path']))
+                elif isinstance(record.get('image'), str) and record['image'].startswith("data:"):
+                    record['image'] = record['image'].split(",", 1)[1]
+            imported += self.database.conversation_bulk_saver(batch, id_map=id_map)
+            logger.debug(f"{imported} conversations imported")
+
+        if imported < read:
+            logger.warning(f"{read - imported} records skipped: invalid role, or neither text nor image")
+        logger.info(f"{imported} conversations imported from {path} in {time.perf_counter() - start:.1f}s")
+        return imported
+
+
+    def exportConversations(self, path: str, images: str = "inline", image_dir: str = None, file_format: str = None, compression: str = None, level: int = None) -> int:
+        """
+        Export every conversation.
+
+        Args:
+            path: The JSONL or CSV file to write.
+            images: "inline" to keep images as base64 in the records, "files" to write them to
+                image_dir and reference them by `image_path`, or "none" to leave them out.
+            image_dir: The directory of the image files, next to the export if None.
+            file_format: "jsonl" or "csv", inferred from the extension if None.
+            compression: "gzip", "bz2", "xz" or "none", inferred from the extension if None.
+            level: The compression level, the default of the format if None.
+
+        Returns:
+            int: The number of exported records.
+        """
+        start = time.perf_counter()
+        base_directory = os.path.dirname(os.path.abspath(path))
+        if images == "files":
+            image_dir = image_dir or os.path.join(base_directory, "images")
+            os.makedirs(image_dir, exist_ok=True)
+
+        def records():
+            for record in self.database.conversation_streamer(batch_size=self.batch_size):
+                if record['image'] is not None and images == "files":
+                    image_path = self.imageToFile(record['image'], os.path.join(image_dir, str(record['id'])))
+                    record['image_path'] = os.path.relpath(image_path, base_directory) if image_path else None
+                    record['image'] = None
+                elif images == "none":
+                    record['image'] = None
+                yield record
+
+        exported = self.writeRecords(path, records(), "conversations", file_format=file_format, compression=compression, level=level)
+        logger.info(f"{exported} conversations exported to {path} in {time.perf_counter() - start:.1f}s")
+        return exported
+
+
+    def importIdeas(self, path: str, file_format: str = None, compression: str = None) -> int:
+        """
+        Import ideas, each record with its date and idea (one idea, or a summary with one idea per
+        line), and optionally the uses and last_used of its ideas. Ideas already saved are merged.
+
+        Returns:
+            int: The number of imported ideas.
+        """
+        imported = sum(
+            self.database.idea_bulk_saver(batch)
+            for batch in self.batches(self.readRecords(path, file_format=file_format, compression=compression))
+        )
+        logger.info(f"{imported} ideas imported from {path}")
+        return imported
+
+
+    def exportIdeas(self, path: str, file_format: str = None, compression: str = None, level: int = None) -> int:
+        """
+        Export every idea.
+
+        Returns:
+            int: The number of exported ideas.
+        """
+        exported = self.writeRecords(path, self.database.idea_streamer(batch_size=self.batch_size), "ideas", file_format=file_format, compression=compression, level=level)
+        logger.info(f"{exported} ideas exported to {path}")
+        return exported
+
+
+    def imageFromFile(self, image_path: str) -> str:
+        """Read an image file as base64, None if it can't be read."""
+        try:
+            with open(image_path, "rb") as image_file:
+                return base64.b64encode(image_file.read()).decode("ascii")
+        except OSError as e:
+            logger.warning(f"Image {image_path} not imported: {str(e)}")
+            return None
+
+
+    def imageToFile(self, image: str, path_without_extension: str) -> str:
+        """Write a base64 image to a file named after its format, return its path, None if it isn't valid base64."""
+        try:
+            data = base64.b64decode(image, validate=True)
+        except (binascii.Error, ValueError):
+            logger.warning(f"Image of {os.path.basename(path_without_extension)} is not valid base64, not exported")
+            return None
+        extension = next((extension for signature, extension in IMAGE_SIGNATURES if data.startswith(signature)), ".bin")
+        with open(path_without_extension + extension, "wb") as image_file:
+            image_file.write(data)
+        return path_without_extension + extension
+
+
+def main():
+    """
+    Command line interface, e.g.:
+        python -m src.core.transfer export conversations data/conversations.jsonl.gz --images files
+        python -m src.core.transfer import conversations history.csv
+    """
+    from dotenv import load_dotenv
+    from src.core.sharded_database import ShardedDatabaseCore
+
+    parser = argparse.ArgumentParser(description="Bulk import and export of ArtBuddy conversations and ideas")
+    parser.add_argument("action", choices=["import", "export"])
+    parser.add_argument("table", choices=list(FIELDS))
+    parser.add_argument("path", help="The JSONL or CSV file, optionally .gz, .bz2 or .xz")
+    parser.add_argument("--format", choices=["jsonl", "csv"], help="Inferred from the extension by default")
+    parser.add_argument("--compression", choices=[*COMPRESSIONS, "none"], help="Inferred from the extension by default")
+    parser.add_argument("--level", type=int, help="The compression level of an export")
+    parser.add_argument("--images", choices=["inline", "files", "none"], default="inline", help="How exported images are stored")
+    parser.add_argument("--image-dir", help="The directory of exported image files")
+    parser.add_argument("--batch-size", type=int, default=50000, help="The number of records per transaction")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    load_dotenv(override=True)
+    database_type = os.getenv("DATABASE_TYPE") or "sqlite"
+    database_path = os.getenv("DATABASE_PATH") or "ArtBuddy.db"
+    if database_type == "sqlite_sharded":
+        database = ShardedDatabaseCore(verbose=args.verbose, database_type=database_type, database_path=database_path, num_shards=int(os.getenv("DATABASE_SHARDS") or 4))
+    else:
+        database = DatabaseCore(verbose=args.verbose, database_type=database_type, database_path=database_path)
+
+    transfer = DataTransfer(database=database, verbose=args.verbose, batch_size=args.batch_size)
+    if args.action == "import" and args.table == "conversations":
+        count = transfer.importConversations(args.path, file_format=args.format, compression=args.compression)
+    elif args.action == "import":
+        count = transfer.importIdeas(args.path, file_format=args.format, compression=args.compression)
+    elif args.table == "conversations":
+        count = transfer.exportConversations(args.path, images=args.images, image_dir=args.image_dir, file_format=args.format, compression=args.compression, level=args.level)
+    else:
+        count = transfer.exportIdeas(args.path, file_format=args.format, compression=args.compression, level=args.level)
+    print(f"{count} {args.table} {args.action}ed")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,32 +1,42 @@
 from PIL import Image
-import base64
+from typing import Iterable, Iterator
+import binascii
 import os
 import requests
 from datetime import datetime
 import logging
+import math
 
 from src.core.logging_config import setup_logging
+from src.core.image_cache import ImageCache
+from src.core.http_transport import HttpTransport
 
 # Get logger for this module
 logger = logging.getLogger(__name__)
 
 class Utils:
-    def __init__(self, verbose: bool):
+    def __init__(self, verbose: bool, image_cache: ImageCache = None, transport: HttpTransport = None, download_timeout: float = 60):
         self.verbose = verbose
+        self.image_cache = image_cache
+        self.transport = transport
+        self.download_timeout = download_timeout
         setup_logging(verbose=verbose)
 
 
-    def imgLoader(self, imgs: list[str]) -> list[Image.Image]:
+    def imgLoader(self, imgs: Iterable[str]) -> Iterator[Image.Image]:
         """
-        Load images from the given list of paths.
+        Lazily load images from the given paths, one at a time, so only the image being used
+        is held in memory.
 
         Args:
-            imgs: The list of paths to the images.
+            imgs: The paths to the images.
 
-        Returns:
-            list[PIL.Image.Image]: A list of PIL Image objects.
+        Yields:
+            PIL.Image.Image: Each image, closed once the next one is requested.
         """
-        return [Image.open(path) for path in imgs]
+        for path in imgs:
+            with Image.open(path) as image:
+                yield image
 
     def imgSaver(self, image_url: str, formatted_prompt: str, save_path: str):
         
@@ -39,14 +49,125 @@ class Utils:
         # Download and save the image
         logger.info(f"Downloading image to {save_path}")
         
-        response = requests.get(image_url)
-        response.raise_for_status()
-        
-        with open(save_path, 'wb') as f:
-            f.write(response.content)
+        if self.transport is not None:
+            # Streamed through the shared pool, reusing the connection to the image host
+            self.transport.download(image_url, save_path)
+        else:
+            response = requests.get(image_url, timeout=self.download_timeout)
+            response.raise_for_status()
+
+            with open(save_path, 'wb') as f:
+                f.write(response.content)
+
+        # Build the thumbnail and web variants while the file is hot in the page cache. The image is
+        # saved either way, derivatives that fail here are generated on first access
+        if self.image_cache is not None:
+            try:
+                self.image_cache.generateDerivatives(save_path)
+            except Exception as e:
+                logger.warning(f"Failed to generate derivatives of {save_path}: {str(e)}")
         return save_path
 
 
-    def encode_image(self, image_path: str) -> str:
-        with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode("utf-8")
+    def imgDerivative(self, image_path: str, variant: str = "thumbnail") -> str:
+        """
+        Return the path of a small derivative of an image (thumbnail or web variant), to serve
+        galleries and history views without shipping the full resolution file.
+
+        Args:
+            image_path: The path to the original image.
+            variant: "thumbnail" or "web".
+
+        Returns:
+            str: The path of the derivative, or the original path if no cache is configured.
+        """
+        if self.image_cache is None:
+            return image_path
+        return self.image_cache.getDerivative(image_path, variant=variant)
+
+
+    def encodeImageChunks(self, image_path: str, chunk_size: int = 3 * 1024 * 1024) -> Iterator[bytes]:
+        """
+        Base64 encode an image incrementally. The file is read chunk by chunk into one reusable
+        buffer, so the raw image is never held in memory as a whole.
+
+        Args:
+            image_path: The path to the image.
+            chunk_size: The number of raw bytes encoded at once, rounded down to a multiple of 3 so
+                chunks concatenate into the base64 of the whole file.
+
+        Yields:
+            bytes: The base64 encoded chunks, in order.
+        """
+        chunk_size = max(3, chunk_size - chunk_size % 3)
+        buffer = bytearray(chunk_size)
+        view = memoryview(buffer)
+        with open(image_path, "rb", buffering=0) as image_file:
+            while True:
+                # Fill the whole chunk, a short chunk in the middle would add padding to the output
+                filled = 0
+                while filled < chunk_size:
+                    read = image_file.readinto(view[filled:])
+                    if not read:
+                        break
+                    filled += read
+                if filled:
+                    yield binascii.b2a_base64(view[:filled], newline=False)
+                if filled < chunk_size:
+                    return
+
+
+    def encode_image(self, image_path: str, prefix: str = "") -> str:
+        """
+        Base64 encode an image. The chunks are written into a single preallocated buffer, after the
+        prefix, and decoded to str once.
+
+        Args:
+            image_path: The path to the image.
+            prefix: ASCII text put before the base64, e.g. the header of a data URL.
+
+        Returns:
+            str: The prefix followed by the base64 encoded image.
+        """
+        header = prefix.encode("ascii")
+        encoded = bytearray(len(header) + 4 * math.ceil(os.path.getsize(image_path) / 3))
+        encoded[:len(header)] = header
+        position = len(header)
+        for chunk in self.encodeImageChunks(image_path):
+            encoded[position:position + len(chunk)] = chunk
+            position += len(chunk)
+        # The file may have shrunk since its size was read
+        del encoded[position:]
+        return encoded.decode("ascii")
+
+
+    def imageDataUrl(self, image_path: str, mime_type: str = "image/jpeg") -> str:
+        """
+        Encode an image as a base64 data URL, built in place instead of formatting the base64 into
+        a second string. The database accepts the data URL as an image and only stores its base64
+        payload, so the request and the record share the same string.
+
+        Args:
+            image_path: The path to the image.
+            mime_type: The MIME type announced in the data URL.
+
+        Returns:
+            str: The data URL of the image.
+        """
+        return self.encode_image(image_path, prefix=f"data:{mime_type};base64,")
+
+
+    @staticmethod
+    def countTokens(text: str) -> int:
+        """
+        Estimate the number of tokens of a text, using the usual ~4 characters per token of OpenAI tokenizers.
+
+        Args:
+            text: The text to measure.
+
+        Returns:
+            int: The estimated number of tokens.
+        """
+        if not text:
+            return 0
+        return math.ceil(len(text) / 4)